@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Asynchronous ELK client used by the total_* scripts to run
+independent search requests concurrently.
+"""
+
+import sys
+import json
+import logging
+import asyncio
+import aiohttp
+
+
+class AsyncElk(object):
+    """
+    Pooled asynchronous client on a _search endpoint.
+    At most "max_concurrency" requests are in flight at the same time
+    and each request must answer within "deadline" seconds.
+    """
+
+    def __init__(self, url, max_concurrency, deadline):
+        self.url = url
+        self.deadline = deadline
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+            headers={'Content-Type': 'application/json'})
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.session.close()
+
+    async def _get(self, json_value, url):
+        """ Send one search request and return the decoded answer. """
+
+        async with self.session.get(url, data=json_value) as req:
+            if req.status != 200:
+                message = "Error while requesting object, status " + \
+                    str(req.status)
+                logging.warning(message)
+                sys.exit(message)
+            return json.loads(await req.read())
+
+    async def request(self, search, url=None):
+        """
+        Request ELK with a search body (dict), on the endpoint of the
+        client by default.
+        """
+
+        if url is None:
+            url = self.url
+        async with self.semaphore:
+            try:
+                return await asyncio.wait_for(
+                    self._get(json.dumps(search), url), self.deadline)
+            except asyncio.TimeoutError:
+                message = "Request to " + url + " took more than " + \
+                    str(self.deadline) + " seconds"
+            except aiohttp.ClientError as error:
+                message = "Error while requesting " + url + " : " + \
+                    str(error)
+
+        logging.warning(message)
+        sys.exit(message)
+
+    async def request_all(self, searches):
+        """
+        Run all the given searches concurrently.
+        Returns the responses in the same order as the searches.
+        """
+
+        return await asyncio.gather(*[self.request(search)
+                                      for search in searches])
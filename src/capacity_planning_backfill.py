@@ -0,0 +1,714 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Script that rebuilds the rollup documents of a period from the raw
+documents : cluster documents from the hv documents, backup DC documents
+from the backuphost documents, SAN host/cluster/DC documents from the
+SAN pools documents.
+
+The raw documents are streamed in post_date order from ES (scroll) or
+from NDJSON files, and the rollups of the collection scripts are run at
+the end of every slice of "step" seconds, as if the script had run then.
+Results have a deterministic id (a backfill can be run again) and are
+written by parallel _bulk workers with a cap on documents per second.
+The documents written by the collection scripts have random ids : with
+--replace the documents of the targets posted in the period are deleted
+first, so that they aren't counted twice.
+
+    capacity_planning_backfill.py clusters --start 2019-01-01 \\
+        --end 2019-04-01 --step 3600
+"""
+
+import sys
+import json
+import heapq
+import queue
+import random
+import logging
+import argparse
+import datetime
+import threading
+import traceback
+import collections
+from time import gmtime, strftime, sleep, monotonic
+import os
+import requests
+from capacity_planning_store import to_epoch
+from capacity_planning_indices import history_url, write_url, type_filter, \
+    url_doc_type, is_latest_url
+from capacity_planning_relay import bulk_action
+from capacity_planning_sketch import update_state, merged_percentiles
+import capacity_planning_total_hypervisors as total_hypervisors
+import capacity_planning_total_backups as total_backups
+
+
+# What is rebuilt : the raw documents read ("source", key in the "indexes"
+# section of the conf file), the fields they must hold, the field grouping
+# them and the rollup documents written.
+KINDS = {
+    'clusters': {
+        'source': 'hv',
+        'required': ('name', 'cluster') + total_hypervisors.HV_VALUES,
+        'group': 'cluster',
+        'targets': ('clusters',),
+    },
+    'backup_dc': {
+        'source': 'backup_hosts',
+        'required': ('name', 'datacenter') + total_backups.BACKUP_VALUES,
+        'group': 'datacenter',
+        'targets': ('backup_dc',),
+    },
+    'san': {
+        'source': 'san_pools',
+        'required': ('name', 'host', 'cluster', 'datacenter',
+                     'SANPoolsUsage'),
+        'group': None,
+        'targets': ('san_hosts', 'san_clusters', 'san_dc'),
+    },
+}
+
+# Length of the window averaged by the cluster and DC rollups.
+ROLLUP_WINDOW = 24 * 3600
+
+# Attempts of a _bulk request refused by ES before giving up.
+BULK_ATTEMPTS = 5
+
+
+def source_type(kind):
+    """ Returns the type of the raw documents of a kind of backfill. """
+
+    # The backup rollups have always read the "backuphost" type
+    return CONF['indexes'].get(KINDS[kind]['source'], "backuphost")
+
+
+def scroll_documents(doc_type, start, end):
+    """
+    Yields the _source of the documents of a type posted between "start"
+    and "end" (epoch seconds), in post_date order.
+    """
+
+    search = {
+        'size': PAGE_SIZE,
+        'sort': [{'post_date': {'order': 'asc'}}],
+        '_source': {'excludes': ['vms']},
+        'query': {
+            'bool': {
+                'must': [{'term': filter_value}
+                         for filter_value in type_filter(CONF, doc_type)],
+                'filter': {
+                    'range': {
+                        'post_date': {
+                            'gt': start * 1000,
+                            'lte': end * 1000,
+                            'format': 'epoch_millis'
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+    url = history_url(CONF, doc_type)
+    result = scroll_request(url, search, {'scroll': '5m'})
+    try:
+        while result['hits']['hits']:
+            for hit in result['hits']['hits']:
+                yield hit['_source']
+            result = scroll_request(CONF['url'] + "/_search/scroll",
+                                    {'scroll': '5m',
+                                     'scroll_id': result['_scroll_id']})
+    finally:
+        if '_scroll_id' in result:
+            requests.delete(CONF['url'] + "/_search/scroll",
+                            data=json.dumps({'scroll_id':
+                                             result['_scroll_id']}),
+                            headers={'Content-Type': 'application/json'},
+                            timeout=30)
+
+
+def delete_documents(doc_type, start, end):
+    """
+    Deletes the documents of a type posted between "start" and "end"
+    (epoch seconds). Returns the number of deleted documents.
+    """
+
+    search = {
+        'query': {
+            'bool': {
+                'must': [{'term': filter_value}
+                         for filter_value in type_filter(CONF, doc_type)],
+                'filter': {
+                    'range': {
+                        'post_date': {
+                            'gt': start * 1000,
+                            'lte': end * 1000,
+                            'format': 'epoch_millis'
+                        }
+                    }
+                }
+            }
+        }
+    }
+    url = history_url(CONF, doc_type, "_delete_by_query")
+
+    try:
+        req = requests.post(url, data=json.dumps(search),
+                            params={'conflicts': 'proceed'},
+                            headers={'Content-Type': 'application/json'},
+                            timeout=600)
+    except requests.exceptions.RequestException:
+        message = "Error while deleting the documents of " + doc_type
+        logging.warning(str(message + traceback.format_exc()))
+        sys.exit(message)
+    if req.status_code not in (200, 404):
+        message = "Error while deleting the documents of " + doc_type
+        logging.warning(str(message + " : " + str(req.content)))
+        sys.exit(message)
+
+    return json.loads(req.content).get('deleted', 0)
+
+
+def scroll_request(url, search, params=None):
+    """ Requests one page of a scroll. """
+
+    try:
+        req = requests.post(url, data=json.dumps(search), params=params,
+                            headers={'Content-Type': 'application/json'},
+                            timeout=60)
+    except requests.exceptions.RequestException:
+        message = "Error while requesting " + url
+        logging.warning(str(message + traceback.format_exc()))
+        sys.exit(message)
+    if req.status_code != 200:
+        message = "Error while requesting " + url
+        logging.warning(str(message + " : " + str(req.content)))
+        sys.exit(message)
+
+    return json.loads(req.content)
+
+
+def line_doc_type(conf, url, doc):
+    """
+    Returns the type of a line of a NDJSON file, from the url of a relay
+    line or the _type/_index of a search hit, "" for a latest state and
+    None when the line doesn't tell (a raw document).
+    """
+
+    if url is not None:
+        if is_latest_url(conf, url):
+            return ""
+        return url_doc_type(conf, url)
+    if doc.get('_type') not in (None, "_doc"):
+        return doc['_type']
+    if '_index' in doc:
+        index_url = "/" + doc['_index'] + "/_doc"
+        if is_latest_url(conf, index_url):
+            return ""
+        return url_doc_type(conf, index_url)
+
+    return None
+
+
+def file_documents(path, conf=None, doc_type=None):
+    """
+    Yields the documents of a NDJSON file, one per line : a raw document,
+    a search hit, or a "<url>\\t<document>" line of the collectors relay.
+    With a conf and a type, skips the lines of the other types and the
+    latest states.
+    """
+
+    with open(path) as ndjson:
+        for line in ndjson:
+            line = line.strip()
+            if not line:
+                continue
+            url = None
+            try:
+                if not line.startswith("{"):
+                    url, line = line.split("\t", 1)
+                doc = json.loads(line)
+            except ValueError:
+                logging.warning("Invalid line in " + path + " : " + line)
+                continue
+            if doc_type is not None and \
+                    line_doc_type(conf, url, doc) not in (doc_type, None):
+                continue
+            yield doc.get('_source', doc)
+
+
+def input_documents(kind, paths, start, end):
+    """
+    Yields (epoch, document) for the raw documents of a kind posted
+    between "start" and "end", in post_date order. The NDJSON files must
+    each be in post_date order, as written by the collectors.
+    """
+
+    required = KINDS[kind]['required']
+    if paths:
+        streams = [((to_epoch(doc['post_date']), doc)
+                    for doc in file_documents(path)
+                    if 'post_date' in doc and
+                    all(field in doc for field in required))
+                   for path in paths]
+        documents = heapq.merge(*streams, key=lambda entry: entry[0])
+    else:
+        documents = ((to_epoch(doc['post_date']), doc)
+                     for doc in scroll_documents(source_type(kind),
+                                                 start, end)
+                     if all(field in doc for field in required))
+
+    for epoch, doc in documents:
+        if start < epoch <= end:
+            yield epoch, doc
+
+
+def slices_ends(start, end, step):
+    """ Returns the end of every slice of "step" seconds in the period. """
+
+    first = (start // step + 1) * step
+
+    return range(first, end + 1, step)
+
+
+class Window(object):
+    """
+    Sliding window over the raw documents : the samples of the last
+    "length" seconds, grouped by a field then by host name.
+    """
+
+    def __init__(self, length, group, values):
+        self.length = length
+        self.group = group
+        self.values = values
+        self.samples = collections.deque()
+
+    def add(self, epoch, doc):
+        """ Adds a raw document (documents come in post_date order). """
+
+        self.samples.append((epoch, doc[self.group], doc['name'],
+                             [float(doc[value]) for value in self.values]))
+
+    def samples_until(self, until):
+        """
+        Forgets the samples older than the window ending at "until" and
+        returns the samples of the window, as the rollup scripts get
+        them from ELK : {"group": {"host name": {"post_date": [epoch],
+        "field": [values]}}}.
+        """
+
+        while self.samples and self.samples[0][0] <= until - self.length:
+            self.samples.popleft()
+
+        res = {}
+        for epoch, group, host, values in self.samples:
+            if epoch > until:
+                break
+            if host not in res.setdefault(group, {}):
+                res[group][host] = {'post_date': []}
+                for value in self.values:
+                    res[group][host][value] = []
+            host_samples = res[group][host]
+            host_samples['post_date'].append(epoch)
+            for value, sample in zip(self.values, values):
+                host_samples[value].append(sample)
+
+        return res
+
+
+def percentiles(samples_by_host, fields):
+    """ Returns the percentiles of "fields" over the hosts samples. """
+
+    state = {}
+    sketches_list = []
+    for host, samples in list(samples_by_host.items()):
+        sketches_list.append(update_state(state, host, samples, fields, None,
+                                          SKETCH_ACCURACY))
+
+    res = {}
+    for field in fields:
+        res.update(merged_percentiles(sketches_list, field))
+
+    return res
+
+
+def cluster_docs(samples_by_cluster, now):
+    """ Returns the cluster documents of a slice. """
+
+    res = []
+    for cluster, samples_by_host in sorted(samples_by_cluster.items()):
+        averages_by_host = total_hypervisors.averages_of_samples_by_host(
+            samples_by_host)
+        doc = total_hypervisors.sums_by_cluster(cluster, averages_by_host,
+                                                now)
+        doc.update(percentiles(samples_by_host, HV_SKETCH_FIELDS))
+        res.append(('clusters', doc))
+
+    return res
+
+
+def backup_dc_docs(samples_by_dc, now):
+    """ Returns the backup datacenter documents of a slice. """
+
+    res = []
+    for datacenter, samples_by_host in sorted(samples_by_dc.items()):
+        averages_by_host = total_backups.averages_of_samples_by_host(
+            samples_by_host)
+        doc = total_backups.sums_by_dc(datacenter, averages_by_host, now)
+        doc.update(percentiles(samples_by_host, BACKUP_SKETCH_FIELDS))
+        res.append(('backup_dc', doc))
+
+    return res
+
+
+def san_docs(pools, now):
+    """
+    Returns the SAN host, cluster and datacenter documents of a slice
+    from the last document of each pool in the slice.
+    """
+
+    import capacity_planning_san as san
+
+    pools_by_host = {}
+    for pool_doc in list(pools.values()):
+        pools_by_host.setdefault((pool_doc['datacenter'], pool_doc['cluster'],
+                                  pool_doc['host']), []).append(
+                                      san.SanStats.from_doc(pool_doc))
+
+    hosts_by_cluster = {}
+    for (datacenter, cluster, host), pools_data in \
+            sorted(pools_by_host.items()):
+        hosts_by_cluster.setdefault((datacenter, cluster), []).append(
+            san.host_stats(pools_data, host, cluster, datacenter))
+
+    clusters_by_dc = {}
+    for (datacenter, cluster), hosts_data in sorted(hosts_by_cluster.items()):
+        clusters_by_dc.setdefault(datacenter, []).append(
+            san.cluster_stats(hosts_data, cluster, datacenter))
+
+    res = []
+    for datacenter, clusters_data in sorted(clusters_by_dc.items()):
+        for cluster_data in clusters_data:
+            for host_data in hosts_by_cluster[(datacenter,
+                                               cluster_data.name)]:
+                res.append(('san_hosts', host_data))
+            res.append(('san_clusters', cluster_data))
+        res.append(('san_dc', san.datacenter_stats(clusters_data,
+                                                   datacenter)))
+
+    docs = []
+    for index_name, record in res:
+        doc = record.to_doc()
+        doc['post_date'] = now.isoformat()
+        docs.append((index_name, doc))
+
+    return docs
+
+
+def rollup_docs(kind, documents, ends):
+    """
+    Yields (index name, document) for the rollup documents of every
+    slice, computed from the raw documents (epoch, document).
+    """
+
+    if kind == 'san':
+        # SAN rollups are snapshots : last document of each pool in a slice
+        pools = {}
+        ends = iter(ends)
+        end = next(ends, None)
+        for epoch, doc in documents:
+            while end is not None and epoch > end:
+                for entry in san_docs(pools, datetime.datetime.fromtimestamp(
+                        end)):
+                    yield entry
+                pools = {}
+                end = next(ends, None)
+            if end is None:
+                break
+            pools[(doc['host'], doc['name'])] = doc
+        while end is not None:
+            for entry in san_docs(pools, datetime.datetime.fromtimestamp(end)):
+                yield entry
+            pools = {}
+            end = next(ends, None)
+        return
+
+    if kind == 'clusters':
+        values = total_hypervisors.HV_VALUES
+        slice_docs = cluster_docs
+    else:
+        values = total_backups.BACKUP_VALUES
+        slice_docs = backup_dc_docs
+    window = Window(ROLLUP_WINDOW, KINDS[kind]['group'], values)
+
+    ends = iter(ends)
+    end = next(ends, None)
+    for epoch, doc in documents:
+        while end is not None and epoch > end:
+            for entry in slice_docs(window.samples_until(end),
+                                    datetime.datetime.fromtimestamp(end)):
+                yield entry
+            end = next(ends, None)
+        if end is None:
+            break
+        window.add(epoch, doc)
+    while end is not None:
+        for entry in slice_docs(window.samples_until(end),
+                                datetime.datetime.fromtimestamp(end)):
+            yield entry
+        end = next(ends, None)
+
+
+class BulkWriter(object):
+    """
+    Sends documents to ES with "workers" threads posting _bulk requests
+    of "bulk_size" documents, at most "max_rate" documents per second
+    for all the workers (0 : no limit).
+    """
+
+    def __init__(self, workers, bulk_size, max_rate):
+        self.bulk_size = bulk_size
+        self.max_rate = max_rate
+        self.queue = queue.Queue(maxsize=workers * 2)
+        self.lock = threading.Lock()
+        self.next_slot = monotonic()
+        self.pending = []
+        self.sent = 0
+        self.errors = 0
+        self.threads = [threading.Thread(target=self.work)
+                        for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, url, doc_id, doc):
+        """ Queues a document posted to "url" with the id "doc_id". """
+
+        base_url, action = bulk_action(url)
+        action['index']['_id'] = doc_id
+        self.pending.append((base_url, json.dumps(action) + "\n" +
+                             json.dumps(doc) + "\n"))
+        if len(self.pending) >= self.bulk_size:
+            self.queue.put(self.pending)
+            self.pending = []
+
+    def throttle(self, count):
+        """ Waits for the slot of a request of "count" documents. """
+
+        if self.max_rate <= 0:
+            return
+
+        with self.lock:
+            slot = max(self.next_slot, monotonic())
+            self.next_slot = slot + count / self.max_rate
+        if slot > monotonic():
+            sleep(slot - monotonic())
+
+    def post(self, session, base_url, lines):
+        """
+        Posts a _bulk request, again with a backoff while ES refuses it.
+        Returns the number of documents in error.
+        """
+
+        for attempt in range(BULK_ATTEMPTS):
+            try:
+                req = session.post(base_url + "/_bulk", data="".join(lines),
+                                   timeout=60, headers={
+                                       'Content-Type': 'application/x-ndjson'})
+            except requests.exceptions.RequestException:
+                logging.warning("Error while sending data to elasticsearch "
+                                "at " + base_url + traceback.format_exc())
+            else:
+                if req.status_code == 200:
+                    items = json.loads(req.content).get('items', [])
+                    return len([item for item in items
+                                if 'error' in item.get('index', {})])
+                if req.status_code not in (429, 503):
+                    break
+            sleep(2 ** attempt + random.random())
+
+        logging.warning("Error in bulk response from " + base_url +
+                        ", dropping " + str(len(lines)) + " documents.")
+        return len(lines)
+
+    def work(self):
+        """ Main loop of a worker. """
+
+        session = requests.Session()
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            self.throttle(len(batch))
+            lines_by_url = {}
+            for base_url, lines in batch:
+                lines_by_url.setdefault(base_url, []).append(lines)
+            errors = 0
+            for base_url, lines in list(lines_by_url.items()):
+                errors += self.post(session, base_url, lines)
+            with self.lock:
+                self.sent += len(batch) - errors
+                self.errors += errors
+
+    def close(self):
+        """
+        Sends the last documents and waits for the workers.
+        Returns the number of documents sent and in error.
+        """
+
+        if self.pending:
+            self.queue.put(self.pending)
+            self.pending = []
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+        return self.sent, self.errors
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+    BACKFILL_CONF = CONF.get('backfill', {})
+
+    PARSER = argparse.ArgumentParser(
+        description="Rebuild the rollup documents of a period.")
+    PARSER.add_argument("kind", choices=sorted(KINDS),
+                        help="rollup documents to rebuild")
+    PARSER.add_argument("--start", required=True,
+                        help="start of the period (ISO date)")
+    PARSER.add_argument("--end", required=True,
+                        help="end of the period (ISO date)")
+    PARSER.add_argument("--input", nargs="*",
+                        help="NDJSON files of raw documents (default: ES)")
+    PARSER.add_argument("--step", type=int,
+                        default=int(BACKFILL_CONF.get('step', 3600)),
+                        help="seconds between two rollup documents")
+    PARSER.add_argument("--workers", type=int,
+                        default=int(BACKFILL_CONF.get('workers', 4)),
+                        help="parallel _bulk workers")
+    PARSER.add_argument("--bulk-size", type=int,
+                        default=int(BACKFILL_CONF.get('bulk_size', 500)),
+                        help="documents per _bulk request")
+    PARSER.add_argument("--max-rate", type=float,
+                        default=float(BACKFILL_CONF.get('max_rate', 2000)),
+                        help="documents written per second (0: no limit)")
+    PARSER.add_argument("--replace", action="store_true",
+                        help="delete the documents of the targets posted in "
+                        "the period before writing them")
+    PARSER.add_argument("--dry-run", action="store_true",
+                        help="write the documents on stdout instead of ES")
+    ARGS = PARSER.parse_args()
+
+    PAGE_SIZE = int(BACKFILL_CONF.get('page_size', 5000))
+    SKETCH_ACCURACY = float(CONF.get('sketch_accuracy', 0.01))
+    HV_SKETCH_FIELDS = [value for value in CONF.get('sketch_fields',
+                                                    ["pRAMused"])
+                        if value in total_hypervisors.HV_VALUES]
+    BACKUP_SKETCH_FIELDS = [value for value in CONF.get('sketch_fields',
+                                                        ["volumeFree"])
+                            if value in total_backups.BACKUP_VALUES]
+    # Globals of the cluster rollup
+    total_hypervisors.CONF = CONF
+    total_hypervisors.CPU_OVERCOMMIT = float(CONF['hv_cpu_overcommit'])
+    total_hypervisors.RAM_OVERCOMMIT = float(CONF['hv_ram_overcommit'])
+    total_hypervisors.VMS_TYPE = CONF['vm_type']
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning backfill script."))
+
+    try:
+        START = int(datetime.datetime.fromisoformat(ARGS.start).timestamp())
+        END = int(datetime.datetime.fromisoformat(ARGS.end).timestamp())
+    except ValueError:
+        sys.exit("Invalid --start or --end date.")
+    for TARGET in KINDS[ARGS.kind]['targets']:
+        if TARGET not in CONF['indexes']:
+            sys.exit("Error while parsing conf file : no index " + TARGET)
+
+    if ARGS.replace and not ARGS.dry_run:
+        for TARGET in KINDS[ARGS.kind]['targets']:
+            logging.info(str(delete_documents(CONF['indexes'][TARGET],
+                                              START, END)) +
+                         " " + TARGET + " documents deleted.")
+
+    # The first slices average the samples of the previous day
+    DOCUMENTS = input_documents(ARGS.kind, ARGS.input,
+                                START - ROLLUP_WINDOW, END)
+    DOCS = rollup_docs(ARGS.kind, DOCUMENTS,
+                       slices_ends(START, END, ARGS.step))
+
+    WRITER = None if ARGS.dry_run else BulkWriter(ARGS.workers,
+                                                  ARGS.bulk_size,
+                                                  ARGS.max_rate)
+    COUNT = 0
+    for INDEX_NAME, DOC in DOCS:
+        DOC_TYPE = CONF['indexes'][INDEX_NAME]
+        if WRITER is None:
+            sys.stdout.write(json.dumps(DOC) + "\n")
+        else:
+            DAY = datetime.datetime.utcfromtimestamp(
+                to_epoch(DOC['post_date']))
+            WRITER.add(write_url(CONF, DOC_TYPE, DAY),
+                       DOC_TYPE + "-" + DOC['name'] + "-" + DOC['post_date'],
+                       DOC)
+        COUNT += 1
+
+    if WRITER is not None:
+        SENT, ERRORS = WRITER.close()
+        logging.info(str(SENT) + " documents written, " + str(ERRORS) +
+                     " in error.")
+        if ERRORS:
+            sys.exit(str(ERRORS) + " documents in error, see " + LOGFILE)
+    logging.info(str(COUNT) + " " + ARGS.kind + " documents rebuilt.")
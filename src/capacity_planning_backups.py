@@ -33,14 +33,23 @@ to elastic search.
 """
 
 import os
-from subprocess import Popen, PIPE
+from subprocess import Popen, PIPE, CalledProcessError
 import datetime
 import logging
+import argparse
 import traceback
 from time import gmtime, strftime
 import sys
 import json
-import requests
+import heapq
+from capacity_planning_store import ColumnStore
+from capacity_planning_indices import write_url, latest_url
+from capacity_planning_sinks import add_sink_arguments, open_sink
+
+
+# Columns asked to "zfs list" for the per-dataset breakdown.
+DATASET_COLUMNS = ('name', 'used', 'avail', 'logicalused', 'compressratio',
+                   'usedbysnapshots')
 
 
 def call_cmd(cmd):
@@ -64,19 +73,182 @@ def bytes_to_gib(value):
     return int(float(value) / 1024.0 / 1024.0 / 1024.0)
 
 
-def send_to_elk(url, data_json):
+def stream_cmd(cmd):
+    """
+    Call a command line and yield its output line by line,
+    without keeping the whole output in memory.
+    Raises CalledProcessError once the output is read if the command
+    failed, its output being incomplete.
+    """
+
+    try:
+        child = Popen(list(str(cmd).split(' ')), stdout=PIPE)
+    except OSError:
+        message = str("Error while executing " + cmd + "\n" + traceback.format_exc())
+        logging.warning(message)
+        sys.exit(message)
+
+    for line in child.stdout:
+        yield line.decode()
+    child.stdout.close()
+    if child.wait() != 0:
+        logging.warning("Error while executing " + cmd + " : exit status " +
+                        str(child.returncode))
+        raise CalledProcessError(child.returncode, cmd)
+
+
+def parse_datasets(lines):
+    """
+    Parse the output of "zfs list -Hp -o <DATASET_COLUMNS>".
+    Yields one dict per dataset, sizes in bytes.
+    """
+
+    for line in lines:
+        columns = line.rstrip('\n').split('\t')
+        if len(columns) != len(DATASET_COLUMNS):
+            continue
+        dataset = dict(zip(DATASET_COLUMNS, columns))
+        try:
+            for column in ('used', 'avail', 'logicalused', 'usedbysnapshots'):
+                dataset[column] = int(dataset[column])
+        except ValueError:
+            continue
+        try:
+            dataset['compressratio'] = float(
+                dataset['compressratio'].rstrip('x'))
+        except ValueError:
+            dataset['compressratio'] = 0.0
+        yield dataset
+
+
+def load_datasets_date(path):
+    """ Returns the date (epoch) of the previous run, or None. """
+
+    try:
+        with open(path) as state_file:
+            return float(state_file.readline())
+    except (OSError, IOError, ValueError):
+        return None
+
+
+def datasets_state(path):
     """
-    Send data formated in JSON to the elastic search stack.
+    Yields the usage of each dataset at the previous run
+    (dataset, used bytes), sorted by name as written by send_datasets.
     """
 
     try:
-        requests.post(url, data=data_json, timeout=5)
-    except RequestException:
-        sys.exit("Error while sending data to elasticsearch at " + url)
+        with open(path) as state_file:
+            state_file.readline()
+            for line in state_file:
+                try:
+                    name, used = line.rstrip('\n').rsplit('\t', 1)
+                    yield name, int(used)
+                except ValueError:
+                    continue
+    except (OSError, IOError):
+        return
 
 
-def main():
-    """ Main function. """
+def send_datasets(conf, fqdn, datacenter, now, sink):
+    """
+    Send one document per dataset of the backup pool, streamed from a
+    single recursive "zfs list" sorted by name, to the sink. The growth
+    of each dataset since the previous run is computed by merging this
+    listing with the state file of the previous run, sorted the same
+    way, and the top growing datasets are sent in a summary document.
+    If "zfs list" fails, the state of the previous run is kept.
+    """
+
+    datasets_url = write_url(conf, conf['indexes'].get('backup_datasets',
+                                                       "backupdataset"))
+    top_url = write_url(conf, conf['indexes'].get('backup_datasets_top',
+                                                  "backupdatasettop"))
+    state_path = conf.get('datasets_state',
+                          "/tmp/capacity_planning/datasets.tsv")
+    top_n = int(conf.get('datasets_top_n', 10))
+
+    previous_date = load_datasets_date(state_path)
+    elapsed_hours = None
+    if previous_date:
+        elapsed_hours = (now.timestamp() - previous_date) / 3600.0
+
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    state_file = open(state_path + ".tmp", "w")
+    state_file.write(str(now.timestamp()) + "\n")
+
+    def datasets_docs():
+        """ Yields the dataset documents, saving the new state. """
+
+        previous = datasets_state(state_path)
+        previous_row = next(previous, None)
+        for dataset in parse_datasets(stream_cmd(
+                "/sbin/zfs list -r -Hp -s name -o " +
+                ",".join(DATASET_COLUMNS) + " backup")):
+            while previous_row is not None and \
+                    previous_row[0] < dataset['name']:
+                previous_row = next(previous, None)
+            state_file.write(dataset['name'] + "\t" +
+                             str(dataset['used']) + "\n")
+            doc = {
+                'name': dataset['name'],
+                'host': fqdn,
+                'datacenter': datacenter,
+                'datasetUsed': dataset['used'] / 1024.0 ** 3,
+                'datasetAvail': dataset['avail'] / 1024.0 ** 3,
+                'datasetLogUsed': dataset['logicalused'] / 1024.0 ** 3,
+                'datasetSnapshotUsed':
+                    dataset['usedbysnapshots'] / 1024.0 ** 3,
+                'compressRatio': dataset['compressratio'],
+                'post_date': now.isoformat()
+            }
+            if previous_row is not None and \
+                    previous_row[0] == dataset['name']:
+                doc['datasetGrowth'] = \
+                    (dataset['used'] - previous_row[1]) / 1024.0 ** 3
+                if elapsed_hours:
+                    doc['datasetGrowthPerHour'] = \
+                        doc['datasetGrowth'] / elapsed_hours
+            yield doc
+        previous.close()
+
+    def sent_docs():
+        """ Sends the documents, yields them once sent. """
+
+        for doc in datasets_docs():
+            sink.send(datasets_url, doc)
+            yield doc
+
+    # Only the top_n documents are kept in memory
+    try:
+        top = heapq.nlargest(top_n, (doc for doc in sent_docs()
+                                     if 'datasetGrowth' in doc),
+                             key=lambda doc: doc['datasetGrowth'])
+    except CalledProcessError:
+        # The listing is incomplete : keep the previous state
+        state_file.close()
+        os.remove(state_path + ".tmp")
+        return
+
+    state_file.close()
+    os.rename(state_path + ".tmp", state_path)
+
+    top_data = {
+        'name': fqdn,
+        'datacenter': datacenter,
+        'topGrowth': [{'dataset': doc['name'],
+                       'datasetGrowth': doc['datasetGrowth'],
+                       'datasetUsed': doc['datasetUsed']} for doc in top],
+        'post_date': now.isoformat()
+    }
+    sink.send(top_url, top_data)
+
+
+def main(args=None):
+    """
+    Main function. "args" are the command line options choosing
+    where the documents are sent.
+    """
 
     __location__ = os.path.realpath(os.path.join(os.getcwd(),
                                                  os.path.dirname(__file__)))
@@ -95,9 +267,10 @@ def main():
 
     logfile = conf['logs']
     elk_url = conf['url']
-    main_index = conf['indexes']['main']
     backuphost_url = conf['indexes']['backup_hosts']
     datacenter = conf['datacenter']
+    sample_store = conf.get('sample_store')
+    sink = open_sink(conf, args)
 
     if not logfile or not elk_url or not backuphost_url or not datacenter:
         sys.exit("Error while parsing conf file")
@@ -156,9 +329,23 @@ def main():
         'datacenter': datacenter
     }
 
-    send_to_elk(elk_url + "/" + main_index + "/" + backuphost_url,
-                json.dumps(host_data))
+    sink.send(write_url(conf, backuphost_url), host_data)
+    if conf.get('latest_state', False):
+        sink.send(latest_url(conf, backuphost_url, fqdn), host_data)
+
+    # Keep a local copy of the samples for offline rollups
+    if sample_store:
+        ColumnStore(sample_store).append(backuphost_url, [host_data])
+
+    # Usage of each dataset of the backup pool
+    if conf.get('backup_datasets', False):
+        send_datasets(conf, fqdn, datacenter, now, sink)
+
+    sink.close()
 
 
 if __name__ == "__main__":
-    main()
+    PARSER = argparse.ArgumentParser(
+        description="Send the stats of the backup host.")
+    add_sink_arguments(PARSER)
+    main(PARSER.parse_args())
@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Script that downsamples the raw documents of ELK (hv, vm, backuphost,
+SAN pools) into min/avg/max/last documents at several resolutions,
+each resolution having its own index and retention.
+Run it from cron at least as often as the smallest resolution.
+"""
+
+import sys
+import json
+import logging
+import traceback
+import datetime
+from time import gmtime, strftime, time
+import os
+import requests
+from capacity_planning_indices import search_url, type_filter, partitioned, \
+    keyword_field
+
+
+# Default resolutions : name, bucket size in seconds, retention.
+DEFAULT_TIERS = [
+    {'name': '5m', 'interval': 300, 'retention': '30d'},
+    {'name': '1h', 'interval': 3600, 'retention': '365d'},
+    {'name': '1d', 'interval': 86400, 'retention': '3650d'},
+]
+
+# Numeric fields downsampled for each kind of document,
+# keyed by their name in the "indexes" section of the conf file.
+DEFAULT_FIELDS = {
+    'hv': ["pRAMfree", "pRAMused", "pRAMtotal", "pCPU", "vRAMallocated",
+           "vCPUallocated", "CPUratio", "RAMratio", "vCPUfree", "vRAMfree"],
+    'vm': ["cpu", "maxmem", "vram_used"],
+    'backup_hosts': ["volumeUsed", "volumeFree", "volumeTotal",
+                     "volumeRatio", "compressRatio", "volumeLogUsed",
+                     "volumeLogFree"],
+    'san_pools': ["SANTotalVol", "SANFreeVol", "SANUsedVol", "SANVolRatio",
+                  "SANUsedSnapshot", "SANReservedSnapshot",
+                  "SANTotalDelegatedSpace", "SANUsedDelegatedSpace",
+                  "SANAllocatedVolSpace", "SANFreeThinProv"],
+    'san_volumes': ["volumeSize", "volumeUsed", "volumeSnapReserve",
+                    "volumeRatio"],
+}
+
+# Fields copied from the last sample of a bucket.
+LABELS = ('host', 'cluster', 'datacenter')
+
+# Kinds of documents named after their SAN group : the same name can be
+# found on several groups, so their buckets are grouped by host and name.
+HOST_KINDS = ('san_pools', 'san_volumes')
+
+
+def request(url, json_value):
+    """ Request values from ES. """
+
+    req = requests.get(url, data=json_value, timeout=30,
+                       headers={'Content-Type': 'application/json'})
+    if req.status_code != 200:
+        message = "Error while requesting " + url
+        logging.warning(str(message + " : " + str(req.content)))
+        sys.exit(message)
+
+    return json.loads(req.content)
+
+
+def send_bulk(actions):
+    """
+    Sends a list of (action, document) to the _bulk API of ES.
+    """
+
+    if not actions:
+        return
+
+    body = ""
+    for action, doc in actions:
+        body += json.dumps(action) + "\n" + json.dumps(doc) + "\n"
+
+    try:
+        req = requests.post(ELK_URL + "/_bulk", data=body, timeout=30,
+                            headers={'Content-Type': 'application/x-ndjson'})
+    except requests.exceptions.RequestException:
+        message = "Error while sending data to elasticsearch at " + ELK_URL
+        logging.warning(str(message + traceback.format_exc()))
+        sys.exit(message)
+
+    if req.status_code != 200 or json.loads(req.content).get('errors'):
+        message = "Error in bulk response from elasticsearch"
+        logging.warning(str(message + " : " + str(req.content)[:1000]))
+        sys.exit(message)
+
+
+def downsample_search(doc_type, fields, interval, start, end,
+                      by_host=False):
+    """
+    Builds the aggregation returning, for each name (each host and name
+    if "by_host" is True) and each bucket of "interval" seconds between
+    "start" and "end" (epoch seconds), the min/avg/max of the fields and
+    the last sample.
+    """
+
+    field_aggs = {}
+    for field in fields:
+        field_aggs[field] = {'stats': {'field': field}}
+    field_aggs['last'] = {
+        'top_hits': {'size': 1, 'sort': [{'post_date': {'order': 'desc'}}],
+                     '_source': {'excludes': ['vms']}}
+    }
+
+    aggs = {
+        'names': {
+            'terms': {'field': keyword_field(CONF, 'name'),
+                      'size': TERMS_SIZE},
+            'aggs': {
+                'buckets': {
+                    'date_histogram': {
+                        'field': 'post_date',
+                        'interval': str(interval) + 's',
+                        'min_doc_count': 1
+                    },
+                    'aggs': field_aggs
+                }
+            }
+        }
+    }
+    if by_host:
+        aggs = {
+            'hosts': {
+                'terms': {'field': keyword_field(CONF, 'host'),
+                          'size': TERMS_SIZE},
+                'aggs': aggs
+            }
+        }
+
+    return {
+        'size': 0,
+        'query': {
+            'bool': {
+                'must': [{'term': filter_value}
+                         for filter_value in type_filter(CONF, doc_type)],
+                'filter': {
+                    'range': {
+                        'post_date': {
+                            'gte': start * 1000,
+                            'lt': end * 1000,
+                            'format': 'epoch_millis'
+                        }
+                    }
+                }
+            }
+        },
+        'aggs': aggs
+    }
+
+
+def downsampled_docs(result, fields, tier):
+    """
+    Turns the answer of downsample_search into downsampled documents.
+    """
+
+    res = []
+
+    aggregations = result['aggregations']
+    if 'hosts' in aggregations:
+        name_buckets = [(host_bucket['key'], name_bucket)
+                        for host_bucket in aggregations['hosts']['buckets']
+                        for name_bucket in host_bucket['names']['buckets']]
+    else:
+        name_buckets = [(None, name_bucket) for name_bucket
+                        in aggregations['names']['buckets']]
+
+    for host, name_bucket in name_buckets:
+        for bucket in name_bucket['buckets']['buckets']:
+            last = bucket['last']['hits']['hits'][0]['_source']
+            doc = {}
+            doc['name'] = name_bucket['key']
+            doc['post_date'] = datetime.datetime.utcfromtimestamp(
+                bucket['key'] / 1000).isoformat()
+            doc['resolution'] = tier['name']
+            doc['samples'] = bucket['doc_count']
+            for label in LABELS:
+                if label in last:
+                    doc[label] = last[label]
+            if host is not None:
+                doc['host'] = host
+            for field in fields:
+                if bucket[field]['count'] <= 0:
+                    continue
+                doc[field + '_min'] = bucket[field]['min']
+                doc[field + '_avg'] = bucket[field]['avg']
+                doc[field + '_max'] = bucket[field]['max']
+                if field in last:
+                    doc[field + '_last'] = last[field]
+            res.append(doc)
+
+    return res
+
+
+def nested_vm_search(fields, interval, start, end):
+    """
+    Builds the aggregation of downsample_search for the VMs nested in
+    the hv documents ("nested" vm_schema) : for each hypervisor and each
+    bucket, the last hv document and the min/avg/max of the fields of
+    each VM.
+    """
+
+    search = downsample_search(HV_TYPE, [], interval, start, end)
+    buckets_aggs = search['aggs']['names']['aggs']['buckets']['aggs']
+    # The last VMs of each bucket are in the last hv document
+    del buckets_aggs['last']['top_hits']['_source']
+    vm_aggs = {}
+    for field in fields:
+        vm_aggs[field] = {'stats': {'field': 'vms.' + field}}
+    buckets_aggs['vms'] = {
+        'nested': {'path': 'vms'},
+        'aggs': {
+            'names': {
+                'terms': {'field': 'vms.name', 'size': TERMS_SIZE},
+                'aggs': vm_aggs
+            }
+        }
+    }
+
+    return search
+
+
+def nested_vm_docs(result, fields, tier):
+    """
+    Turns the answer of nested_vm_search into downsampled vm documents,
+    as downsampled_docs does for the vm documents.
+    """
+
+    res = []
+
+    for host_bucket in result['aggregations']['names']['buckets']:
+        for bucket in host_bucket['buckets']['buckets']:
+            last = bucket['last']['hits']['hits'][0]['_source']
+            last_vms = dict((vm_data['name'], vm_data)
+                            for vm_data in last.get('vms', []))
+            for vm_bucket in bucket['vms']['names']['buckets']:
+                doc = {}
+                doc['name'] = vm_bucket['key']
+                doc['host'] = host_bucket['key']
+                doc['post_date'] = datetime.datetime.utcfromtimestamp(
+                    bucket['key'] / 1000).isoformat()
+                doc['resolution'] = tier['name']
+                doc['samples'] = vm_bucket['doc_count']
+                if 'cluster' in last:
+                    doc['cluster'] = last['cluster']
+                last_vm = last_vms.get(vm_bucket['key'], {})
+                for field in fields:
+                    if vm_bucket[field]['count'] <= 0:
+                        continue
+                    doc[field + '_min'] = vm_bucket[field]['min']
+                    doc[field + '_avg'] = vm_bucket[field]['avg']
+                    doc[field + '_max'] = vm_bucket[field]['max']
+                    if field in last_vm:
+                        doc[field + '_last'] = last_vm[field]
+                res.append(doc)
+
+    return res
+
+
+def downsample(doc_type, fields, tier, now):
+    """
+    Downsamples the last complete buckets of a document type into the
+    index of a tier. Documents have a deterministic id so buckets
+    computed again by the next run are overwritten.
+    """
+
+    interval = int(tier['interval'])
+    end = int(now) // interval * interval
+    start = end - interval * LOOKBACK
+
+    hours = (int(now) - start) // 3600 + 1
+    if doc_type == VM_TYPE and VM_SCHEMA == "nested" and \
+            not partitioned(CONF):
+        # "vms" is only mapped as nested on the partitioned indices
+        logging.warning("The nested VMs can't be downsampled without "
+                        "the partitioned indices, skipped.")
+        return 0
+    if doc_type == VM_TYPE and VM_SCHEMA == "nested":
+        result = request(search_url(CONF, HV_TYPE, hours),
+                         json.dumps(nested_vm_search(fields, interval,
+                                                     start, end)))
+        docs = nested_vm_docs(result, fields, tier)
+    else:
+        result = request(search_url(CONF, doc_type, hours),
+                         json.dumps(downsample_search(
+                             doc_type, fields, interval, start, end,
+                             doc_type in HOST_TYPES)))
+        docs = downsampled_docs(result, fields, tier)
+    index = tier_index(tier, doc_type)
+    actions = []
+
+    for doc in docs:
+        doc_id = doc_type + "-" + doc['name'] + "-" + doc['post_date']
+        if doc_type in HOST_TYPES:
+            doc_id = doc_type + "-" + doc['host'] + "-" + doc['name'] + \
+                "-" + doc['post_date']
+        action = {'_index': index, '_id': doc_id}
+        if not partitioned(CONF):
+            action['_type'] = doc_type
+        actions.append(({'index': action}, doc))
+
+    for start_chunk in range(0, len(actions), BULK_SIZE):
+        send_bulk(actions[start_chunk:start_chunk + BULK_SIZE])
+
+    return len(actions)
+
+
+def tier_index(tier, doc_type=None):
+    """
+    Returns the index of a tier for a type, or the pattern of its
+    indices (no type). Indices created by ES 6 hold a single type, so
+    the legacy layout has one index per type and tier.
+    """
+
+    index = tier.get('index', MAIN_INDEX + "-" + tier['name'])
+    if partitioned(CONF):
+        return index
+    if doc_type is None:
+        return index + "-*"
+
+    return index + "-" + doc_type
+
+
+def apply_retention(tier):
+    """ Deletes the documents of a tier older than its retention. """
+
+    url = ELK_URL + "/" + tier_index(tier) + "/" + "_delete_by_query"
+    search = {
+        'query': {
+            'range': {'post_date': {'lt': 'now-' + tier['retention']}}
+        }
+    }
+
+    try:
+        req = requests.post(url, data=json.dumps(search), timeout=30,
+                            params={'conflicts': 'proceed'},
+                            headers={'Content-Type': 'application/json'})
+    except requests.exceptions.RequestException:
+        message = "Error while applying retention on " + tier_index(tier)
+        logging.warning(str(message + traceback.format_exc()))
+        return
+
+    if req.status_code not in (200, 404):
+        logging.warning("Error while applying retention on " +
+                        tier_index(tier) + " : " + str(req.content))
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+
+    LOGFILE = CONF['logs']
+    ELK_URL = CONF['url']
+    MAIN_INDEX = CONF['indexes']['main']
+    HV_TYPE = CONF['indexes'].get('hv')
+    VM_TYPE = CONF['indexes'].get('vm')
+    VM_SCHEMA = CONF.get('vm_schema', "documents")
+    HOST_TYPES = set(CONF['indexes'][name] for name in HOST_KINDS
+                     if name in CONF['indexes'])
+    DOWNSAMPLE_CONF = CONF.get('downsample', {})
+    TIERS = DOWNSAMPLE_CONF.get('tiers', DEFAULT_TIERS)
+    FIELDS = DOWNSAMPLE_CONF.get('fields', DEFAULT_FIELDS)
+    LOOKBACK = int(DOWNSAMPLE_CONF.get('lookback', 2))
+    TERMS_SIZE = int(DOWNSAMPLE_CONF.get('terms_size', 10000))
+    BULK_SIZE = int(DOWNSAMPLE_CONF.get('bulk_size', 1000))
+    # End parse conf file
+
+    LOGFILE = LOGFILE + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning downsampling script."))
+
+    NOW = time()
+
+    for TIER in TIERS:
+        for INDEX_NAME, INDEX_FIELDS in list(FIELDS.items()):
+            if INDEX_NAME not in CONF['indexes']:
+                continue
+            COUNT = downsample(CONF['indexes'][INDEX_NAME], INDEX_FIELDS,
+                               TIER, NOW)
+            logging.info(str(COUNT) + " " + INDEX_NAME + " documents at " +
+                         TIER['name'] + " resolution.")
+        apply_retention(TIER)
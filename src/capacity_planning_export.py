@@ -0,0 +1,395 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+"""
+Script that exports capacity planning documents of a period to CSV or
+Parquet, for the capacity reviews.
+
+The documents are streamed in post_date order from ES (search_after
+paging), from NDJSON files or from the local sample store, and written
+as they come : memory doesn't grow with the period. With --rollup, the
+cluster, backup DC and SAN host/cluster/DC documents are computed from
+the raw documents, with the rollups of the collection scripts (see
+capacity_planning_backfill.py), instead of read as they were stored.
+
+    capacity_planning_export.py clusters --start 2019-01-01 \\
+        --end 2019-04-01 --rollup --step 86400 --output clusters.csv
+"""
+
+import sys
+import csv
+import json
+import heapq
+import logging
+import argparse
+import datetime
+import itertools
+import traceback
+from time import gmtime, strftime, time
+import os
+import requests
+from capacity_planning_store import ColumnStore, to_epoch
+from capacity_planning_indices import history_url, type_filter, \
+    keyword_field
+import capacity_planning_backfill as backfill
+import capacity_planning_total_hypervisors as total_hypervisors
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# Columns written first, the others follow in alphabetical order.
+LEADING_COLUMNS = ('post_date', 'name', 'host', 'cluster', 'datacenter')
+
+# Documents read before writing, to find the columns of the export.
+PEEK_SIZE = 1000
+
+
+def search_after_documents(doc_type, start, end):
+    """
+    Yields the _source of the documents of a type posted between "start"
+    and "end" (epoch seconds), in post_date order, paging with
+    search_after : no search context is kept open in ES between pages.
+    """
+
+    search = {
+        'size': PAGE_SIZE,
+        'sort': [{'post_date': 'asc'}, {keyword_field(CONF, 'name'): 'asc'},
+                 {keyword_field(CONF, 'host'): {
+                     'order': 'asc', 'missing': '_first',
+                     'unmapped_type': 'keyword'}}],
+        '_source': {'excludes': ['vms']},
+        'query': {
+            'bool': {
+                'must': [{'term': filter_value}
+                         for filter_value in type_filter(CONF, doc_type)],
+                'filter': {
+                    'range': {
+                        'post_date': {
+                            'gt': start * 1000,
+                            'lte': end * 1000,
+                            'format': 'epoch_millis'
+                        }
+                    }
+                }
+            }
+        }
+    }
+    url = history_url(CONF, doc_type)
+
+    while True:
+        try:
+            req = requests.post(url, data=json.dumps(search), timeout=60,
+                                headers={'Content-Type': 'application/json'})
+        except requests.exceptions.RequestException:
+            message = "Error while requesting " + url
+            logging.warning(str(message + traceback.format_exc()))
+            sys.exit(message)
+        if req.status_code != 200:
+            message = "Error while requesting " + url
+            logging.warning(str(message + " : " + str(req.content)))
+            sys.exit(message)
+
+        hits = json.loads(req.content)['hits']['hits']
+        for hit in hits:
+            yield hit['_source']
+        if len(hits) < PAGE_SIZE:
+            return
+        search['search_after'] = hits[-1]['sort']
+
+
+def raw_documents(doc_type, start, end):
+    """
+    Yields (epoch, document) for the documents of a type posted between
+    "start" and "end", from the --input files, the --store sample store
+    or ES.
+    """
+
+    if ARGS.input:
+        streams = [((to_epoch(doc['post_date']), doc)
+                    for doc in backfill.file_documents(path, CONF, doc_type)
+                    if 'post_date' in doc)
+                   for path in ARGS.input]
+        documents = heapq.merge(*streams, key=lambda entry: entry[0])
+    elif ARGS.store:
+        documents = ((to_epoch(doc['post_date']), doc)
+                     for doc in ColumnStore(ARGS.store).stream(
+                         doc_type, start=start, end=end))
+    else:
+        documents = ((to_epoch(doc['post_date']), doc)
+                     for doc in search_after_documents(doc_type, start, end))
+
+    for epoch, doc in documents:
+        if start < epoch <= end:
+            yield epoch, doc
+
+
+def rollup_documents(target, start, end, step):
+    """
+    Yields the rollup documents of a target (clusters, backup_dc,
+    san_hosts...) every "step" seconds between "start" and "end",
+    computed from the raw documents as the collection scripts do.
+    """
+
+    kinds = [kind for kind in backfill.KINDS
+             if target in backfill.KINDS[kind]['targets']]
+    if not kinds:
+        sys.exit("No rollup computes " + target)
+    kind = kinds[0]
+    required = backfill.KINDS[kind]['required']
+
+    # The first slices average the samples of the previous day
+    documents = ((epoch, doc) for epoch, doc in raw_documents(
+        backfill.source_type(kind), start - backfill.ROLLUP_WINDOW, end)
+                 if all(field in doc for field in required))
+    for index_name, doc in backfill.rollup_docs(
+            kind, documents, backfill.slices_ends(start, end, step)):
+        if index_name == target:
+            yield doc
+
+
+def scalar(value):
+    """ Is a value written in a column ? (nested arrays aren't) """
+
+    return isinstance(value, (str, int, float, bool)) or value is None
+
+
+def columns_of(docs, fields=None):
+    """ Returns the columns of the export from the first documents. """
+
+    if fields:
+        return list(fields)
+
+    names = set()
+    for doc in docs:
+        names.update(key for key, value in list(doc.items()) if scalar(value))
+
+    return [name for name in LEADING_COLUMNS if name in names] + \
+        sorted(names - set(LEADING_COLUMNS))
+
+
+class CsvWriter(object):
+    """ Writes the documents as CSV rows. """
+
+    def __init__(self, output, columns):
+        self.output = output
+        self.writer = csv.DictWriter(output, columns, extrasaction='ignore')
+        self.writer.writeheader()
+
+    def write(self, doc):
+        """ Writes a document. """
+
+        self.writer.writerow(doc)
+
+    def close(self):
+        """ Flushes the output. """
+
+        self.output.flush()
+
+
+class ParquetWriter(object):
+    """
+    Writes the documents in a Parquet file, one row group every
+    "batch_rows" documents. Columns holding numbers in the first
+    documents are doubles, the others strings.
+    """
+
+    def __init__(self, path, columns, docs, batch_rows):
+        if pyarrow is None:
+            sys.exit("pyarrow is needed to write Parquet files.")
+
+        numeric = set(column for column in columns
+                      if all(doc.get(column) is None or
+                             isinstance(doc[column], (int, float))
+                             for doc in docs))
+        self.columns = columns
+        self.numeric = numeric
+        self.schema = pyarrow.schema([
+            (column, pyarrow.float64() if column in numeric
+             else pyarrow.string()) for column in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema)
+        self.batch_rows = batch_rows
+        self.batch = dict((column, []) for column in columns)
+        self.rows = 0
+
+    def write(self, doc):
+        """ Adds a document to the current row group. """
+
+        for column in self.columns:
+            value = doc.get(column)
+            if value is not None:
+                try:
+                    value = float(value) if column in self.numeric \
+                        else str(value)
+                except ValueError:
+                    value = None
+            self.batch[column].append(value)
+        self.rows += 1
+        if self.rows >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        """ Writes the current row group. """
+
+        if self.rows:
+            self.writer.write_table(pyarrow.Table.from_pydict(
+                self.batch, schema=self.schema))
+            for values in list(self.batch.values()):
+                del values[:]
+            self.rows = 0
+
+    def close(self):
+        """ Writes the last row group and the footer. """
+
+        self.flush()
+        self.writer.close()
+
+
+def export(docs, output, output_format, fields=None, batch_rows=50000):
+    """
+    Writes the documents (an iterator) to "output" (a path, "-" for the
+    standard output). Returns the number of documents written.
+    """
+
+    docs = iter(docs)
+    first_docs = list(itertools.islice(docs, PEEK_SIZE))
+    columns = columns_of(first_docs, fields)
+
+    if output_format == "parquet":
+        if output == "-":
+            sys.exit("Parquet files can't be written on stdout.")
+        writer = ParquetWriter(output, columns, first_docs, batch_rows)
+    elif output == "-":
+        writer = CsvWriter(sys.stdout, columns)
+    else:
+        writer = CsvWriter(open(output, "w", newline=""), columns)
+
+    count = 0
+    for doc in itertools.chain(first_docs, docs):
+        writer.write(doc)
+        count += 1
+    writer.close()
+
+    return count
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+    EXPORT_CONF = CONF.get('export', {})
+
+    PARSER = argparse.ArgumentParser(
+        description="Export the documents of a period to CSV or Parquet.")
+    PARSER.add_argument("documents", choices=sorted(
+        name for name in CONF['indexes'] if name != 'main'),
+                        help="documents exported (key of \"indexes\")")
+    PARSER.add_argument("--start", required=True,
+                        help="start of the period (ISO date)")
+    PARSER.add_argument("--end", help="end of the period (ISO date, "
+                        "default: now)")
+    PARSER.add_argument("--rollup", action="store_true",
+                        help="compute the cluster/DC documents from the "
+                        "raw documents")
+    PARSER.add_argument("--step", type=int,
+                        default=int(EXPORT_CONF.get('step', 3600)),
+                        help="seconds between two rollup documents")
+    PARSER.add_argument("--input", nargs="*",
+                        help="NDJSON files of raw documents (default: ES)")
+    PARSER.add_argument("--store", help="read the raw documents from this "
+                        "sample store (default: ES)")
+    PARSER.add_argument("--fields", nargs="*",
+                        help="columns of the export (default: the fields "
+                        "of the first documents)")
+    PARSER.add_argument("--format", choices=("csv", "parquet"),
+                        default="csv")
+    PARSER.add_argument("--output", default="-",
+                        help="output file (default: stdout)")
+    ARGS = PARSER.parse_args()
+
+    PAGE_SIZE = int(EXPORT_CONF.get('page_size', 5000))
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning export script."))
+
+    try:
+        START = int(datetime.datetime.fromisoformat(ARGS.start).timestamp())
+        END = int(datetime.datetime.fromisoformat(ARGS.end).timestamp()) \
+            if ARGS.end else int(time())
+    except ValueError:
+        sys.exit("Invalid --start or --end date.")
+
+    if ARGS.rollup:
+        # Globals of the rollups, as set by the backfill script
+        backfill.CONF = CONF
+        backfill.SKETCH_ACCURACY = float(CONF.get('sketch_accuracy', 0.01))
+        backfill.HV_SKETCH_FIELDS = [
+            value for value in CONF.get('sketch_fields', ["pRAMused"])
+            if value in total_hypervisors.HV_VALUES]
+        backfill.BACKUP_SKETCH_FIELDS = [
+            value for value in CONF.get('sketch_fields', ["volumeFree"])
+            if value in backfill.total_backups.BACKUP_VALUES]
+        total_hypervisors.CONF = CONF
+        total_hypervisors.CPU_OVERCOMMIT = float(CONF['hv_cpu_overcommit'])
+        total_hypervisors.RAM_OVERCOMMIT = float(CONF['hv_ram_overcommit'])
+        total_hypervisors.VMS_TYPE = CONF['vm_type']
+        DOCS = rollup_documents(ARGS.documents, START, END, ARGS.step)
+    else:
+        DOCS = (doc for epoch, doc in raw_documents(
+            CONF['indexes'][ARGS.documents], START, END))
+
+    COUNT = export(DOCS, ARGS.output, ARGS.format, ARGS.fields,
+                   int(EXPORT_CONF.get('batch_rows', 50000)))
+    logging.info(str(COUNT) + " " + ARGS.documents + " documents exported.")
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+"""
+Prometheus exporter of the last samples of the collectors of a node.
+
+The collectors run with the "exporter" sink write their documents on a
+Unix socket, with the protocol of the relay ("<url>\\t<json>\\n"). The
+exporter keeps the last document of each entity of the exported types
+and serves their numeric fields in the text exposition format on
+http://<listen>:<port>/metrics, one gauge per type and field :
+
+    capacity_hv_pRAMfree{name="hv1.example.com",cluster="ven-mut"} 12.0
+
+The page is rendered once after new samples arrive and kept in a
+buffer, so scrapes only copy it. Entities without a sample for
+"max_age" seconds are dropped.
+
+    "exporter": {"socket": "/tmp/capacity_planning/exporter.sock",
+                 "listen": "0.0.0.0", "port": 9472, "max_age": 1800,
+                 "types": ["hv", "vm", "backup_hosts", "san_pools"]}
+"""
+
+import os
+import re
+import sys
+import json
+import logging
+import threading
+import traceback
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import gmtime, strftime, time
+from capacity_planning_indices import url_doc_type, is_latest_url
+from capacity_planning_sinks import DEFAULT_EXPORTER_SOCKET
+
+
+# Fields describing the entity of a document, exported as labels.
+LABELS = ('name', 'host', 'cluster', 'datacenter')
+
+DEFAULT_TYPES = ("hv", "vm", "backup_hosts", "san_pools")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metric_name(doc_type, field):
+    """ Returns the name of the gauge of a field of a type. """
+
+    return re.sub(r"[^a-zA-Z0-9_]", "_", "capacity_" + doc_type + "_" + field)
+
+
+def label_value(value):
+    """ Escapes a label value. """
+
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+        .replace("\n", "\\n")
+
+
+class SampleCache(object):
+    """
+    Last document of each entity (type, name, host) and the exposition
+    page rendered from them, rendered again only once they changed.
+    """
+
+    def __init__(self, doc_types, max_age):
+        self.doc_types = doc_types
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        # {(type, name, host): (time, labels, {"field": value})}
+        self.samples = {}
+        self.page = b""
+        self.changed = True
+        self.expires = 0.0
+
+    def update(self, doc_type, doc):
+        """ Keeps a document if its type is exported. """
+
+        if doc_type not in self.doc_types or 'name' not in doc:
+            return
+
+        labels = ",".join(label + "=\"" + label_value(doc[label]) + "\""
+                          for label in LABELS if label in doc)
+        values = dict((field, float(value))
+                      for field, value in list(doc.items())
+                      if isinstance(value, (int, float)) and
+                      not isinstance(value, bool))
+        with self.lock:
+            self.samples[(doc_type, doc['name'], doc.get('host'))] = \
+                (time(), labels, values)
+            self.changed = True
+
+    def render(self):
+        """ Returns the exposition page, rendered again if needed. """
+
+        with self.lock:
+            now = time()
+            if not self.changed and now < self.expires:
+                return self.page
+
+            for key in [key for key, sample in list(self.samples.items())
+                        if sample[0] < now - self.max_age]:
+                del self.samples[key]
+
+            families = {}
+            for (doc_type, name, host), (received, labels, values) in \
+                    sorted(self.samples.items(), key=lambda item: item[0][:2]):
+                for field, value in list(values.items()):
+                    families.setdefault((doc_type, field), []).append(
+                        "%s{%s} %r" % (metric_name(doc_type, field), labels,
+                                       value))
+
+            lines = []
+            for (doc_type, field), samples in sorted(families.items()):
+                lines.append("# HELP " + metric_name(doc_type, field) + " " +
+                             field + " of the last " + doc_type +
+                             " documents.")
+                lines.append("# TYPE " + metric_name(doc_type, field) +
+                             " gauge")
+                lines.extend(samples)
+            lines.append("# TYPE capacity_exporter_entities gauge")
+            lines.append("capacity_exporter_entities " +
+                         str(len(self.samples)))
+
+            self.page = ("\n".join(lines) + "\n").encode()
+            self.changed = False
+            self.expires = min([sample[0] for sample
+                                in list(self.samples.values())] or [now]) + \
+                self.max_age
+
+            return self.page
+
+
+class CollectorHandler(socketserver.StreamRequestHandler):
+    """ Reads the documents of a collector. """
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                url, data = line.decode().rstrip("\n").split("\t", 1)
+                # The latest states repeat the last documents
+                if is_latest_url(CONF, url):
+                    continue
+                self.server.cache.update(url_doc_type(CONF, url),
+                                         json.loads(data))
+            except ValueError:
+                logging.warning("Bad document from a collector : " +
+                                str(line[:200]))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the exposition page. """
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        page = self.server.cache.render()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        self.wfile.write(page)
+
+    def log_message(self, format, *args):
+        logging.debug(self.address_string() + " " + format % args)
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning exporter."))
+
+    EXPORTER_CONF = CONF.get('exporter', {})
+    EXPORTER_SOCKET = EXPORTER_CONF.get('socket', DEFAULT_EXPORTER_SOCKET)
+    CACHE = SampleCache(set(CONF['indexes'][name] for name
+                            in EXPORTER_CONF.get('types', DEFAULT_TYPES)
+                            if name in CONF['indexes']),
+                        float(EXPORTER_CONF.get('max_age', 1800)))
+
+    if os.path.exists(EXPORTER_SOCKET):
+        os.unlink(EXPORTER_SOCKET)
+    os.makedirs(os.path.dirname(EXPORTER_SOCKET), exist_ok=True)
+    COLLECTORS = socketserver.ThreadingUnixStreamServer(EXPORTER_SOCKET,
+                                                        CollectorHandler)
+    COLLECTORS.daemon_threads = True
+    COLLECTORS.cache = CACHE
+    threading.Thread(target=COLLECTORS.serve_forever, daemon=True).start()
+
+    SERVER = ThreadingHTTPServer((EXPORTER_CONF.get('listen', "0.0.0.0"),
+                                  int(EXPORTER_CONF.get('port', 9472))),
+                                 MetricsHandler)
+    SERVER.daemon_threads = True
+    SERVER.cache = CACHE
+    SERVER.serve_forever()
@@ -37,10 +37,17 @@ import os
 import json
 import datetime
 import logging
+import argparse
 import traceback
 from time import gmtime, strftime
 import sys
-import requests
+from capacity_planning_store import ColumnStore
+from capacity_planning_indices import write_url, latest_url
+from capacity_planning_sinks import add_sink_arguments, open_sink
+
+
+# Fields of each VM kept in the hv document with the "nested" vm_schema.
+VM_FIELDS = ('name', 'cpu', 'maxmem', 'vram_used')
 
 
 def call_cmd(cmd):
@@ -65,21 +72,12 @@ def kib_to_gib(value):
     return int(float(float(value) / 1024.0) / 1024.0)
 
 
-def send_to_elk(url, data_json):
+def main(args=None):
     """
-    Send data formated in JSON to the elastic search stack.
+    Main function. "args" are the command line options choosing
+    where the documents are sent.
     """
 
-    try:
-        requests.post(url, data=data_json, timeout=5)
-    except RequestException:
-        message = "Error while sending data to elasticsearch at " + url
-        sys.exit(message)
-
-
-def main():
-    """ Main function. """
-
     __location__ = os.path.realpath(
         os.path.join(os.getcwd(), os.path.dirname(__file__)))
 
@@ -97,13 +95,16 @@ def main():
     path_stats = "/tmp/capacity_planning"
     path_script = os.path.join(conf['working_dir'], "stats.sh")
     logfile = conf['logs']
-    elk_url = conf['url']
-    main_index = conf['indexes']['main']
     vm_index = conf['indexes']['vm']
     hv_index = conf['indexes']['hv']
     cluster = conf['cluster']
+    # "documents": one vm document per VM, "nested": VMs in the hv document
+    vm_schema = conf.get('vm_schema', "documents")
+    latest_state = conf.get('latest_state', False)
     cpu_overcommit = int(conf['hv_cpu_overcommit'])
     ram_overcommit = int(conf['hv_ram_overcommit'])
+    sample_store = conf.get('sample_store')
+    sink = open_sink(conf, args)
     # End parse conf file
 
     now = datetime.datetime.now()
@@ -160,6 +161,7 @@ def main():
     vm_stat_files = [f for f in os.listdir(path_stats_files)
                      if os.path.isfile(os.path.join(path_stats_files, f))]
 
+    vm_docs = []
     for stat_file in vm_stat_files:
         data = {}
         data['host'] = fqdn
@@ -202,9 +204,12 @@ def main():
             print(message)
             continue
 
-        data_json = json.dumps(data)
         vm_name = vm_name.split('.')[0]
-        send_to_elk(elk_url + "/" + main_index + "/" + vm_index, data_json)
+        if vm_schema != "nested":
+            sink.send(write_url(conf, vm_index), data)
+            if latest_state:
+                sink.send(latest_url(conf, vm_index, data['name']), data)
+        vm_docs.append(data)
 
     host_data['vRAMallocated'] = kib_to_gib(host_vram_alloc)
     host_data['vCPUallocated'] = host_cpu_allocated
@@ -225,10 +230,26 @@ def main():
                                        float(host_vram_alloc)
                                        )
 
-    host_data_json = json.dumps(host_data)
-    send_to_elk(elk_url + "/" + main_index + "/" + hv_index, host_data_json)
+    if vm_schema == "nested":
+        host_data['vmCount'] = len(vm_docs)
+        host_data['vms'] = [dict((key, vm_data[key]) for key in VM_FIELDS
+                                 if key in vm_data) for vm_data in vm_docs]
+
+    sink.send(write_url(conf, hv_index), host_data)
+    if latest_state:
+        sink.send(latest_url(conf, hv_index, fqdn), host_data)
+    sink.close()
+
+    # Keep a local copy of the samples for offline rollups
+    if sample_store:
+        store = ColumnStore(sample_store)
+        store.append(vm_index, vm_docs)
+        store.append(hv_index, [host_data])
 
 
 
 if __name__ == "__main__":
-    main()
+    PARSER = argparse.ArgumentParser(
+        description="Send the stats of the hypervisor and its VMs.")
+    add_sink_arguments(PARSER)
+    main(PARSER.parse_args())
@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Index layout of the capacity planning documents.
+
+With "index_layout": "legacy" (default) every document goes to
+url/<main index>/<type> and searches filter on _type.
+With "index_layout": "partitioned" each type has daily indices
+<prefix>-<type>-YYYY.MM.DD created from an index template, read through
+the alias <prefix>-<type>, and searches on the last hours only touch the
+last partitions.
+
+With "latest_state": true the collectors also index the last document
+of each entity (hypervisor, VM, backup host, SAN pool) with a
+deterministic id in a small latest-state index per type
+(<main index>-latest-<type> or <prefix>-latest-<type>), so the current state of an entity or the list
+of entities is one small document each.
+
+Run as a script, installs the templates, drops the partitions older
+than the retention and the latest-state documents older than
+"latest_ttl" seconds.
+"""
+
+import sys
+import json
+import logging
+import traceback
+import datetime
+from time import gmtime, strftime
+from urllib.parse import urlsplit, quote
+import os
+import requests
+
+
+DEFAULT_PREFIX = "capacity"
+DEFAULT_RETENTION_DAYS = 400
+DEFAULT_LATEST_TTL = 6 * 3600
+
+
+def partitioned(conf):
+    """ Are the documents written in daily partitions ? """
+
+    return conf.get('index_layout', "legacy") == "partitioned"
+
+
+def prefix(conf):
+    """ Returns the prefix of the partitioned indices. """
+
+    return conf.get('partitions', {}).get('prefix', DEFAULT_PREFIX)
+
+
+def partition_name(conf, doc_type, day):
+    """ Returns the name of the partition of a type for a day (date). """
+
+    return prefix(conf) + "-" + doc_type + "-" + day.strftime("%Y.%m.%d")
+
+
+def write_url(conf, doc_type, now=None):
+    """ Returns the url where the documents of a type are posted. """
+
+    if not partitioned(conf):
+        return conf['url'] + "/" + conf['indexes']['main'] + "/" + doc_type
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    return conf['url'] + "/" + partition_name(conf, doc_type, now) + \
+        "/" + "_doc"
+
+
+def latest_index(conf, doc_type):
+    """ Returns the latest-state index of a type. """
+
+    # One index per type : indices created by ES 6 hold a single type
+    if not partitioned(conf):
+        return conf['indexes']['main'] + "-latest-" + doc_type
+
+    return prefix(conf) + "-latest-" + doc_type
+
+
+def latest_url(conf, doc_type, entity_id):
+    """
+    Returns the url of the latest-state document of an entity : posting
+    there replaces the previous state of the entity.
+    """
+
+    if not partitioned(conf):
+        return conf['url'] + "/" + latest_index(conf, doc_type) + "/" + \
+            doc_type + "/" + quote(entity_id, safe='')
+
+    return conf['url'] + "/" + latest_index(conf, doc_type) + "/_doc/" + \
+        quote(entity_id, safe='')
+
+
+def latest_search_url(conf, doc_type, endpoint="_search"):
+    """ Returns the url of the search "endpoint" on the latest states. """
+
+    return conf['url'] + "/" + latest_index(conf, doc_type) + "/" + endpoint
+
+
+def is_latest_url(conf, url):
+    """ Is a url one of latest_url (a latest-state document) ? """
+
+    index = urlsplit(url).path.strip('/').split('/')[0]
+    if not partitioned(conf):
+        return index.startswith(conf['indexes']['main'] + "-latest-")
+
+    return index.startswith(prefix(conf) + "-latest-")
+
+
+def url_doc_type(conf, url):
+    """
+    Returns the type of the documents posted to a url of write_url or
+    latest_url. The callers tell the latest states apart with
+    is_latest_url.
+    """
+
+    path = urlsplit(url).path.strip('/').split('/')
+    if len(path) > 1 and path[1] != "_doc":
+        return path[1]
+
+    index = path[0]
+    if index.startswith(prefix(conf) + "-"):
+        index = index[len(prefix(conf)) + 1:]
+    if is_latest_url(conf, url):
+        return index[len("latest-"):]
+
+    return index.rsplit('-', 1)[0]
+
+
+def read_indices(conf, doc_type, hours=24, now=None):
+    """
+    Returns the comma separated partitions of a type holding
+    the documents of the last "hours".
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+
+    days = []
+    day = (now - datetime.timedelta(hours=hours)).date()
+    while day <= now.date():
+        days.append(partition_name(conf, doc_type, day))
+        day += datetime.timedelta(days=1)
+
+    return ",".join(days)
+
+
+def search_url(conf, doc_type, hours=24, endpoint="_search"):
+    """
+    Returns the url of the search "endpoint" (_search, _msearch...)
+    for the documents of a type posted in the last "hours".
+    """
+
+    if not partitioned(conf):
+        return conf['url'] + "/" + conf['indexes']['main'] + "/" + endpoint
+
+    return conf['url'] + "/" + read_indices(conf, doc_type, hours) + "/" + \
+        endpoint + "?ignore_unavailable=true&allow_no_indices=true"
+
+
+def history_url(conf, doc_type, endpoint="_search"):
+    """
+    Returns the url of the search "endpoint" over all the documents of
+    a type : the alias of its partitions instead of a list of days.
+    """
+
+    if not partitioned(conf):
+        return conf['url'] + "/" + conf['indexes']['main'] + "/" + endpoint
+
+    return conf['url'] + "/" + prefix(conf) + "-" + doc_type + "/" + endpoint
+
+
+def type_filter(conf, doc_type):
+    """
+    Returns the term filters selecting a type of documents :
+    partitions only hold one type so there is nothing to filter.
+    """
+
+    if partitioned(conf):
+        return []
+
+    return [{'_type': doc_type}]
+
+
+def keyword_field(conf, field):
+    """
+    Returns the field to aggregate or sort on for a string field : the
+    templates of the partitions map strings as keywords, the legacy index
+    is dynamically mapped (text with a "keyword" sub-field).
+    """
+
+    if partitioned(conf):
+        return field
+
+    return field + ".keyword"
+
+
+def template(conf, doc_type):
+    """ Returns the index template of the partitions of a type. """
+
+    partitions = conf.get('partitions', {})
+
+    res = {
+        'index_patterns': [prefix(conf) + "-" + doc_type + "-*"],
+        'settings': {
+            'number_of_shards': int(partitions.get('shards', 1)),
+            'number_of_replicas': int(partitions.get('replicas', 1)),
+            'refresh_interval': partitions.get('refresh_interval', "30s")
+        },
+        'mappings': {
+            'dynamic_templates': [
+                {'strings': {'match_mapping_type': 'string',
+                             'mapping': {'type': 'keyword'}}},
+                {'numbers': {'match_mapping_type': 'long',
+                             'mapping': {'type': 'double'}}},
+                {'floats': {'match_mapping_type': 'double',
+                            'mapping': {'type': 'double'}}}
+            ],
+            'properties': {
+                'name': {'type': 'keyword'},
+                'host': {'type': 'keyword'},
+                'cluster': {'type': 'keyword'},
+                'datacenter': {'type': 'keyword'},
+                'post_date': {'type': 'date'}
+            }
+        },
+        'aliases': {prefix(conf) + "-" + doc_type: {}}
+    }
+
+    # VMs in the hv documents, each one queried on its own
+    if conf.get('vm_schema') == "nested" and \
+       doc_type == conf['indexes'].get('hv'):
+        res['mappings']['properties']['vms'] = {'type': 'nested'}
+
+    return res
+
+
+def latest_template(conf):
+    """ Returns the index template of the latest-state indices. """
+
+    res = template(conf, "latest")
+    res['index_patterns'] = [prefix(conf) + "-latest-*"]
+    res['settings']['number_of_shards'] = 1
+    del res['aliases']
+
+    return res
+
+
+def install_templates(conf):
+    """ Creates or updates the template of every type. """
+
+    templates = {}
+    for name, doc_type in list(conf['indexes'].items()):
+        if name == 'main':
+            continue
+        templates[prefix(conf) + "-" + doc_type] = template(conf, doc_type)
+    if conf.get('latest_state', False):
+        templates[prefix(conf) + "-latest"] = latest_template(conf)
+
+    for name, body in list(templates.items()):
+        url = conf['url'] + "/_template/" + name
+        try:
+            req = requests.put(url, data=json.dumps(body),
+                               headers={'Content-Type': 'application/json'},
+                               timeout=30)
+        except requests.exceptions.RequestException:
+            message = "Error while installing template at " + url
+            logging.warning(str(message + traceback.format_exc()))
+            sys.exit(message)
+        if req.status_code != 200:
+            message = "Error while installing template at " + url
+            logging.warning(str(message + " : " + str(req.content)))
+            sys.exit(message)
+
+
+def drop_old_partitions(conf, now=None):
+    """
+    Deletes the partitions older than the retention (in days).
+    Returns the names of the deleted partitions.
+    """
+
+    if now is None:
+        now = datetime.datetime.utcnow()
+    retention = int(conf.get('partitions', {}).get('retention_days',
+                                                   DEFAULT_RETENTION_DAYS))
+    oldest = (now - datetime.timedelta(days=retention)).date()
+
+    try:
+        req = requests.get(conf['url'] + "/_cat/indices/" + prefix(conf) +
+                           "-*", params={'format': 'json', 'h': 'index'},
+                           timeout=30)
+        indices = [entry['index'] for entry in json.loads(req.content)]
+    except (requests.exceptions.RequestException, ValueError):
+        message = "Error while listing the partitions"
+        logging.warning(str(message + traceback.format_exc()))
+        sys.exit(message)
+
+    deleted = []
+    for index in indices:
+        try:
+            day = datetime.datetime.strptime(index.rsplit('-', 1)[1],
+                                             "%Y.%m.%d").date()
+        except (IndexError, ValueError):
+            continue
+        if day < oldest:
+            requests.delete(conf['url'] + "/" + index, timeout=30)
+            deleted.append(index)
+
+    return deleted
+
+
+def expire_latest(conf):
+    """
+    Deletes the latest-state documents of the entities which stopped
+    reporting "latest_ttl" seconds ago.
+    """
+
+    ttl = int(conf.get('latest_ttl', DEFAULT_LATEST_TTL))
+    if partitioned(conf):
+        indices = prefix(conf) + "-latest-*"
+    else:
+        indices = conf['indexes']['main'] + "-latest-*"
+    url = conf['url'] + "/" + indices + "/_delete_by_query"
+    search = {'query': {'range': {'post_date': {'lt': "now-" + str(ttl) +
+                                                      "s"}}}}
+
+    try:
+        req = requests.post(url, data=json.dumps(search), timeout=30,
+                            params={'conflicts': 'proceed',
+                                    'allow_no_indices': 'true',
+                                    'ignore_unavailable': 'true'},
+                            headers={'Content-Type': 'application/json'})
+    except requests.exceptions.RequestException:
+        logging.warning("Error while expiring the latest states." +
+                        traceback.format_exc())
+        return 0
+
+    if req.status_code != 200:
+        logging.warning("Error while expiring the latest states : " +
+                        str(req.content))
+        return 0
+
+    return json.loads(req.content).get('deleted', 0)
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning indices script."))
+
+    if CONF.get('latest_state', False):
+        logging.info(str(expire_latest(CONF)) + " latest states expired.")
+
+    if not partitioned(CONF):
+        if CONF.get('latest_state', False):
+            sys.exit(0)
+        sys.exit("index_layout is not \"partitioned\", nothing to do.")
+
+    install_templates(CONF)
+    for INDEX in drop_old_partitions(CONF):
+        logging.info("Deleted partition " + INDEX)
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+_msearch client shared by the total_* scripts : sends many search
+bodies in as few round trips as the hits they request allow.
+"""
+
+import sys
+import json
+import logging
+import traceback
+import requests
+
+
+# Hits returned by ES for a search without "size".
+DEFAULT_HITS = 10
+
+
+def msearch_chunks(searches, chunk_size, max_hits):
+    """
+    Splits a list of search bodies into chunks of at most "chunk_size"
+    searches requesting at most "max_hits" hits, a search requesting
+    more being alone in its chunk.
+    """
+
+    chunk = []
+    hits = 0
+    for search in searches:
+        size = search.get('size', DEFAULT_HITS)
+        if chunk and (len(chunk) >= chunk_size or hits + size > max_hits):
+            yield chunk
+            chunk = []
+            hits = 0
+        chunk.append(search)
+        hits += size
+
+    if chunk:
+        yield chunk
+
+
+def request_msearch(url, searches, chunk_size, max_hits, timeout):
+    """
+    Send a list of search bodies to the _msearch endpoint "url", in
+    chunks of msearch_chunks, each answering within "timeout" seconds.
+    Returns the responses in the same order as the searches.
+    """
+
+    responses = []
+
+    for chunk in msearch_chunks(searches, chunk_size, max_hits):
+        body = ""
+        for search in chunk:
+            body += "{}\n" + json.dumps(search) + "\n"
+
+        try:
+            req = requests.post(url, data=body, timeout=timeout,
+                                headers={'Content-Type':
+                                         'application/x-ndjson'})
+        except requests.exceptions.RequestException:
+            message = "Error while requesting objects"
+            logging.warning(str(message + traceback.format_exc()))
+            sys.exit(message)
+        if req.status_code != 200:
+            message = "Error while requesting objects"
+            logging.warning(str(message + " : " + str(req.content)))
+            sys.exit(message)
+
+        for response in json.loads(req.content)['responses']:
+            if 'error' in response:
+                message = "Error in msearch response : " + \
+                    json.dumps(response['error'])
+                logging.warning(message)
+                sys.exit(message)
+            responses.append(response)
+
+    return responses
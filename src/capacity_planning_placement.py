@@ -0,0 +1,415 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+"""
+HTTP service answering VM placement questions from an in-memory index
+of the free vCPU/vRAM of each hypervisor.
+
+The index is loaded from the hv documents (from ELK or the local sample
+store, as the rollups) and refreshed every "refresh_interval" seconds
+with the documents posted since the previous refresh only. For each
+cluster and VM type, hypervisors are kept sorted by the number of VMs
+of this type they can still host, so a question is answered without
+any request to ELK :
+
+    GET /hosts?cluster=<cluster>&type=<vm type>&limit=<n>
+        the hypervisors able to host the most VMs of this type
+    GET /fit?cluster=<cluster>&type=<vm type>&count=<n>
+        can n VMs of this type fit in the cluster, and where
+
+    "placement": {"listen": "127.0.0.1", "port": 8086,
+                  "refresh_interval": 60, "max_age": 1800}
+"""
+
+import sys
+import json
+import bisect
+import logging
+import datetime
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from time import gmtime, strftime, time, sleep
+import os
+import requests
+from capacity_planning_store import ColumnStore, to_epoch
+from capacity_planning_indices import search_url, type_filter, \
+    latest_search_url, keyword_field
+
+
+# Documents posted up to this many seconds before the previous refresh
+# are requested again, for those indexed late.
+REFRESH_OVERLAP = 120
+
+# Maximum number of hits per request while refreshing.
+PAGE_SIZE = 5000
+
+
+def vm_fits(vm_type, vcpu_free, vram_free):
+    """ Returns how many VMs of a type fit in the free vCPU/vRAM. """
+
+    if vm_type['cpu'] <= 0 or vm_type['ram'] <= 0:
+        return 0
+
+    return max(0, min(int(vcpu_free // vm_type['cpu']),
+                      int(vram_free // vm_type['ram'])))
+
+
+class HeadroomIndex(object):
+    """
+    Free vCPU/vRAM of each hypervisor, and for each (cluster, VM type)
+    the hypervisors sorted by the number of VMs of this type they can
+    host, along with the total of the cluster.
+    """
+
+    def __init__(self, vm_types):
+        self.vm_types = dict((vm_type['type'],
+                              {'cpu': float(vm_type['cpu']),
+                               'ram': float(vm_type['ram'])})
+                             for vm_type in vm_types if 'type' in vm_type)
+        self.lock = threading.Lock()
+        # {"host": (cluster, vCPUfree, vRAMfree, epoch)}
+        self.hosts = {}
+        # {(cluster, type): [(-fits, host)]}
+        self.ranks = {}
+        # {(cluster, type): sum of fits}
+        self.capacity = {}
+
+    def _unlink(self, host):
+        cluster, vcpu_free, vram_free, epoch = self.hosts.pop(host)
+        for name, vm_type in list(self.vm_types.items()):
+            fits = vm_fits(vm_type, vcpu_free, vram_free)
+            ranks = self.ranks[(cluster, name)]
+            del ranks[bisect.bisect_left(ranks, (-fits, host))]
+            self.capacity[(cluster, name)] -= fits
+
+    def update(self, host, cluster, vcpu_free, vram_free, epoch):
+        """
+        Sets the free vCPU/vRAM of a hypervisor, unless the index already
+        holds a more recent sample.
+        """
+
+        with self.lock:
+            if host in self.hosts:
+                if self.hosts[host][3] > epoch:
+                    return
+                self._unlink(host)
+            self.hosts[host] = (cluster, vcpu_free, vram_free, epoch)
+            for name, vm_type in list(self.vm_types.items()):
+                fits = vm_fits(vm_type, vcpu_free, vram_free)
+                bisect.insort(self.ranks.setdefault((cluster, name), []),
+                              (-fits, host))
+                self.capacity[(cluster, name)] = \
+                    self.capacity.get((cluster, name), 0) + fits
+
+    def expire(self, oldest):
+        """ Removes the hypervisors without sample since "oldest" (epoch). """
+
+        with self.lock:
+            for host in [host for host, entry in list(self.hosts.items())
+                         if entry[3] < oldest]:
+                logging.info("No recent sample of " + host + ", removed.")
+                self._unlink(host)
+
+    def best_hosts(self, cluster, vm_type, limit):
+        """
+        Returns the "limit" hypervisors of a cluster able to host the
+        most VMs of a type.
+        """
+
+        with self.lock:
+            return [self._host_doc(host, -fits) for fits, host
+                    in self.ranks.get((cluster, vm_type), [])[:limit]
+                    if fits < 0]
+
+    def fit(self, cluster, vm_type, count):
+        """
+        Can "count" VMs of a type fit in a cluster ? Returns the answer,
+        the capacity of the cluster and the hypervisors to use, the
+        least loaded first.
+        """
+
+        with self.lock:
+            capacity = self.capacity.get((cluster, vm_type), 0)
+            placement = []
+            left = count
+            for fits, host in self.ranks.get((cluster, vm_type), []):
+                if left <= 0 or fits >= 0:
+                    break
+                placement.append({'name': host, 'count': min(-fits, left)})
+                left += fits
+
+        return {'fits': capacity >= count, 'capacity': capacity,
+                'placement': placement}
+
+    def _host_doc(self, host, fits):
+        cluster, vcpu_free, vram_free, epoch = self.hosts[host]
+
+        return {'name': host, 'fits': fits, 'vCPUfree': vcpu_free,
+                'vRAMfree': vram_free, 'post_date': epoch}
+
+
+def elk_samples(conf, hv_type, since):
+    """
+    Yields the hv documents posted after "since" (epoch) from ELK,
+    oldest first, paging with search_after.
+    """
+
+    since_date = datetime.datetime.fromtimestamp(since).isoformat()
+    search = {
+        'size': PAGE_SIZE,
+        '_source': ['name', 'cluster', 'vCPUfree', 'vRAMfree', 'post_date'],
+        'query': {'bool': {
+            'must': [{'term': term} for term in type_filter(conf, hv_type)],
+            'filter': {'range': {'post_date': {'gt': since_date}}}
+        }},
+        'sort': [{'post_date': 'asc'}, {keyword_field(conf, 'name'): 'asc'}]
+    }
+    hours = int((time() - since) // 3600) + 1
+    url = search_url(conf, hv_type, hours)
+
+    while True:
+        req = requests.get(url, data=json.dumps(search), timeout=30,
+                           headers={'Content-Type': 'application/json'})
+        if req.status_code != 200:
+            raise IOError("Error while requesting hv documents : " +
+                          str(req.content))
+        hits = json.loads(req.content)['hits']['hits']
+        for hit in hits:
+            yield hit['_source']
+        if len(hits) < PAGE_SIZE:
+            break
+        search['search_after'] = hits[-1]['sort']
+
+
+def latest_samples(conf, hv_type):
+    """
+    Yields the latest-state document of each hypervisor, paging with
+    search_after.
+    """
+
+    search = {
+        'size': PAGE_SIZE,
+        '_source': ['name', 'cluster', 'vCPUfree', 'vRAMfree', 'post_date'],
+        'query': {'bool': {
+            'must': [{'term': term} for term in type_filter(conf, hv_type)]
+        }},
+        'sort': [{keyword_field(conf, 'name'): 'asc'}]
+    }
+    url = latest_search_url(conf, hv_type)
+
+    while True:
+        req = requests.get(url, data=json.dumps(search), timeout=30,
+                           headers={'Content-Type': 'application/json'})
+        if req.status_code != 200:
+            raise IOError("Error while requesting latest states : " +
+                          str(req.content))
+        hits = json.loads(req.content)['hits']['hits']
+        for hit in hits:
+            yield hit['_source']
+        if len(hits) < PAGE_SIZE:
+            break
+        search['search_after'] = hits[-1]['sort']
+
+
+def store_samples(sample_store, hv_type, since):
+    """ Yields the hv documents stored after "since" (epoch). """
+
+    store = ColumnStore(sample_store)
+    for cluster in store.attribute_values(hv_type, 'cluster'):
+        samples = store.query(hv_type, ['vCPUfree', 'vRAMfree'],
+                              start=since, cluster=cluster)
+        for name, post_date, vcpu_free, vram_free in zip(
+                samples['name'], samples['post_date'],
+                samples['vCPUfree'], samples['vRAMfree']):
+            yield {'name': str(name), 'cluster': cluster,
+                   'post_date': int(post_date), 'vCPUfree': float(vcpu_free),
+                   'vRAMfree': float(vram_free)}
+
+
+def refresh(index, samples):
+    """
+    Updates the index with samples. Returns the date (epoch) of the
+    most recent one, or None.
+    """
+
+    last = None
+    for sample in samples:
+        epoch = sample['post_date']
+        if not isinstance(epoch, (int, float)):
+            epoch = to_epoch(epoch)
+        if 'cluster' not in sample or sample.get('vCPUfree') is None or \
+           sample.get('vRAMfree') is None:
+            continue
+        index.update(sample['name'], sample['cluster'],
+                     float(sample['vCPUfree']), float(sample['vRAMfree']),
+                     epoch)
+        last = epoch if last is None else max(last, epoch)
+
+    return last
+
+
+def refresh_forever(index, samples, interval, max_age, since=None):
+    """
+    Refreshes the index every "interval" seconds from the documents
+    posted since the previous refresh (at first since "since", default
+    "max_age" seconds ago). "samples" is called with the date (epoch)
+    to start from.
+    """
+
+    if since is None:
+        since = time() - max_age
+    while True:
+        started = time()
+        try:
+            last = refresh(index, samples(since))
+        except (IOError, requests.exceptions.RequestException, ValueError):
+            logging.warning("Error while refreshing the placement index." +
+                            traceback.format_exc())
+        else:
+            if last is not None:
+                since = max(since, last - REFRESH_OVERLAP)
+            index.expire(time() - max_age)
+            logging.debug("Placement index refreshed in " +
+                          str(time() - started) + "s : " +
+                          str(len(index.hosts)) + " hypervisors.")
+        sleep(max(0.0, interval - (time() - started)))
+
+
+class PlacementHandler(BaseHTTPRequestHandler):
+    """ Answers the placement questions from the index of the server. """
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = dict((key, values[0])
+                      for key, values in list(parse_qs(url.query).items()))
+        index = self.server.index
+
+        if url.path == "/health":
+            return self.reply(200, {'hypervisors': len(index.hosts)})
+        if url.path not in ("/hosts", "/fit"):
+            return self.reply(404, {'error': "unknown path " + url.path})
+        if 'cluster' not in params or 'type' not in params:
+            return self.reply(400, {'error': "cluster and type are needed"})
+        if params['type'] not in index.vm_types:
+            return self.reply(404, {'error': "unknown vm type " +
+                                             params['type']})
+
+        try:
+            if url.path == "/hosts":
+                return self.reply(200, index.best_hosts(
+                    params['cluster'], params['type'],
+                    int(params.get('limit', 5))))
+            return self.reply(200, index.fit(params['cluster'],
+                                             params['type'],
+                                             int(params.get('count', 1))))
+        except ValueError:
+            return self.reply(400, {'error': "limit and count are integers"})
+
+    def reply(self, status, data):
+        """ Sends a JSON answer. """
+
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(self.address_string() + " " + format % args)
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning placement service."))
+
+    PLACEMENT_CONF = CONF.get('placement', {})
+    HV_INDEX = CONF['indexes']['hv']
+    SAMPLE_STORE = CONF.get('sample_store')
+    if CONF.get('rollup_source', "elk") == "store":
+        if not SAMPLE_STORE:
+            sys.exit("Error while parsing conf file : no sample_store.")
+        SAMPLES = lambda since: store_samples(SAMPLE_STORE, HV_INDEX, since)
+    else:
+        SAMPLES = lambda since: elk_samples(CONF, HV_INDEX, since)
+
+    INDEX = HeadroomIndex(CONF['vm_type'])
+    SINCE = None
+    if CONF.get('latest_state', False) and \
+       CONF.get('rollup_source', "elk") != "store":
+        # One document per hypervisor instead of max_age of samples
+        SINCE = time() - REFRESH_OVERLAP
+        try:
+            refresh(INDEX, latest_samples(CONF, HV_INDEX))
+        except (IOError, requests.exceptions.RequestException, ValueError):
+            logging.warning("Error while loading the latest states." +
+                            traceback.format_exc())
+            SINCE = None
+    threading.Thread(target=refresh_forever,
+                     args=(INDEX, SAMPLES,
+                           float(PLACEMENT_CONF.get('refresh_interval', 60)),
+                           float(PLACEMENT_CONF.get('max_age', 1800)),
+                           SINCE),
+                     daemon=True).start()
+
+    SERVER = ThreadingHTTPServer((PLACEMENT_CONF.get('listen', "127.0.0.1"),
+                                  int(PLACEMENT_CONF.get('port', 8086))),
+                                 PlacementHandler)
+    SERVER.index = INDEX
+    SERVER.serve_forever()
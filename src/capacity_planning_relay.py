@@ -0,0 +1,557 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Local relay daemon for the collectors of a node.
+
+The collectors write their documents on a Unix socket, one line per
+document : "<url>\\t<json document>\\n". The relay coalesces the
+documents of all collectors and sends them to elastic search in gzip
+compressed _bulk requests, on one persistent connection.
+The collectors hand their documents with relay_send() and fall back
+to a direct POST when the relay isn't running.
+
+The batch size and the send rate of each ES destination adapt to its
+load (AIMD) : they grow while ES answers fast and are halved, with a
+jittered exponential backoff, when ES is slow or rejects documents
+(429/503). The relay reports this throttle state in its own documents.
+"""
+
+import os
+import sys
+import json
+import gzip
+import random
+import socket
+import signal
+import logging
+import selectors
+import datetime
+import threading
+import traceback
+from time import gmtime, strftime, sleep, monotonic
+from urllib.parse import urlsplit, unquote
+import requests
+from capacity_planning_indices import write_url
+
+
+DEFAULT_RELAY_SOCKET = "/tmp/capacity_planning/relay.sock"
+
+# Connections of the collectors to the relay, by socket path.
+CONNECTIONS = {}
+
+
+def relay_send(url, data_json, socket_path=DEFAULT_RELAY_SOCKET):
+    """
+    Hands a document for "url" to the local relay.
+    Returns False if the relay isn't running, the caller must then
+    send the document itself.
+    """
+
+    if socket_path not in CONNECTIONS:
+        if not socket_path or not os.path.exists(socket_path):
+            return False
+        try:
+            connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.connect(socket_path)
+        except OSError:
+            return False
+        CONNECTIONS[socket_path] = connection
+
+    try:
+        CONNECTIONS[socket_path].sendall(
+            (url + "\t" + data_json.replace("\n", " ") + "\n").encode())
+    except OSError:
+        CONNECTIONS.pop(socket_path).close()
+        return False
+
+    return True
+
+
+def bulk_action(url):
+    """
+    Returns the base url of ES and the bulk action of a document
+    posted to "url" (url/index/type or url/index/_doc, followed by the
+    id of the document if it has a deterministic one).
+    """
+
+    parts = urlsplit(url)
+    path = parts.path.strip('/').split('/')
+    action = {'_index': path[0]}
+    if len(path) > 1 and path[1] != "_doc":
+        action['_type'] = path[1]
+    if len(path) > 2:
+        action['_id'] = unquote(path[2])
+
+    return parts.scheme + "://" + parts.netloc, {'index': action}
+
+
+class Backpressure(object):
+    """
+    Adaptive batch size and send rate (documents per second) of one
+    ES destination. Requests answered faster than "target_latency"
+    increase them additively, slow or rejected requests halve them and
+    rejected ones also delay the next request by a jittered exponential
+    backoff.
+    """
+
+    def __init__(self, max_batch_size, max_rate, target_latency,
+                 min_batch_size=10, min_rate=10.0, max_backoff=300.0):
+        self.max_batch_size = max_batch_size
+        self.min_batch_size = min(min_batch_size, max_batch_size)
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.target_latency = target_latency
+        self.max_backoff = max_backoff
+        self.batch_size = max_batch_size
+        self.rate = max_rate
+        self.latency = 0.0
+        self.failures = 0
+        self.rejections = 0
+        self.next_send = 0.0
+        self.retry_at = 0.0
+
+    def delay(self, now):
+        """ Returns the seconds to wait before the next request. """
+
+        return max(self.next_send, self.retry_at) - now
+
+    def decrease(self):
+        """ Halves the batch size and the rate. """
+
+        self.batch_size = max(self.batch_size // 2, self.min_batch_size)
+        self.rate = max(self.rate / 2.0, self.min_rate)
+
+    def accepted(self, count, latency, now):
+        """ Accounts a request of "count" documents accepted by ES. """
+
+        self.latency = latency if not self.latency \
+            else 0.8 * self.latency + 0.2 * latency
+        self.failures = 0
+        self.retry_at = 0.0
+        if latency > self.target_latency:
+            self.decrease()
+        else:
+            self.batch_size = min(self.batch_size +
+                                  max(self.max_batch_size // 10, 1),
+                                  self.max_batch_size)
+            self.rate = min(self.rate + self.max_rate / 10.0, self.max_rate)
+        self.next_send = now + count / self.rate
+
+    def rejected(self, now):
+        """ Accounts a request rejected by ES or which didn't reach it. """
+
+        self.failures += 1
+        self.rejections += 1
+        self.decrease()
+        backoff = min(2 ** (self.failures - 1), self.max_backoff)
+        self.retry_at = now + backoff * random.uniform(0.5, 1.5)
+
+    def state(self, now):
+        """ Returns the throttle state, for the relay documents. """
+
+        return {
+            'batch_size': self.batch_size,
+            'rate': self.rate,
+            'latency': self.latency,
+            'rejections': self.rejections,
+            'backoff': max(self.retry_at - now, 0.0),
+            'throttled': self.batch_size < self.max_batch_size or
+                         self.rate < self.max_rate or self.retry_at > now
+        }
+
+
+class Relay(object):
+    """
+    Accepts the documents of the local collectors and forwards them
+    to ES in batches of at most "batch_size" documents and "max_rate"
+    documents per second, at least every "flush_interval" seconds.
+    Both adapt to the load of each destination (see Backpressure).
+    If ES is unreachable or overloaded, documents are kept
+    (up to "max_buffer") and sent again with the next batch.
+    Every "metrics_interval" seconds, a document describing the relay
+    is posted to the url returned by "metrics_url" (if given).
+    The collectors are read by the main thread and the batches sent by
+    a flusher thread, so a slow ES doesn't stop the relay from reading :
+    the queues are locked while they change, not during the requests.
+    """
+
+    def __init__(self, socket_path, batch_size, flush_interval, max_buffer,
+                 compress, max_rate=5000.0, target_latency=2.0,
+                 metrics_url=None, metrics_interval=60.0):
+        self.socket_path = socket_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.compress = compress
+        self.max_rate = max_rate
+        self.target_latency = target_latency
+        self.metrics_url = metrics_url
+        self.metrics_interval = metrics_interval
+        self.session = requests.Session()
+        self.selector = selectors.DefaultSelector()
+        self.partial = {}
+        self.pending = {}
+        self.controls = {}
+        self.count = 0
+        self.dropped = 0
+        self.last_flush = monotonic()
+        self.last_metrics = monotonic()
+        self.running = True
+        self.lock = threading.Lock()
+        # Wakes up the flusher when a batch is due or the relay stops
+        self.wakeup = threading.Condition(self.lock)
+
+    def control(self, base_url):
+        """ Returns the backpressure state of a destination. """
+
+        if base_url not in self.controls:
+            self.controls[base_url] = Backpressure(self.batch_size,
+                                                   self.max_rate,
+                                                   self.target_latency)
+
+        return self.controls[base_url]
+
+    def listen(self):
+        """ Creates the Unix socket of the relay. """
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.socket_path)
+        server.listen(128)
+        server.setblocking(False)
+        self.selector.register(server, selectors.EVENT_READ, self.accept)
+
+    def accept(self, server):
+        """ Accepts a new collector. """
+
+        connection = server.accept()[0]
+        connection.setblocking(False)
+        self.partial[connection] = b""
+        self.selector.register(connection, selectors.EVENT_READ, self.read)
+
+    def read(self, connection):
+        """ Reads the documents sent by a collector. """
+
+        try:
+            data = connection.recv(65536)
+        except OSError:
+            data = b""
+        if not data:
+            self.selector.unregister(connection)
+            connection.close()
+            del self.partial[connection]
+            return
+
+        lines = (self.partial[connection] + data).split(b"\n")
+        self.partial[connection] = lines.pop()
+        with self.wakeup:
+            for line in lines:
+                self.queue(line.decode())
+            if self.due():
+                self.wakeup.notify()
+
+    def add(self, line):
+        """ Queues one document line. """
+
+        with self.wakeup:
+            self.queue(line)
+            if self.due():
+                self.wakeup.notify()
+
+    def queue(self, line):
+        """ Queues one document line, the lock being held. """
+
+        try:
+            url, data_json = line.split("\t", 1)
+        except ValueError:
+            logging.warning("Malformed line received by the relay.")
+            return
+
+        base_url, action = bulk_action(url)
+        self.pending.setdefault(base_url, []).append(
+            json.dumps(action) + "\n" + data_json + "\n")
+        self.count += 1
+
+        if self.count > self.max_buffer:
+            # ES has been unreachable for too long, drop the oldest documents
+            for lines in list(self.pending.values()):
+                if lines:
+                    lines.pop(0)
+                    self.count -= 1
+                    self.dropped += 1
+                    logging.warning("Relay buffer full, dropping a "
+                                    "document.")
+                    break
+
+    def due(self):
+        """
+        Has a destination a full batch it can send now ? The lock must
+        be held.
+        """
+
+        now = monotonic()
+        for base_url, lines in list(self.pending.items()):
+            control = self.control(base_url)
+            if len(lines) >= control.batch_size and control.delay(now) <= 0:
+                return True
+
+        return False
+
+    def timeout(self):
+        """ Returns the seconds until the next flush, the lock held. """
+
+        now = monotonic()
+        timeout = self.last_flush + self.flush_interval - now
+        for base_url, lines in list(self.pending.items()):
+            control = self.control(base_url)
+            if len(lines) >= control.batch_size:
+                timeout = min(timeout, control.delay(now))
+
+        return max(timeout, 0)
+
+    def flush(self):
+        """
+        Sends the queued documents to ES, as long as each destination
+        accepts them at its current rate. Each batch is taken from its
+        queue while sent, the documents to send again being put back at
+        its head.
+        """
+
+        with self.lock:
+            self.last_flush = monotonic()
+            base_urls = list(self.pending)
+
+        for base_url in base_urls:
+            while True:
+                with self.lock:
+                    control = self.control(base_url)
+                    lines = self.pending[base_url]
+                    if not lines or control.delay(monotonic()) > 0:
+                        break
+                    batch = lines[:control.batch_size]
+                    del lines[:len(batch)]
+                if not self.send(base_url, control, batch):
+                    break
+
+    def send(self, base_url, control, batch):
+        """
+        Sends a batch of lines taken from the queue of a destination.
+        The whole batch if the request failed, or the documents rejected
+        by an overloaded ES (429), are queued again.
+        Returns False if ES didn't accept the request.
+        """
+
+        body = "".join(batch).encode()
+        headers = {'Content-Type': 'application/x-ndjson'}
+        if self.compress:
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+
+        start = monotonic()
+        try:
+            req = self.session.post(base_url + "/_bulk", data=body,
+                                    headers=headers, timeout=30)
+        except requests.exceptions.RequestException:
+            logging.warning("Error while sending data to "
+                            "elasticsearch at " + base_url +
+                            traceback.format_exc())
+            req = None
+        if req is not None and req.status_code != 200:
+            logging.warning("Error in bulk response from " +
+                            base_url + " : " + str(req.content)[:1000])
+            req = None
+        if req is None:
+            with self.lock:
+                self.pending[base_url][:0] = batch
+                control.rejected(monotonic())
+            return False
+
+        retry = []
+        try:
+            result = json.loads(req.content)
+        except ValueError:
+            result = {}
+        if result.get('errors'):
+            for line, item in zip(batch, result.get('items', [])):
+                status = list(item.values())[0].get('status')
+                if status == 429:
+                    retry.append(line)
+                elif status not in (200, 201):
+                    logging.warning("Document rejected by " + base_url +
+                                    " : " + json.dumps(item))
+
+        with self.lock:
+            self.pending[base_url][:0] = retry
+            self.count -= len(batch) - len(retry)
+            if retry:
+                control.rejected(monotonic())
+                return False
+            control.accepted(len(batch), monotonic() - start, monotonic())
+
+        return True
+
+    def metrics(self):
+        """ Queues the document describing the relay and its throttles. """
+
+        self.last_metrics = monotonic()
+        url = self.metrics_url() if self.metrics_url else None
+        if not url:
+            return
+
+        now = monotonic()
+        destinations = []
+        with self.lock:
+            for base_url, control in sorted(self.controls.items()):
+                state = control.state(now)
+                state['url'] = base_url
+                state['pending'] = len(self.pending.get(base_url, []))
+                destinations.append(state)
+            count = self.count
+            dropped = self.dropped
+        doc = {
+            'name': socket.getfqdn(),
+            'post_date': datetime.datetime.now().isoformat(),
+            'pending': count,
+            'dropped': dropped,
+            'throttled': len([state for state in destinations
+                              if state['throttled']]),
+            'destinations': destinations
+        }
+        self.add(url + "\t" + json.dumps(doc))
+
+    def drain(self):
+        """
+        Sends the remaining documents before the relay stops, waiting for
+        the destinations for at most "flush_interval" seconds.
+        """
+
+        deadline = monotonic() + self.flush_interval
+        self.flush()
+        while monotonic() < deadline:
+            with self.lock:
+                now = monotonic()
+                delays = [self.control(base_url).delay(now)
+                          for base_url, lines in list(self.pending.items())
+                          if lines]
+            if not delays or now + min(delays) > deadline:
+                break
+            sleep(max(min(delays), 0))
+            self.flush()
+
+    def flusher(self):
+        """
+        Flushes the queues when a batch is due or every
+        "flush_interval" seconds, then drains them once the relay stops.
+        """
+
+        while True:
+            with self.wakeup:
+                if self.running and not self.due():
+                    self.wakeup.wait(self.timeout())
+                if not self.running:
+                    break
+                due = monotonic() - self.last_flush >= \
+                    self.flush_interval or self.due()
+            if due:
+                self.flush()
+
+        self.drain()
+
+    def stop(self, signum=None, frame=None):
+        """ Stops the relay after the current loop. """
+
+        self.running = False
+
+    def serve_forever(self):
+        """ Main loop of the relay. """
+
+        self.listen()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        flusher = threading.Thread(target=self.flusher)
+        flusher.start()
+
+        while self.running:
+            timeout = self.last_metrics + self.metrics_interval - monotonic()
+            for key, _ in self.selector.select(max(min(timeout, 1.0), 0)):
+                key.data(key.fileobj)
+            if monotonic() - self.last_metrics >= self.metrics_interval:
+                self.metrics()
+
+        with self.wakeup:
+            self.wakeup.notify()
+        flusher.join()
+        os.unlink(self.socket_path)
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    CONF = parse_conf()
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning relay."))
+
+    RELAY_CONF = CONF.get('relay', {})
+    METRICS_TYPE = CONF['indexes'].get('relay')
+    Relay(CONF.get('relay_socket', DEFAULT_RELAY_SOCKET),
+          int(RELAY_CONF.get('batch_size', 500)),
+          float(RELAY_CONF.get('flush_interval', 5)),
+          int(RELAY_CONF.get('max_buffer', 100000)),
+          bool(RELAY_CONF.get('compress', True)),
+          float(RELAY_CONF.get('max_rate', 5000)),
+          float(RELAY_CONF.get('target_latency', 2)),
+          (lambda: write_url(CONF, METRICS_TYPE)) if METRICS_TYPE else None,
+          float(RELAY_CONF.get('metrics_interval', 60))).serve_forever()
@@ -35,12 +35,165 @@ and send it to elastic search
 import json
 import datetime
 import logging
+import argparse
 import traceback
-from time import gmtime, strftime
+from time import gmtime, strftime, time, monotonic
+from array import array
 import sys
 import os
 from pysnmp.hlapi import *
-import requests
+from capacity_planning_indices import write_url, latest_url
+from capacity_planning_sinks import add_sink_arguments, open_sink
+from capacity_planning_shards import heartbeat, live_workers, hash_ring, \
+    ring_owner, try_lock, save_results, load_results, DEFAULT_VNODES
+
+
+# Monotonic time at which the polling of each SAN group must stop.
+BUDGET_ENDS = {}
+
+# Names of the pools, the index of each row being the index of the pool.
+POOL_NAME_OID = "1.3.6.1.4.1.12740.16.1.1.1.3.1"
+
+# Stats fetched on each pool : name, OID of its column in the pools
+# table and whether the value is converted from Mib to Gib.
+POOL_STATS = (
+    ('SANCountVol', "1.3.6.1.4.1.12740.16.1.2.1.16.1.", False),
+    ('SANTotalVol', "1.3.6.1.4.1.12740.16.1.2.1.1.1.", True),
+    ('SANFreeVol', "1.3.6.1.4.1.12740.16.1.2.1.3.1.", True),
+    ('SANTotalReplication', "1.3.6.1.4.1.12740.16.1.2.1.4.1.", True),
+    ('SANUsedReplication', "1.3.6.1.4.1.12740.16.1.2.1.5.1.", True),
+    ('SANFreeReplication', "1.3.6.1.4.1.12740.16.1.2.1.6.1.", True),
+    ('SANReservedSnapshot', "1.3.6.1.4.1.12740.16.1.2.1.9.1.", True),
+    ('SANUsedSnapshot', "1.3.6.1.4.1.12740.16.1.2.1.10.1.", True),
+    ('SANTotalDelegatedSpace', "1.3.6.1.4.1.12740.16.1.2.1.17.1.", True),
+    ('SANUsedDelegatedSpace', "1.3.6.1.4.1.12740.16.1.2.1.18.1.", True),
+    ('SANAllocatedVolSpace', "1.3.6.1.4.1.12740.16.1.2.1.21.1.", True),
+    ('SANFreeThinProv', "1.3.6.1.4.1.12740.16.1.2.1.23.1.", True),
+    ('SANFreeSnaphot', "1.3.6.1.4.1.12740.16.1.2.1.25.1.", True),
+)
+
+# I/O counters of the pools (EQLSTORAGEPOOL-MIB) and of the members
+# (EQLMEMBER-MIB) walked with GETBULK, and the rate published for each
+# one : operations/s or Mib/s.
+POOL_COUNTERS = (
+    ('SANReadIOPS', "1.3.6.1.4.1.12740.16.1.3.1.1.1"),
+    ('SANWriteIOPS', "1.3.6.1.4.1.12740.16.1.3.1.2.1"),
+    ('SANReadThroughput', "1.3.6.1.4.1.12740.16.1.3.1.3.1"),
+    ('SANWriteThroughput', "1.3.6.1.4.1.12740.16.1.3.1.4.1"),
+)
+MEMBER_NAME_OID = "1.3.6.1.4.1.12740.2.1.1.1.9.1"
+MEMBER_COUNTERS = (
+    ('SANReadIOPS', "1.3.6.1.4.1.12740.2.1.12.1.1.1"),
+    ('SANWriteIOPS', "1.3.6.1.4.1.12740.2.1.12.1.2.1"),
+    ('SANReadThroughput', "1.3.6.1.4.1.12740.2.1.12.1.3.1"),
+    ('SANWriteThroughput', "1.3.6.1.4.1.12740.2.1.12.1.4.1"),
+)
+PERF_STATS = tuple(stat for stat, oid in POOL_COUNTERS)
+
+# Stats summed from the pools up to the datacenters, in the order of
+# SanStats.values.
+STATS = tuple(stat for stat, oid, to_gib in POOL_STATS) + \
+    ('SANUsedVol',) + PERF_STATS
+STATS_INDEX = dict((stat, index) for index, stat in enumerate(STATS))
+
+# Columns of the EqualLogic volumes table (EQLVOLUME-MIB) walked together
+# with GETBULK, rows indexed by <member>.<volume>.
+VOLUME_COLUMNS = (
+    ('name', "1.3.6.1.4.1.12740.5.1.7.1.1.4"),
+    ('size', "1.3.6.1.4.1.12740.5.1.7.1.1.8"),
+    ('snap_reserve', "1.3.6.1.4.1.12740.5.1.7.1.1.10"),
+    ('pool', "1.3.6.1.4.1.12740.5.1.7.1.1.22"),
+)
+
+# Allocated space (Mib) of each volume, in the volumes status table.
+VOLUME_USED_OID = "1.3.6.1.4.1.12740.5.1.7.7.1.13"
+
+
+class SanUnreachable(Exception):
+    """ A SAN group doesn't answer or has used all its time budget. """
+
+
+class SanStats(object):
+    """
+    Stats of a pool, a SAN group (host), a cluster or a datacenter :
+    its identity and one float per STATS. Hosts, clusters and
+    datacenters are summed from these records, which are only turned
+    into documents when sent.
+    """
+
+    __slots__ = ('name', 'host', 'cluster', 'datacenter', 'usage', 'stale',
+                 'stale_groups', 'perf', 'values')
+
+    def __init__(self, name, host=None, cluster=None, datacenter=None):
+        self.name = name
+        self.host = host
+        self.cluster = cluster
+        self.datacenter = datacenter
+        # "storage" or "replication", pools only
+        self.usage = None
+        # Couldn't the SAN group be polled ? hosts only
+        self.stale = None
+        # Number of stale SAN groups, clusters and datacenters only
+        self.stale_groups = None
+        # Were PERF_STATS measured ?
+        self.perf = False
+        self.values = array('d', bytes(8 * len(STATS)))
+
+    def __getitem__(self, stat):
+        return self.values[STATS_INDEX[stat]]
+
+    def __setitem__(self, stat, value):
+        self.values[STATS_INDEX[stat]] = value
+
+    def ratio(self):
+        """ Returns the used volume ratio (%). """
+
+        if self['SANTotalVol'] <= 0.0:
+            return 0.0
+
+        return float(self['SANUsedVol'] / self['SANTotalVol'] * 100.0)
+
+    def to_doc(self):
+        """ Returns the document of the record, as sent to ELK. """
+
+        doc = {'name': self.name}
+        for attribute in ('host', 'cluster', 'datacenter'):
+            if getattr(self, attribute) is not None:
+                doc[attribute] = getattr(self, attribute)
+        if self.stale:
+            doc['stale'] = True
+            return doc
+
+        for stat, value in zip(STATS, self.values):
+            if self.perf or stat not in PERF_STATS:
+                doc[stat] = value
+        doc['SANVolRatio'] = self.ratio()
+        if self.usage is not None:
+            doc['SANPoolsUsage'] = self.usage
+        if self.stale is not None:
+            doc['stale'] = False
+        if self.stale_groups is not None:
+            doc['SANStaleGroups'] = self.stale_groups
+
+        return doc
+
+    @classmethod
+    def from_doc(cls, doc):
+        """
+        Returns the record of a pool or host document (ex: read from ELK
+        or from the results of a shard).
+        """
+
+        record = cls(doc['name'], doc.get('host'), doc.get('cluster'),
+                     doc.get('datacenter'))
+        record.usage = doc.get('SANPoolsUsage')
+        record.stale = doc.get('stale')
+        record.perf = PERF_STATS[0] in doc
+        for stat in STATS:
+            if stat in doc:
+                record[stat] = float(doc[stat])
+
+        return record
 
 
 def mib_to_gib(value):
@@ -59,20 +212,33 @@ def get_oid_num(string):
     return oid_num[len(oid_num) - 1]
 
 
-def send_to_elk(url, data_map):
-    """ Sends data to the ELK stack. """
+def send_to_elk(url, record):
+    """
+    Sends the document of a SanStats record to the sink of the script
+    (the ELK stack by default).
+    """
 
     now = datetime.datetime.now()
-    tmp_data = data_map.copy()
-    tmp_data['post_date'] = now.isoformat()
-    data_json = json.dumps(tmp_data)
+    doc = record.to_doc()
+    doc['post_date'] = now.isoformat()
+    SINK.send(url, doc)
 
-    try:
-        requests.post(url, data=data_json, timeout=5)
-    except RequestException:
-        message = "Error while sending data to elasticsearch at " + url
-        logging.warning(str(message + traceback.format_exc()))
-        sys.exit(message)
+
+def transport(host):
+    """
+    Returns the UDP transport to a SAN group.
+    Raises SanUnreachable if the time budget of the group is exceeded;
+    otherwise a request can't last longer than what is left of it.
+    """
+
+    remaining = BUDGET_ENDS.get(host, monotonic() + SNMP_BUDGET) - monotonic()
+    if remaining <= 0:
+        raise SanUnreachable(host + " : time budget exceeded")
+
+    return UdpTransportTarget((host, SNMP_PORT),
+                              timeout=min(SNMP_TIMEOUT,
+                                          remaining / (SNMP_RETRIES + 1)),
+                              retries=SNMP_RETRIES)
 
 
 def walk(host, oid):
@@ -86,12 +252,12 @@ def walk(host, oid):
     for (error_indication, error_status, error_index, var_binds) \
         in nextCmd(SnmpEngine(),
                    CommunityData(SNMP_COMMUNITY),
-                   UdpTransportTarget((host, 161)),
+                   transport(host),
                    ContextData(),
                    ObjectType(ObjectIdentity(oid)),
                    lexicographicMode=False):
         if error_indication:
-            print(error_indication)
+            raise SanUnreachable(host + " : " + str(error_indication))
         elif error_status:
             print(('%s at %s' % (
                 error_status.prettyPrint(),
@@ -104,6 +270,8 @@ def walk(host, oid):
             for var_bind in var_binds:
                 res = str(' = '.join([x.prettyPrint() for x in var_bind]))
                 binds.append(res)
+        if monotonic() > BUDGET_ENDS.get(host, monotonic()):
+            raise SanUnreachable(host + " : time budget exceeded")
 
     return binds
 
@@ -116,14 +284,14 @@ def get(host, oid):
 
     get_cmd = getCmd(SnmpEngine(),
                      CommunityData(SNMP_COMMUNITY),
-                     UdpTransportTarget((host, 161)),
+                     transport(host),
                      ContextData(),
                      ObjectType(ObjectIdentity(oid)))
 
     error_indication, error_status, error_index, var_binds = next(get_cmd)
 
     if error_indication:
-        print(error_indication)
+        raise SanUnreachable(host + " : " + str(error_indication))
     elif error_status:
         print(('%s at %s' % (
             error_status.prettyPrint(),
@@ -140,6 +308,191 @@ def get(host, oid):
     return None
 
 
+def bulk_walk(host, oids):
+    """
+    Walks table columns together with GETBULK requests of
+    SNMP_MAX_REPETITIONS rows. Yields the index of each row (the end of
+    its OIDs) with the values of the columns, rows being streamed as
+    the answers come.
+    """
+
+    for (error_indication, error_status, error_index, var_binds) \
+        in bulkCmd(SnmpEngine(),
+                   CommunityData(SNMP_COMMUNITY),
+                   transport(host),
+                   ContextData(),
+                   0, SNMP_MAX_REPETITIONS,
+                   *[ObjectType(ObjectIdentity(oid)) for oid in oids],
+                   lexicographicMode=False):
+        if error_indication:
+            raise SanUnreachable(host + " : " + str(error_indication))
+        elif error_status:
+            logging.warning("%s at %s on %s" % (
+                error_status.prettyPrint(),
+                error_index and var_binds[int(error_index) - 1][0] or '?',
+                host))
+            return
+        row = [(str(name.prettyPrint()), value.prettyPrint())
+               for name, value in var_binds]
+        # A column may end before the others
+        if all(name.startswith(oid + ".")
+               for (name, value), oid in zip(row, oids)):
+            yield row[0][0][len(oids[0]) + 1:], \
+                [value for name, value in row]
+        if monotonic() > BUDGET_ENDS.get(host, monotonic()):
+            raise SanUnreachable(host + " : time budget exceeded")
+
+
+def get_stats_on_all_volumes(host, cluster, datacenter, send):
+    """
+    Fetches the size, used space and snapshot reserve of all the volumes
+    of a SAN group with GETBULK walks, each volume mapped to its pool.
+    Returns the number of volumes; if "send" is True, sends one
+    document per volume to the ELK stack.
+    """
+
+    pools = list_pools(host)
+    used = {}
+    for index, values in bulk_walk(host, [VOLUME_USED_OID]):
+        used[index] = mib_to_gib(values[0])
+
+    url = write_url(CONF, VOLUMES_INDEX)
+    post_date = datetime.datetime.now().isoformat()
+    count = 0
+
+    for index, values in bulk_walk(host, [oid for column, oid
+                                          in VOLUME_COLUMNS]):
+        volume = dict(zip([column for column, oid in VOLUME_COLUMNS],
+                          values))
+        try:
+            size = mib_to_gib(volume['size'])
+            snap_reserve = size * float(volume['snap_reserve']) / 100.0
+        except ValueError:
+            logging.warning("Bad stats for volume " + volume['name'] +
+                            " on " + host)
+            continue
+        doc = {
+            'name': volume['name'],
+            'host': host,
+            'cluster': cluster,
+            'datacenter': datacenter,
+            'pool': pools.get(volume['pool'], "default"),
+            'volumeSize': size,
+            'volumeSnapReserve': snap_reserve,
+            'post_date': post_date
+        }
+        if index in used:
+            doc['volumeUsed'] = used[index]
+            doc['volumeRatio'] = used[index] / size * 100.0 \
+                if size > 0.0 else 0.0
+        if send:
+            SINK.send(url, doc)
+        count += 1
+
+    return count
+
+
+def counter_rate(key, value, now):
+    """
+    Returns the rate (per second) of a counter since its previous sample
+    in PERF_STATE, or None without a previous sample or after a reset.
+    A counter lower than its previous sample wrapped if it fits in 32
+    bits and the wrap gives less than half its range, otherwise the
+    counter was reset (ex: member restarted).
+    """
+
+    previous = PERF_STATE.get(key)
+    PERF_STATE[key] = [now, value]
+    if previous is None or now <= previous[0]:
+        return None
+
+    delta = value - previous[1]
+    if delta < 0:
+        if previous[1] >= 2 ** 32 or value >= 2 ** 32:
+            return None
+        delta += 2 ** 32
+        if delta > 2 ** 31:
+            return None
+
+    return delta / (now - previous[0])
+
+
+def counters_rates(host, index, counters, values, now):
+    """
+    Returns the rates {"stat": rate} of the counters of a pool or member,
+    None if they can't be computed yet. Bytes rates are in Mib/s.
+    """
+
+    rates = {}
+    for (stat, oid), value in zip(counters, values):
+        rates[stat] = counter_rate(host + "/" + oid + "." + index,
+                                   int(value), now)
+    if None in list(rates.values()):
+        return None
+
+    for stat in rates:
+        if stat.endswith("Throughput"):
+            rates[stat] = rates[stat] / 1024.0 / 1024.0
+
+    return rates
+
+
+def get_perf_on_pools(host, records):
+    """
+    Fetches the I/O counters of the pools in one GETBULK walk and stores
+    their rates in the records {"oid pool": SanStats}.
+    """
+
+    now = time()
+    for index, values in bulk_walk(host, [oid for stat, oid
+                                          in POOL_COUNTERS]):
+        if index not in records:
+            continue
+        try:
+            rates = counters_rates(host, index, POOL_COUNTERS, values, now)
+        except ValueError:
+            logging.warning("Bad I/O counters for pool " +
+                            records[index].name + " on " + host)
+            continue
+        if rates is not None:
+            for stat, rate in list(rates.items()):
+                records[index][stat] = rate
+            records[index].perf = True
+
+
+def get_perf_on_all_members(host, cluster, datacenter, send):
+    """
+    Fetches the I/O counters of the members of a SAN group in one
+    GETBULK walk. Returns the documents of the members with rates;
+    if "send" is True, sends them to the ELK stack.
+    """
+
+    now = time()
+    url = write_url(CONF, MEMBERS_INDEX)
+    res = []
+
+    for index, values in bulk_walk(host, [MEMBER_NAME_OID] +
+                                   [oid for stat, oid in MEMBER_COUNTERS]):
+        try:
+            rates = counters_rates(host, index, MEMBER_COUNTERS, values[1:],
+                                   now)
+        except ValueError:
+            logging.warning("Bad I/O counters for member " + values[0] +
+                            " on " + host)
+            continue
+        if rates is None:
+            continue
+        doc = {'name': values[0], 'host': host, 'cluster': cluster,
+               'datacenter': datacenter,
+               'post_date': datetime.datetime.now().isoformat()}
+        doc.update(rates)
+        if send:
+            SINK.send(url, doc)
+        res.append(doc)
+
+    return res
+
+
 def list_pools(host):
     """
     Lists pools in a given SAN group (host).
@@ -148,7 +501,7 @@ def list_pools(host):
     """
 
     res = {}
-    pools = walk(host, '1.3.6.1.4.1.12740.16.1.1.1.3.1')
+    pools = walk(host, POOL_NAME_OID)
 
     for pool in pools:
         name = str(pool).split('=')[1].strip()
@@ -158,209 +511,284 @@ def list_pools(host):
     return res
 
 
-def get_stat_on_pools(host, pools, oid, to_gib):
+def get_stat_on_pools(host, records, stat, oid, to_gib):
     """
-    Fetches a specific stat of identified by the "oid" parameter
-    on given dict {"oid pool", "name"} of pools.
-    Returns a dict {"oid pool", "value"} with this stat.
-    If "toGib" is True, parse it from Kib to Gib.
+    Fetches a specific stat identified by the "oid" parameter on given
+    dict {"oid pool", SanStats} of pools, and stores it in their records.
+    If "to_gib" is True, parse it from Mib to Gib.
     """
 
-    res = {}
-
-    for oid_num in list(pools.items()):
+    for oid_num, record in list(records.items()):
         value = get(host, oid + str(oid_num))
-        if to_gib:
-            value = mib_to_gib(value)
-        res[str(oid_num)] = value
-
-    return res
+        if value is None:
+            logging.warning("No " + stat + " for pool " + record.name +
+                            " on " + host)
+            continue
+        record[stat] = mib_to_gib(value) if to_gib else float(value)
 
 
 def get_stats_on_all_pools(host, cluster, datacenter, send):
     """
     Fetches all stats on all pools on a given SAN group "host".
-    Returns an array of dicts [{"oid pool", {"stat name", "value}}].
+    Returns a list of SanStats, one per pool.
     If "send" is True, send these to the ELK stack.
     """
 
-    pools = list_pools(host)
+    records = {}
+    for oid_num, pool in list(list_pools(host).items()):
+        records[oid_num] = SanStats(pool, host, cluster, datacenter)
+
+    for stat, oid, to_gib in POOL_STATS:
+        get_stat_on_pools(host, records, stat, oid, to_gib)
+    if SAN_PERF:
+        get_perf_on_pools(host, records)
 
-    # data is a 2 dimension dictionnary structured as below :
-    # data{StatName}{oid_numPool}
-    data = {}
-    data['SANCountVol'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.16.1.",
-                          False)
-    data['SANTotalVol'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.1.1.",
-                          True)
-    data['SANFreeVol'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.3.1.",
-                          True)
-    data['SANTotalReplication'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.4.1.",
-                          True)
-    data['SANUsedReplication'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.5.1.",
-                          True)
-    data['SANFreeReplication'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.6.1.",
-                          True)
-    data['SANReservedSnapshot'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.9.1.",
-                          True)
-    data['SANUsedSnapshot'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.10.1.",
-                          True)
-    data['SANTotalDelegatedSpace'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.17.1.",
-                          True)
-    data['SANUsedDelegatedSpace'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.18.1.",
-                          True)
-    data['SANAllocatedVolSpace'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.21.1.",
-                          True)
-    data['SANFreeThinProv'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.23.1.",
-                          True)
-    data['SANFreeSnaphot'] = \
-        get_stat_on_pools(host, pools,
-                          "1.3.6.1.4.1.12740.16.1.2.1.25.1.",
-                          True)
-
-    # Process used volume and ratio form fetched stats to avoid
-    # doing this with scripted fields in the ELK stack.
-    data['SANUsedVol'] = {}
-    data['SANVolRatio'] = {}
-    data['SANPoolsUsage'] = {}
-
-    for oid_num in list(data['SANTotalVol'].items()):
-        data['SANUsedVol'][oid_num] = \
-            float(data['SANTotalVol'][oid_num] - data['SANFreeVol'][oid_num])
-        data['SANVolRatio'][oid_num] = \
-            float(data['SANUsedVol'][oid_num] / data['SANTotalVol'][oid_num] *
-                  100.0)
+    for oid_num, record in list(records.items()):
+        # Process used volume form fetched stats to avoid
+        # doing this with scripted fields in the ELK stack.
+        record['SANUsedVol'] = record['SANTotalVol'] - record['SANFreeVol']
 
         # If there aren't any volumes on a pool, this pool is considered
         # dedicated to the replication.
-        if int(data['SANCountVol'][oid_num]) > 0:
-            data['SANPoolsUsage'][oid_num] = "storage"
+        if record['SANCountVol'] > 0:
+            record.usage = "storage"
         else:
-            data['SANPoolsUsage'][oid_num] = "replication"
-
-    # Construct the result array from fetched data.
-    # Send these data to the ELK stack if needed.
-    res = []
+            record.usage = "replication"
 
-    for oid_num, pool in list(pools.items()):
-        pool_data = {}
-        pool_data['name'] = pool
-        pool_data['host'] = host
-        pool_data['cluster'] = cluster
-        pool_data['datacenter'] = datacenter
-        for data_name, data_pools in list(data.items()):
-            pool_data[data_name] = data_pools[oid_num]
         if send:
-            send_to_elk(ELK_URL + "/" + MAIN_INDEX + "/" + POOLS_INDEX,
-                        pool_data)
-        res.append(pool_data)
+            send_to_elk(write_url(CONF, POOLS_INDEX), record)
+            if LATEST_STATE:
+                send_to_elk(latest_url(CONF, POOLS_INDEX,
+                                       host + "-" + oid_num), record)
+
+    return list(records.values())
+
+
+def agg_stats(records, res):
+    """
+    Aggregates (sum) the stats of the given records (for host, cluster
+    and dc) in the record "res" to avoid doing it in the ELK stack.
+    The I/O rates are only published if they were measured on all the
+    records, unmeasured ones would count as 0 in the sums.
+    Returns "res".
+    """
+
+    values = res.values
+    for record in records:
+        for index, value in enumerate(record.values):
+            values[index] += value
+    res.perf = bool(records) and all(record.perf for record in records)
 
     return res
 
 
-def is_aggretable_stat(stat_name):
-    """ Do we want to aggregate this stat in host, cluster and dc ? """
+def exlude_replication_pools(pools_data):
+    """
+    Returns a list without pools only used for replication.
+    """
 
-    return stat_name not in ('name', 'host', 'cluster',
-                             'datacenter', 'SANPoolsUsage')\
-        and 'Ratio' not in stat_name
+    return [record for record in pools_data if record.usage != "replication"]
 
 
-def agg_stats(data):
+def load_breakers():
     """
-    Aggregates (sum) all given data (for host, cluster and dc)
-    to avoid doing it in the ELK stack.
-    Returns a dict {"stat name", "value"} with aggregated stats.
+    Loads the circuit breakers state of the SAN groups :
+    {"host": {"failures": count, "open_until": epoch}}.
     """
 
-    res = {}
+    try:
+        with open(SAN_BREAKER_STATE) as state_file:
+            return json.load(state_file)
+    except (OSError, IOError, ValueError):
+        return {}
 
-    if data:
-        for stat_name  in list(data[0].items()):
-            if is_aggretable_stat(stat_name):
-                res[stat_name] = 0.0
-                for entry in data:
-                    if stat_name in entry:
-                        res[stat_name] += float(entry[stat_name])
 
-    return res
+def load_perf_state():
+    """
+    Loads the previous samples of the I/O counters :
+    {"host/oid": [epoch, value]}.
+    """
 
+    try:
+        with open(SAN_PERF_STATE) as state_file:
+            return json.load(state_file)
+    except (OSError, IOError, ValueError):
+        return {}
 
-def exlude_replication_pools(pools_data):
+
+def save_perf_state():
     """
-    Returns an array without pools only used for replication.
+    Saves the samples of the I/O counters for the next run, those of
+    the last day only.
     """
 
-    data = []
+    oldest = time() - 24 * 3600
+    try:
+        os.makedirs(os.path.dirname(SAN_PERF_STATE), exist_ok=True)
+        with open(SAN_PERF_STATE + ".tmp", "w") as state_file:
+            json.dump(dict((key, sample) for key, sample
+                           in list(PERF_STATE.items())
+                           if sample[0] > oldest), state_file)
+        os.rename(SAN_PERF_STATE + ".tmp", SAN_PERF_STATE)
+    except (OSError, IOError):
+        logging.warning("Error while saving I/O counters state." +
+                        traceback.format_exc())
+
 
-    for entry in pools_data:
-        if entry['SANPoolsUsage'] != "replication":
-            data.append(entry.copy())
+def save_breakers():
+    """ Saves the circuit breakers state for the next runs. """
 
-    return data
+    try:
+        os.makedirs(os.path.dirname(SAN_BREAKER_STATE), exist_ok=True)
+        with open(SAN_BREAKER_STATE + ".tmp", "w") as state_file:
+            json.dump(BREAKERS, state_file)
+        os.rename(SAN_BREAKER_STATE + ".tmp", SAN_BREAKER_STATE)
+    except (OSError, IOError):
+        logging.warning("Error while saving circuit breakers state." +
+                        traceback.format_exc())
 
 
-def get_stats_on_all_hosts(data, cluster, datacenter, send):
+def breaker_open(host):
+    """ Should the polling of this SAN group be skipped ? """
+
+    return BREAKERS.get(host, {}).get('open_until', 0) > time()
+
+
+def breaker_failure(host):
     """
-    Fetches stats on all hosts in a given cluster.
-    Returns an array of a dict [{"host name", {"stat name", "value"}}];
-    If "send" is True, sends these stats on the ELK stack.
+    Counts a failed polling of a SAN group. After BREAKER_THRESHOLD
+    failures in a row, the group is skipped for a backoff doubling at
+    each new failure, up to BREAKER_MAX_BACKOFF seconds.
     """
 
-    res = []
+    entry = BREAKERS.setdefault(host, {'failures': 0, 'open_until': 0})
+    entry['failures'] += 1
+    if entry['failures'] >= BREAKER_THRESHOLD:
+        backoff = min(BREAKER_BACKOFF *
+                      2 ** (entry['failures'] - BREAKER_THRESHOLD),
+                      BREAKER_MAX_BACKOFF)
+        entry['open_until'] = time() + backoff
+    save_breakers()
+
+
+def breaker_success(host):
+    """ Closes the circuit breaker of a SAN group. """
+
+    if host in BREAKERS:
+        del BREAKERS[host]
+        save_breakers()
+
+
+def stale_host_data(host, cluster, datacenter):
+    """ Returns the record of a SAN group which couldn't be polled. """
+
+    host_data = SanStats(host, cluster=cluster, datacenter=datacenter)
+    host_data.stale = True
+
+    return host_data
+
+
+def host_stats(pools_data, host, cluster, datacenter):
+    """
+    Aggregates the pools of a SAN group into the host record,
+    pools dedicated to the replication excluded.
+    """
+
+    # If an host is dedicated to the replication, its stats are 0.0
+    host_data = SanStats(host, cluster=cluster, datacenter=datacenter)
+    host_data.stale = False
+    agg_stats(exlude_replication_pools(pools_data), host_data)
+    # Measured if all its pools are, so a group dedicated to the
+    # replication still publishes its (null) rates
+    host_data.perf = bool(pools_data) and \
+        all(pool_data.perf for pool_data in pools_data)
+
+    # subtract 5% of free vol on each SAN to
+    # prevent performance degradation
+    host_data['SANFreeVol'] = host_data['SANFreeVol'] - \
+        (host_data['SANTotalVol'] * 5.0 / 100.0)
+
+    return host_data
+
+
+def cluster_stats(hosts_data, cluster, datacenter):
+    """
+    Aggregates the host records of a cluster into the cluster record,
+    stale hosts excluded.
+    """
+
+    fresh_data = [host_data for host_data in hosts_data
+                  if not host_data.stale]
+    cluster_data = SanStats(cluster, datacenter=datacenter)
+    # Number of SAN groups not counted in these stats
+    cluster_data.stale_groups = len(hosts_data) - len(fresh_data)
+
+    return agg_stats(fresh_data, cluster_data)
+
+
+def datacenter_stats(clusters_data, datacenter):
+    """ Aggregates the cluster records of a datacenter. """
+
+    dc_data = SanStats(datacenter)
+    dc_data.stale_groups = sum(cluster_data.stale_groups
+                               for cluster_data in clusters_data)
 
-    for host in data[datacenter][cluster]:
-        pools_data = get_stats_on_all_pools(host, cluster, datacenter, True)
-        pools_data = exlude_replication_pools(pools_data)
-        host_data = agg_stats(pools_data)
-        host_data['name'] = host
-        host_data['cluster'] = cluster
-        host_data['datacenter'] = datacenter
-        if 'SANUsedVol' in host_data and 'SANTotalVol' in host_data:
-            host_data['SANVolRatio'] = float(host_data['SANUsedVol'] /
-                                             host_data['SANTotalVol'] * 100.0)
+    return agg_stats(clusters_data, dc_data)
+
+
+def poll_host(host, cluster, datacenter, send):
+    """
+    Fetches the stats of a SAN group, or returns a stale record if it
+    can't be polled. If "send" is True, sends its record on the ELK stack.
+    """
+
+    if breaker_open(host):
+        logging.warning("Circuit breaker open on " + host +
+                        ", its data is stale.")
+        host_data = stale_host_data(host, cluster, datacenter)
+    else:
+        BUDGET_ENDS[host] = monotonic() + SNMP_BUDGET
+        try:
+            pools_data = get_stats_on_all_pools(host, cluster, datacenter,
+                                                True)
+        except SanUnreachable as error:
+            logging.warning("Error while polling " + str(error) +
+                            ", its data is stale.")
+            breaker_failure(host)
+            host_data = stale_host_data(host, cluster, datacenter)
         else:
-            # If an host is dedicated to the replication, its stats are 0.0
-            host_data['SANVolRatio'] = 0.0
-            host_data['SANTotalVol'] = 0.0
-            host_data['SANUsedVol'] = 0.0
-            host_data['SANFreeVol'] = 0.0
+            breaker_success(host)
+            host_data = host_stats(pools_data, host, cluster, datacenter)
+            # The pools stats stand even if the volumes or the members
+            # can't be polled
+            if SAN_VOLUMES:
+                try:
+                    get_stats_on_all_volumes(host, cluster, datacenter, True)
+                except SanUnreachable as error:
+                    logging.warning("Error while polling the volumes of " +
+                                    str(error))
+            if SAN_PERF:
+                try:
+                    get_perf_on_all_members(host, cluster, datacenter, True)
+                except SanUnreachable as error:
+                    logging.warning("Error while polling the members of " +
+                                    str(error))
+
+    if send:
+        send_to_elk(write_url(CONF, HOSTS_INDEX), host_data)
+
+    return host_data
 
-        # subtract 5% of free vol on each SAN to
-        # prevent performance degradation
-        host_data['SANFreeVol'] = host_data['SANFreeVol'] - \
-            (host_data['SANTotalVol'] * 5.0 / 100.0)
 
-        if send:
-            send_to_elk(ELK_URL + "/" + MAIN_INDEX + "/" + HOSTS_INDEX,
-                        host_data)
-        res.append(host_data)
+def get_stats_on_all_hosts(data, cluster, datacenter, send):
+    """
+    Fetches stats on all hosts in a given cluster.
+    Returns an array of a dict [{"host name", {"stat name", "value"}}];
+    If "send" is True, sends these stats on the ELK stack.
+    """
 
-    return res
+    return [poll_host(host, cluster, datacenter, send)
+            for host in data[datacenter][cluster]]
 
 
 def get_stats_on_all_clusters(data, datacenter, send):
@@ -374,16 +802,9 @@ def get_stats_on_all_clusters(data, datacenter, send):
 
     for cluster in data[datacenter]:
         hosts_data = get_stats_on_all_hosts(data, cluster, datacenter, True)
-        cluster_data = agg_stats(hosts_data)
-        cluster_data['name'] = cluster
-        cluster_data['datacenter'] = datacenter
-        if 'SANUsedVol' in cluster_data and 'SANTotalVol' in cluster_data:
-            cluster_data['SANVolRatio'] = \
-                float(cluster_data['SANUsedVol'] /
-                      cluster_data['SANTotalVol'] * 100.0)
+        cluster_data = cluster_stats(hosts_data, cluster, datacenter)
         if send:
-            send_to_elk(ELK_URL + "/" + MAIN_INDEX + "/" + CLUSTERS_INDEX,
-                        cluster_data)
+            send_to_elk(write_url(CONF, CLUSTERS_INDEX), cluster_data)
         res.append(cluster_data)
 
     return res
@@ -400,14 +821,87 @@ def get_stats_on_all_datacenters(data, send):
 
     for datacenter in data:
         cluster_data = get_stats_on_all_clusters(data, datacenter, True)
-        dc_data = agg_stats(cluster_data)
-        dc_data['name'] = datacenter
-        if 'SANUsedVol' in dc_data and 'SANTotalVol' and dc_data:
-            dc_data['SANVolRatio'] = \
-                float(dc_data['SANUsedVol'] /
-                      dc_data['SANTotalVol'] * 100.0)
+        dc_data = datacenter_stats(cluster_data, datacenter)
         if send:
-            send_to_elk(ELK_URL + "/" + MAIN_INDEX + "/" + DC_INDEX, dc_data)
+            send_to_elk(write_url(CONF, DC_INDEX), dc_data)
+        res.append(dc_data)
+
+    return res
+
+
+def poll_shard(data, worker):
+    """
+    Fetches and sends the stats of the SAN groups owned by this worker
+    on the ring of the live workers, and saves their records for the
+    merge step. Groups locked by another worker are skipped.
+    Returns the records of the polled groups.
+    """
+
+    heartbeat(SHARDS_DIR, worker)
+    workers = live_workers(SHARDS_DIR, SHARDS_TTL)
+    if worker not in workers:
+        workers.append(worker)
+    ring = hash_ring(workers, SHARDS_VNODES)
+    logging.info("Shard " + worker + " of " + str(len(workers)) +
+                 " workers : " + ", ".join(workers))
+
+    res = []
+
+    for datacenter in data:
+        for cluster in data[datacenter]:
+            for host in data[datacenter][cluster]:
+                if ring_owner(ring, host) != worker:
+                    continue
+                lock = try_lock(SHARDS_DIR, host)
+                if lock is None:
+                    logging.info(host + " is polled by another worker.")
+                    continue
+                try:
+                    res.append(poll_host(host, cluster, datacenter, True))
+                finally:
+                    lock.close()
+
+    save_results(SHARDS_DIR, worker,
+                 [host_data.to_doc() for host_data in res])
+
+    return res
+
+
+def merge_shards(data, send):
+    """
+    Aggregates the host records saved by the workers into the clusters
+    and datacenters stats. A host missing from the results younger
+    than SHARDS_TTL is counted as stale.
+    Returns the datacenters records; if "send" is True, sends the
+    clusters and datacenters stats on the ELK stack.
+    """
+
+    # The most recent result of each host wins
+    hosts = {}
+    for doc in load_results(SHARDS_DIR, SHARDS_TTL):
+        hosts[doc['name']] = SanStats.from_doc(doc)
+
+    res = []
+
+    for datacenter in data:
+        clusters_data = []
+        for cluster in data[datacenter]:
+            hosts_data = []
+            for host in data[datacenter][cluster]:
+                if host not in hosts:
+                    logging.warning("No recent result for " + host +
+                                    ", its data is stale.")
+                    hosts_data.append(stale_host_data(host, cluster,
+                                                      datacenter))
+                else:
+                    hosts_data.append(hosts[host])
+            cluster_data = cluster_stats(hosts_data, cluster, datacenter)
+            if send:
+                send_to_elk(write_url(CONF, CLUSTERS_INDEX), cluster_data)
+            clusters_data.append(cluster_data)
+        dc_data = datacenter_stats(clusters_data, datacenter)
+        if send:
+            send_to_elk(write_url(CONF, DC_INDEX), dc_data)
         res.append(dc_data)
 
     return res
@@ -437,6 +931,17 @@ def parse_conf():
 
 
 if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Send the SNMP stats of the SANs.")
+    add_sink_arguments(PARSER)
+    PARSER.add_argument("--worker",
+                        help="only poll the SAN groups of this worker "
+                        "on the ring of the live workers")
+    PARSER.add_argument("--merge", action="store_true",
+                        help="aggregate the results of the workers into "
+                        "the clusters and datacenters stats")
+    ARGS = PARSER.parse_args()
+
     CONF = parse_conf()
 
     LOGFILE = CONF['logs']
@@ -446,12 +951,51 @@ if __name__ == "__main__":
     HOSTS_INDEX = CONF['indexes']['san_hosts']
     DC_INDEX = CONF['indexes']['san_dc']
     CLUSTERS_INDEX = CONF['indexes']['san_clusters']
+    VOLUMES_INDEX = CONF['indexes'].get('san_volumes', "sanvolume")
+    MEMBERS_INDEX = CONF['indexes'].get('san_members', "sanmember")
+    SAN_PERF = bool(CONF.get('san_perf', False))
+    SAN_PERF_STATE = CONF.get('san_perf_state',
+                              "/tmp/capacity_planning/san_perf.json")
+    SAN_VOLUMES = bool(CONF.get('san_volumes', False))
+    LATEST_STATE = bool(CONF.get('latest_state', False))
+    SNMP_MAX_REPETITIONS = int(CONF.get('snmp_max_repetitions', 50))
     SNMP_COMMUNITY = CONF['snmp_community']
+    SNMP_PORT = int(CONF.get('snmp_port', 161))
     MAP_SAN = CONF['san']
+    SNMP_TIMEOUT = float(CONF.get('snmp_timeout', 1))
+    SNMP_RETRIES = int(CONF.get('snmp_retries', 1))
+    SNMP_BUDGET = float(CONF.get('san_group_budget', 60))
+    BREAKER_THRESHOLD = int(CONF.get('san_breaker_threshold', 3))
+    BREAKER_BACKOFF = float(CONF.get('san_breaker_backoff', 300))
+    BREAKER_MAX_BACKOFF = float(CONF.get('san_breaker_max_backoff', 3600))
+    SAN_BREAKER_STATE = CONF.get('san_breaker_state',
+                                 "/tmp/capacity_planning/san_breakers.json")
+    SHARDS_CONF = CONF.get('san_shards', {})
+    SHARDS_DIR = SHARDS_CONF.get('state_dir',
+                                 "/tmp/capacity_planning/san_shards")
+    SHARDS_VNODES = int(SHARDS_CONF.get('vnodes', DEFAULT_VNODES))
+    SHARDS_TTL = float(SHARDS_CONF.get('ttl', 900))
+    if ARGS.worker:
+        # Each worker keeps the breakers of the groups it polls
+        SAN_BREAKER_STATE = os.path.join(SHARDS_DIR, "breakers",
+                                         ARGS.worker + ".json")
+        SAN_PERF_STATE = os.path.join(SHARDS_DIR, "perf",
+                                      ARGS.worker + ".json")
+    BREAKERS = load_breakers()
+    PERF_STATE = load_perf_state() if SAN_PERF else {}
+    SINK = open_sink(CONF, ARGS)
 
     LOGFILE = LOGFILE + ".log"
     logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
     logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
                      " : Starting capacity planning script."))
 
-    get_stats_on_all_datacenters(MAP_SAN, True)
+    if ARGS.worker:
+        poll_shard(MAP_SAN, ARGS.worker)
+    if ARGS.merge:
+        merge_shards(MAP_SAN, True)
+    if not ARGS.worker and not ARGS.merge:
+        get_stats_on_all_datacenters(MAP_SAN, True)
+    if SAN_PERF:
+        save_perf_state()
+    SINK.close()
@@ -0,0 +1,303 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+What-if engine for the overcommit policy of the hypervisors.
+
+From the raw facts of each hypervisor (pCPU, pRAMtotal, vCPUallocated,
+vRAMallocated) it computes, for every cluster and every combination of
+CPU overcommit, RAM overcommit and VM mix of the scenarios file, the
+free vCPU/vRAM, the CPU/RAM ratios and how many VMs still fit.
+All the scenarios are computed at once with numpy arrays.
+
+Scenarios file (JSON) :
+{
+    "cpu_overcommit": [100, 200, 400],
+    "ram_overcommit": [100, 120, 150],
+    "vm_mixes": [{"name": "web", "types": {"small": 0.8, "large": 0.2}}]
+}
+The VM types are the "vm_type" of the conf file. Results are written as
+one JSON document per (cluster, scenario).
+"""
+
+import sys
+import json
+import logging
+import argparse
+import traceback
+from time import gmtime, strftime, time
+import os
+import numpy
+import requests
+from capacity_planning_store import ColumnStore
+from capacity_planning_indices import search_url, type_filter, \
+    keyword_field
+
+
+# Raw facts of a hypervisor used by the scenarios.
+FACTS = ("pCPU", "pRAMtotal", "vCPUallocated", "vRAMallocated")
+
+
+def request(url, json_value):
+    """ Request values from ES. """
+
+    req = requests.get(url, data=json_value, timeout=30,
+                       headers={'Content-Type': 'application/json'})
+    if req.status_code != 200:
+        message = "Error while requesting " + url
+        logging.warning(str(message + " : " + str(req.content)))
+        sys.exit(message)
+
+    return json.loads(req.content)
+
+
+def host_facts_from_elk(conf):
+    """
+    Returns the hosts names, their cluster and a (hosts, FACTS) array
+    with the average of each fact over the last 24 hours.
+    """
+
+    hv_index = conf['indexes']['hv']
+    aggs = {'cluster': {'terms': {'field': keyword_field(conf, 'cluster'),
+                                  'size': 1}}}
+    for fact in FACTS:
+        aggs[fact] = {'avg': {'field': fact}}
+    search = {
+        'size': 0,
+        'query': {
+            'bool': {
+                'must': [{'term': filter_value}
+                         for filter_value in type_filter(conf, hv_index)],
+                'filter': {'range': {'post_date': {'gt': 'now-24h'}}}
+            }
+        },
+        'aggs': {
+            'hosts': {
+                'terms': {'field': keyword_field(conf, 'name'),
+                          'size': 100000},
+                'aggs': aggs
+            }
+        }
+    }
+
+    result = request(search_url(conf, hv_index), json.dumps(search))
+    names = []
+    clusters = []
+    facts = []
+    for bucket in result['aggregations']['hosts']['buckets']:
+        if not bucket['cluster']['buckets']:
+            continue
+        names.append(bucket['key'])
+        clusters.append(bucket['cluster']['buckets'][0]['key'])
+        facts.append([bucket[fact]['value'] or 0.0 for fact in FACTS])
+
+    return names, clusters, numpy.array(facts, dtype=float).reshape(-1,
+                                                                    len(FACTS))
+
+
+def host_facts_from_store(conf):
+    """ Same as host_facts_from_elk, from the local sample store. """
+
+    store = ColumnStore(conf['sample_store'])
+    hv_index = conf['indexes']['hv']
+    averages = store.averages_by_name(hv_index, FACTS,
+                                      start=time() - 24 * 3600)
+    names = []
+    clusters = []
+    facts = []
+    for cluster in store.attribute_values(hv_index, 'cluster'):
+        for name in store.entities(hv_index, cluster=cluster):
+            if name not in averages:
+                continue
+            names.append(name)
+            clusters.append(cluster)
+            facts.append([averages[name][fact] for fact in FACTS])
+
+    return names, clusters, numpy.array(facts, dtype=float).reshape(-1,
+                                                                    len(FACTS))
+
+
+def evaluate(clusters, facts, cpu_overcommit, ram_overcommit, mixes,
+             vm_types):
+    """
+    Evaluates all the scenarios.
+    "clusters" is the cluster of each host, "facts" a (hosts, FACTS)
+    array, "cpu_overcommit" and "ram_overcommit" lists of percents,
+    "mixes" a list of {"name", "types": {"vm type": share}} and
+    "vm_types" the vm_type list of the conf file.
+    Returns the cluster names and a dict of arrays indexed by
+    [cluster, cpu overcommit, ram overcommit(, mix or vm type)].
+    """
+
+    cluster_names, cluster_ids = numpy.unique(numpy.array(clusters),
+                                              return_inverse=True)
+    # Sum the facts of the hosts of each cluster : (clusters, FACTS)
+    totals = numpy.zeros((len(cluster_names), len(FACTS)))
+    numpy.add.at(totals, cluster_ids, facts)
+    pcpu, pram, vcpu_alloc, vram_alloc = [totals[:, i][:, None, None]
+                                          for i in range(len(FACTS))]
+
+    cpu_ratio = numpy.asarray(cpu_overcommit, dtype=float)[None, :, None]
+    ram_ratio = numpy.asarray(ram_overcommit, dtype=float)[None, None, :]
+    shape = (len(cluster_names), cpu_ratio.shape[1], ram_ratio.shape[2])
+
+    cpu_capacity = pcpu * cpu_ratio / 100.0
+    ram_capacity = pram * ram_ratio / 100.0
+    res = {}
+    res['vCPUfree'] = numpy.broadcast_to(cpu_capacity - vcpu_alloc, shape)
+    res['vRAMfree'] = numpy.broadcast_to(ram_capacity - vram_alloc, shape)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        res['CPUratio'] = numpy.broadcast_to(
+            numpy.where(cpu_capacity > 0, vcpu_alloc / cpu_capacity * 100.0,
+                        0.0), shape)
+        res['RAMratio'] = numpy.broadcast_to(
+            numpy.where(ram_capacity > 0, vram_alloc / ram_capacity * 100.0,
+                        0.0), shape)
+
+    # Resources needed by each VM type : (types,)
+    types = [vm_type for vm_type in vm_types
+             if 'type' in vm_type and int(vm_type['cpu']) > 0 and
+             int(vm_type['ram']) > 0]
+    type_cpu = numpy.array([float(vm_type['cpu']) for vm_type in types])
+    type_ram = numpy.array([float(vm_type['ram']) for vm_type in types])
+
+    # A VM needs both its vCPU and its vRAM, so it fits if both fit.
+    cpu_free = numpy.maximum(res['vCPUfree'], 0.0)[..., None]
+    ram_free = numpy.maximum(res['vRAMfree'], 0.0)[..., None]
+    res['remaining_vm_type'] = numpy.floor(numpy.minimum(
+        cpu_free / type_cpu, ram_free / type_ram))
+
+    # A mix is a weighted average VM : (mixes,)
+    shares = numpy.array([[float(mix['types'].get(vm_type['type'], 0.0))
+                           for vm_type in types] for mix in mixes])
+    shares = shares.reshape(len(mixes), len(types))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        shares = shares / shares.sum(axis=1, keepdims=True)
+        mix_cpu = shares @ type_cpu
+        mix_ram = shares @ type_ram
+        res['remaining_vm_mix'] = numpy.nan_to_num(numpy.floor(numpy.minimum(
+            cpu_free / mix_cpu, ram_free / mix_ram)))
+
+    return cluster_names, [vm_type['type'] for vm_type in types], res
+
+
+def scenario_docs(cluster_names, type_names, res, cpu_overcommit,
+                  ram_overcommit, mixes):
+    """ Yields one document per cluster and scenario. """
+
+    for cluster_id, cluster in enumerate(cluster_names):
+        for cpu_id, cpu_ratio in enumerate(cpu_overcommit):
+            for ram_id, ram_ratio in enumerate(ram_overcommit):
+                index = (cluster_id, cpu_id, ram_id)
+                doc = {
+                    'name': str(cluster),
+                    'hv_cpu_overcommit': cpu_ratio,
+                    'hv_ram_overcommit': ram_ratio,
+                    'vCPUfree': float(res['vCPUfree'][index]),
+                    'vRAMfree': float(res['vRAMfree'][index]),
+                    'CPUratio': float(res['CPUratio'][index]),
+                    'RAMratio': float(res['RAMratio'][index]),
+                }
+                for type_id, type_name in enumerate(type_names):
+                    doc['remaining_vm_type_' + type_name] = \
+                        int(res['remaining_vm_type'][index + (type_id,)])
+                for mix_id, mix in enumerate(mixes):
+                    doc['remaining_vm_mix_' + mix['name']] = \
+                        int(res['remaining_vm_mix'][index + (mix_id,)])
+                yield doc
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Evaluate overcommit and VM mix scenarios.")
+    PARSER.add_argument("scenarios", help="JSON scenarios file")
+    PARSER.add_argument("--source", choices=("elk", "store"), default="elk",
+                        help="where the hypervisors facts are read")
+    PARSER.add_argument("--output", help="output file (default: stdout)")
+    ARGS = PARSER.parse_args()
+
+    CONF = parse_conf()
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning scenarios script."))
+
+    try:
+        with open(ARGS.scenarios) as SCENARIOS_FILE:
+            SCENARIOS = json.load(SCENARIOS_FILE)
+    except (OSError, IOError, ValueError):
+        sys.exit("Error while loading scenarios file." +
+                 traceback.format_exc())
+
+    CPU_OVERCOMMIT = SCENARIOS.get('cpu_overcommit',
+                                   [float(CONF['hv_cpu_overcommit'])])
+    RAM_OVERCOMMIT = SCENARIOS.get('ram_overcommit',
+                                   [float(CONF['hv_ram_overcommit'])])
+    MIXES = SCENARIOS.get('vm_mixes', [])
+
+    if ARGS.source == "store":
+        NAMES, CLUSTERS, FACTS_ARRAY = host_facts_from_store(CONF)
+    else:
+        NAMES, CLUSTERS, FACTS_ARRAY = host_facts_from_elk(CONF)
+    if not NAMES:
+        sys.exit("No hypervisor found.")
+
+    CLUSTER_NAMES, TYPE_NAMES, RESULTS = evaluate(
+        CLUSTERS, FACTS_ARRAY, CPU_OVERCOMMIT, RAM_OVERCOMMIT, MIXES,
+        CONF['vm_type'])
+
+    OUTPUT = open(ARGS.output, "w") if ARGS.output else sys.stdout
+    for DOC in scenario_docs(CLUSTER_NAMES, TYPE_NAMES, RESULTS,
+                             CPU_OVERCOMMIT, RAM_OVERCOMMIT, MIXES):
+        OUTPUT.write(json.dumps(DOC) + "\n")
+    if ARGS.output:
+        OUTPUT.close()
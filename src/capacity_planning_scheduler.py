@@ -0,0 +1,267 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+"""
+Scheduler running the collectors and the rollups of a node.
+
+Instead of every node running its collectors from cron at the same
+minute, each job runs once per "interval" seconds at an offset derived
+from the FQDN of the node and the name of the job, plus a random jitter.
+The offsets of the collectors are spread over the first "collect_window"
+seconds of the interval, the rollups run after this window so they see
+the samples of every node. A job still running from the previous
+interval is skipped.
+
+    "schedule": {
+        "interval": 600,
+        "collect_window": 420,
+        "jitter": 30,
+        "jobs": [
+            {"name": "hypervisors", "phase": "collect",
+             "command": ["capacity_planning_hypervisors.py"]},
+            {"name": "total_hypervisors", "phase": "rollup",
+             "command": ["capacity_planning_total_hypervisors.py"]}
+        ]
+    }
+"""
+
+import os
+import sys
+import json
+import fcntl
+import random
+import signal
+import socket
+import hashlib
+import logging
+import argparse
+import traceback
+from subprocess import Popen
+from time import gmtime, strftime, time, sleep
+
+
+PHASES = ('collect', 'rollup')
+
+
+def phase_offset(fqdn, name, window):
+    """
+    Returns the offset (seconds, in [0, window)) of a job on a node.
+    It only depends on the FQDN and the job name, so a node keeps its
+    offsets from one run to the other and nodes are spread evenly.
+    """
+
+    digest = hashlib.sha1((fqdn + "/" + name).encode()).hexdigest()
+
+    return int(digest[:13], 16) / float(16 ** 13) * window
+
+
+class Job(object):
+    """ A command run once per interval at a fixed offset. """
+
+    def __init__(self, name, command, offset):
+        self.name = name
+        self.command = command
+        self.offset = offset
+        self.process = None
+        self.lock = None
+        self.cycle = None
+        self.next_run = 0.0
+
+    def schedule(self, now, interval, jitter):
+        """
+        Sets the next run of the job : in the interval following its
+        last run, or the first offset still to come at start up.
+        Intervals are aligned on the epoch so that all the nodes share
+        them; missed intervals aren't caught up.
+        """
+
+        if self.cycle is None:
+            self.cycle = now - now % interval
+            if self.cycle + self.offset < now:
+                self.cycle += interval
+        else:
+            self.cycle = max(self.cycle + interval, now - now % interval)
+        self.next_run = self.cycle + self.offset + random.uniform(0, jitter)
+
+    def start(self, lock_dir):
+        """
+        Starts the job unless its previous run is still going
+        (here or in another scheduler). Returns True if started.
+        Raises OSError if the command can't be launched.
+        """
+
+        if self.process is not None:
+            return False
+
+        os.makedirs(lock_dir, exist_ok=True)
+        lock = open(os.path.join(lock_dir, self.name + ".lock"), "w")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock.close()
+            return False
+
+        # The command inherits the lock : a restarted scheduler doesn't
+        # start the job again while a run left by the previous one goes on
+        try:
+            self.process = Popen(self.command, pass_fds=[lock.fileno()])
+        except OSError:
+            lock.close()
+            raise
+        self.lock = lock
+
+        return True
+
+    def reap(self):
+        """ Releases the lock of the job once its run is over. """
+
+        if self.process is None or self.process.poll() is None:
+            return
+
+        if self.process.returncode != 0:
+            logging.warning(self.name + " exited with code " +
+                            str(self.process.returncode))
+        self.process = None
+        self.lock.close()
+        self.lock = None
+
+
+def make_jobs(schedule, fqdn, location):
+    """ Returns the jobs of the "schedule" section of the conf file. """
+
+    interval = float(schedule.get('interval', 600))
+    collect_window = float(schedule.get('collect_window', interval * 0.7))
+    jitter = float(schedule.get('jitter', 30))
+    # The rollups start after the jitter of the collectors and end,
+    # their own jitter included, before the next interval
+    rollup_window = interval - collect_window - 2 * jitter
+    if collect_window <= 0 or rollup_window <= 0:
+        sys.exit("Error while parsing conf file : the collect window and "
+                 "twice the jitter must be shorter than the interval.")
+
+    jobs = []
+    for entry in schedule.get('jobs', []):
+        if entry.get('phase', "collect") not in PHASES:
+            sys.exit("Error while parsing conf file : unknown phase " +
+                     entry['phase'])
+        if entry.get('phase', "collect") == "collect":
+            offset = phase_offset(fqdn, entry['name'], collect_window)
+        else:
+            # After the collectors of every node, jitter included
+            offset = collect_window + jitter + \
+                phase_offset(fqdn, entry['name'], rollup_window)
+        command = list(entry['command'])
+        if command[0].endswith(".py"):
+            command = [sys.executable, os.path.join(location, command[0])] + \
+                command[1:]
+        jobs.append(Job(entry['name'], command, offset))
+
+    return jobs
+
+
+def stop(signum, frame):
+    """ Stops the scheduler, running jobs go on holding their locks. """
+
+    sys.exit(0)
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Run the collectors and rollups of this node.")
+    PARSER.add_argument("--show", action="store_true",
+                        help="print the offsets of the jobs and exit")
+    ARGS = PARSER.parse_args()
+
+    CONF = parse_conf()
+    SCHEDULE = CONF.get('schedule', {})
+    INTERVAL = float(SCHEDULE.get('interval', 600))
+    JITTER = float(SCHEDULE.get('jitter', 30))
+    LOCK_DIR = SCHEDULE.get('lock_dir', "/tmp/capacity_planning/locks")
+    FQDN = SCHEDULE.get('fqdn', socket.getfqdn())
+    LOCATION = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+    JOBS = make_jobs(SCHEDULE, FQDN, LOCATION)
+    if not JOBS:
+        sys.exit("Error while parsing conf file : no schedule.jobs.")
+
+    if ARGS.show:
+        for JOB in sorted(JOBS, key=lambda job: job.offset):
+            print("%7.1fs  %s" % (JOB.offset, JOB.name))
+        sys.exit(0)
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning scheduler."))
+    signal.signal(signal.SIGTERM, stop)
+
+    for JOB in JOBS:
+        JOB.schedule(time(), INTERVAL, JITTER)
+
+    while True:
+        for JOB in JOBS:
+            JOB.reap()
+            if time() < JOB.next_run:
+                continue
+            try:
+                if JOB.start(LOCK_DIR):
+                    logging.info("Started " + JOB.name)
+                else:
+                    logging.warning("Skipped " + JOB.name +
+                                    " : its previous run is still going.")
+            except OSError:
+                logging.warning("Error while starting " + JOB.name +
+                                traceback.format_exc())
+            JOB.schedule(time(), INTERVAL, JITTER)
+        # Wake up at least every second to release the finished jobs
+        sleep(max(min(min(JOB.next_run for JOB in JOBS) - time(), 1.0), 0))
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+"""
+Sharding of a polling job across several workers (processes or nodes)
+sharing a state directory.
+
+Each worker touches a heartbeat file in <state dir>/workers at every
+run; the workers whose heartbeat is younger than "ttl" seconds form a
+consistent hash ring (several virtual nodes per worker), and each key
+(ex: a SAN group) belongs to the first worker after its hash on the
+ring. Adding or removing a worker only moves the keys of its virtual
+nodes. Each worker saves its results in <state dir>/results for a
+final merge step.
+"""
+
+import os
+import json
+import bisect
+import fcntl
+import hashlib
+from time import time
+
+
+DEFAULT_VNODES = 64
+
+
+def ring_hash(key):
+    """ Returns the position of a key on the ring. """
+
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+def hash_ring(workers, vnodes=DEFAULT_VNODES):
+    """ Returns the ring of the workers : sorted [(position, worker)]. """
+
+    return sorted((ring_hash(worker + "#" + str(vnode)), worker)
+                  for worker in workers for vnode in range(vnodes))
+
+
+def ring_owner(ring, key):
+    """ Returns the worker owning a key. """
+
+    index = bisect.bisect(ring, (ring_hash(key),))
+
+    return ring[index % len(ring)][1]
+
+
+def heartbeat(state_dir, worker):
+    """ Marks a worker as alive. """
+
+    path = os.path.join(state_dir, "workers")
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, worker), "w") as heartbeat_file:
+        heartbeat_file.write(str(time()))
+
+
+def live_workers(state_dir, ttl):
+    """ Returns the workers with a heartbeat younger than "ttl" seconds. """
+
+    path = os.path.join(state_dir, "workers")
+    try:
+        names = os.listdir(path)
+    except (OSError, IOError):
+        return []
+
+    res = []
+    for name in names:
+        try:
+            if os.path.getmtime(os.path.join(path, name)) > time() - ttl:
+                res.append(name)
+        except (OSError, IOError):
+            continue
+
+    return sorted(res)
+
+
+def try_lock(state_dir, key):
+    """
+    Locks a key for the current worker, so two workers with a different
+    view of the ring don't poll it together.
+    Returns the lock (to close once done) or None if already locked.
+    """
+
+    path = os.path.join(state_dir, "locks")
+    os.makedirs(path, exist_ok=True)
+    lock = open(os.path.join(path, key + ".lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+
+    return lock
+
+
+def save_results(state_dir, worker, results):
+    """ Saves the results (list of documents) of a worker. """
+
+    path = os.path.join(state_dir, "results")
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, worker + ".tmp"), "w") as results_file:
+        json.dump({'time': time(), 'results': results}, results_file)
+    os.rename(os.path.join(path, worker + ".tmp"),
+              os.path.join(path, worker + ".json"))
+
+
+def load_results(state_dir, ttl):
+    """
+    Returns the results of all the workers saved in the last "ttl"
+    seconds, the most recent last.
+    """
+
+    path = os.path.join(state_dir, "results")
+    try:
+        names = [name for name in os.listdir(path) if name.endswith(".json")]
+    except (OSError, IOError):
+        return []
+
+    shards = []
+    for name in names:
+        try:
+            with open(os.path.join(path, name)) as results_file:
+                shard = json.load(results_file)
+        except (OSError, IOError, ValueError):
+            continue
+        if shard['time'] > time() - ttl:
+            shards.append(shard)
+
+    res = []
+    for shard in sorted(shards, key=lambda shard: shard['time']):
+        res.extend(shard['results'])
+
+    return res
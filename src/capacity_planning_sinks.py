@@ -0,0 +1,358 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+"""
+Outputs of the documents of the capacity planning scripts.
+
+The sink is chosen with the "sink" section of capacityPlanning.json
+({"type": "elk"} by default) or with --sink on the command line :
+    elk     through the local relay if it is running, else _bulk requests
+    file    NDJSON file in the _bulk format, rotated by size
+    stdout  NDJSON in the _bulk format on the standard output
+    null    documents are dropped (benchmarks)
+    exporter the last samples are scraped from the local exporter
+Each document is serialized once, with orjson when it is installed,
+into the buffer of the sink.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import logging
+import threading
+import traceback
+from abc import ABC, abstractmethod
+from time import sleep
+import requests
+from capacity_planning_relay import relay_send, bulk_action, \
+    DEFAULT_RELAY_SOCKET
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+SINK_TYPES = ('elk', 'file', 'stdout', 'null', 'exporter')
+
+DEFAULT_EXPORTER_SOCKET = "/tmp/capacity_planning/exporter.sock"
+
+# Bytes buffered by the file and stdout sinks before being written.
+BUFFER_SIZE = 1024 * 1024
+
+# Statuses of the _bulk items rejected because ES is overloaded, sent
+# again up to BULK_RETRIES times with an exponential backoff.
+RETRY_STATUSES = (429, 503)
+BULK_RETRIES = 3
+
+
+def dumps(doc):
+    """ Serializes a document to JSON bytes. """
+
+    if orjson is not None:
+        return orjson.dumps(doc, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    return json.dumps(doc, separators=(',', ':')).encode()
+
+
+class Sink(ABC):
+    """
+    Where the documents posted to an ES url ("url/index/type") go.
+    Sinks can be shared by threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def send(self, url, doc):
+        """ Sends a document (dict) posted to "url". """
+
+        data = dumps(doc)
+        with self.lock:
+            self.write(url, data)
+            self.count += 1
+
+    @abstractmethod
+    def write(self, url, data):
+        """ Writes a serialized document. """
+
+    def flush(self):
+        """ Writes the buffered documents. """
+
+    def close(self):
+        """ Writes the buffered documents and releases the sink. """
+
+        with self.lock:
+            self.flush()
+
+
+class NullSink(Sink):
+    """ Drops the documents. """
+
+    def write(self, url, data):
+        pass
+
+
+class StreamSink(Sink):
+    """ Writes the documents in the _bulk format to a binary stream. """
+
+    def __init__(self, stream):
+        Sink.__init__(self)
+        self.stream = stream
+        self.buffer = bytearray()
+
+    def write(self, url, data):
+        self.buffer += dumps(bulk_action(url)[1])
+        self.buffer += b"\n"
+        self.buffer += data
+        self.buffer += b"\n"
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            self.stream.write(self.buffer)
+            self.stream.flush()
+            del self.buffer[:]
+
+
+class FileSink(StreamSink):
+    """
+    Appends the documents in the _bulk format to a NDJSON file, renamed
+    to path.1 (path.1 to path.2...) once it holds "max_bytes", keeping
+    "backups" old files. Several collectors can share the file.
+    """
+
+    def __init__(self, path, max_bytes, backups):
+        StreamSink.__init__(self, None)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def rotate(self):
+        """ Shifts the old files and renames the current one. """
+
+        for number in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.path + "." + str(number)):
+                os.rename(self.path + "." + str(number),
+                          self.path + "." + str(number + 1))
+        if self.backups > 0:
+            os.rename(self.path, self.path + ".1")
+        else:
+            os.unlink(self.path)
+
+    def flush(self):
+        while self.buffer:
+            with open(self.path, "ab") as ndjson:
+                fcntl.flock(ndjson, fcntl.LOCK_EX)
+                try:
+                    try:
+                        rotated = os.stat(self.path).st_ino != \
+                            os.fstat(ndjson.fileno()).st_ino
+                    except OSError:
+                        rotated = True
+                    if rotated:
+                        # Rotated by another collector while waiting
+                        continue
+                    if ndjson.tell() > 0 and \
+                       ndjson.tell() + len(self.buffer) > self.max_bytes:
+                        self.rotate()
+                        continue
+                    ndjson.write(self.buffer)
+                    ndjson.flush()
+                    del self.buffer[:]
+                finally:
+                    fcntl.flock(ndjson, fcntl.LOCK_UN)
+
+
+class ElkSink(Sink):
+    """
+    Sends the documents to the local relay if it is running, otherwise
+    to ES in _bulk requests of "batch_size" documents.
+    """
+
+    def __init__(self, relay_socket, batch_size):
+        Sink.__init__(self)
+        self.relay_socket = relay_socket
+        self.batch_size = batch_size
+        self.session = requests.Session()
+        self.buffers = {}
+        self.pending = 0
+
+    def write(self, url, data):
+        if relay_send(url, data.decode(), self.relay_socket):
+            return
+
+        base_url, action = bulk_action(url)
+        buffer = self.buffers.setdefault(base_url, bytearray())
+        buffer += dumps(action)
+        buffer += b"\n"
+        buffer += data
+        buffer += b"\n"
+        self.pending += 1
+        if self.pending >= self.batch_size:
+            self.flush()
+
+    def post_bulk(self, base_url, body):
+        """
+        Posts a _bulk body to ES. The documents rejected for good are
+        logged; returns the body of those to send again (ES overloaded).
+        """
+
+        try:
+            req = self.session.post(
+                base_url + "/_bulk", data=body, timeout=30,
+                headers={'Content-Type': 'application/x-ndjson'})
+        except requests.exceptions.RequestException:
+            message = "Error while sending data to elasticsearch at " + \
+                base_url
+            logging.warning(str(message + traceback.format_exc()))
+            sys.exit(message)
+        if req.status_code in RETRY_STATUSES:
+            return body
+        try:
+            result = json.loads(req.content)
+        except ValueError:
+            result = None
+        if req.status_code != 200 or not isinstance(result, dict):
+            logging.warning("Error in bulk response from " + base_url +
+                            " : " + str(req.content)[:1000])
+            return b""
+        if not result.get('errors'):
+            return b""
+
+        # One item per action, each action followed by its document
+        lines = body.split(b"\n")
+        retry = bytearray()
+        rejected = 0
+        error = None
+        for number, item in enumerate(result.get('items', [])):
+            status = list(item.values())[0].get('status', 200)
+            if status < 300:
+                continue
+            if status in RETRY_STATUSES:
+                retry += b"\n".join(lines[2 * number:2 * number + 2])
+                retry += b"\n"
+            else:
+                rejected += 1
+                error = list(item.values())[0].get('error')
+        if rejected:
+            logging.warning(str(rejected) + " documents rejected by " +
+                            base_url + ", last error : " +
+                            json.dumps(error)[:1000])
+
+        return bytes(retry)
+
+    def flush(self):
+        for base_url, buffer in list(self.buffers.items()):
+            if not buffer:
+                continue
+            body = bytes(buffer)
+            del buffer[:]
+            for attempt in range(BULK_RETRIES + 1):
+                if attempt:
+                    sleep(2 ** (attempt - 1))
+                body = self.post_bulk(base_url, body)
+                if not body:
+                    break
+            if body:
+                logging.warning(str(body.count(b"\n") // 2) +
+                                " documents lost, " + base_url +
+                                " is still overloaded after " +
+                                str(BULK_RETRIES) + " retries")
+        self.pending = 0
+
+
+class ExporterSink(Sink):
+    """
+    Hands the documents to the local exporter, which serves the last
+    samples to Prometheus instead of storing them in ES.
+    """
+
+    def __init__(self, exporter_socket):
+        Sink.__init__(self)
+        self.exporter_socket = exporter_socket
+        self.dropped = 0
+
+    def write(self, url, data):
+        if not relay_send(url, data.decode(), self.exporter_socket):
+            self.dropped += 1
+
+    def close(self):
+        Sink.close(self)
+        if self.dropped:
+            logging.warning(str(self.dropped) + " documents dropped, the " +
+                            "exporter isn't running on " +
+                            self.exporter_socket)
+
+
+def add_sink_arguments(parser):
+    """ Adds the options choosing the sink to an ArgumentParser. """
+
+    parser.add_argument("--sink", choices=SINK_TYPES,
+                        help="where the documents are sent "
+                             "(default: sink.type of the conf file)")
+    parser.add_argument("--sink-path",
+                        help="NDJSON file of the \"file\" sink")
+
+
+def open_sink(conf, args=None):
+    """
+    Returns the sink of the conf file, or of the command line
+    options added by add_sink_arguments.
+    """
+
+    sink_conf = conf.get('sink', {})
+    sink_type = sink_conf.get('type', "elk")
+    path = sink_conf.get('path', "/tmp/capacity_planning/documents.ndjson")
+    if args is not None and args.sink:
+        sink_type = args.sink
+    if args is not None and args.sink_path:
+        path = args.sink_path
+
+    if sink_type == "null":
+        return NullSink()
+    if sink_type == "stdout":
+        return StreamSink(sys.stdout.buffer)
+    if sink_type == "file":
+        return FileSink(path, int(sink_conf.get('max_bytes', 100 * 1024 ** 2)),
+                        int(sink_conf.get('backups', 5)))
+    if sink_type == "exporter":
+        return ExporterSink(conf.get('exporter', {}).get(
+            'socket', DEFAULT_EXPORTER_SOCKET))
+    if sink_type == "elk":
+        return ElkSink(conf.get('relay_socket', DEFAULT_RELAY_SOCKET),
+                       int(sink_conf.get('batch_size', 500)))
+
+    sys.exit("Error while parsing conf file : unknown sink " + sink_type)
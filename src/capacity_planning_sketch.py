@@ -0,0 +1,315 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Mergeable quantile sketches (DDSketch) used by the total_* scripts
+to publish percentiles next to the averages.
+"""
+
+import os
+import json
+import math
+import logging
+import traceback
+
+
+# Percentiles published for each sketched field.
+PERCENTILES = (('p50', 0.50), ('p95', 0.95), ('p99', 0.99))
+
+# Smallest absolute value not counted as zero.
+MIN_INDEXABLE = 1e-9
+
+# Span of the sketches kept per key in the state : the window of the
+# percentiles is covered by hourly sketches, merged when published.
+BUCKET_SECONDS = 3600
+
+
+class DDSketch(object):
+    """
+    Quantile sketch with a relative accuracy guarantee.
+    Values are counted in logarithmic bins; when there are more than
+    "max_bins" bins for a sign, the lowest ones are collapsed, so the
+    memory used does not depend on the number of values.
+    """
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1.0 + relative_accuracy) / (1.0 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def _key(self, value):
+        return int(math.ceil(math.log(value) / self.log_gamma))
+
+    def _value(self, key):
+        return 2.0 * math.pow(self.gamma, key) / (self.gamma + 1.0)
+
+    def _collapse(self, bins):
+        """ Merges the lowest bins until there are at most max_bins. """
+
+        if len(bins) <= self.max_bins:
+            return
+        keys = sorted(bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        target = excess[-1]
+        for key in excess[:-1]:
+            bins[target] += bins.pop(key)
+
+    def add(self, value, count=1):
+        """ Adds a value to the sketch. """
+
+        value = float(value)
+        if value != value:
+            return
+
+        if value > MIN_INDEXABLE:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + count
+            self._collapse(self.positive)
+        elif value < -MIN_INDEXABLE:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + count
+            self._collapse(self.negative)
+        else:
+            self.zero += count
+
+        self.count += count
+        self.sum += value * count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        """ Adds all the values of another sketch to this one. """
+
+        if other.gamma != self.gamma:
+            raise ValueError("Can't merge sketches of different accuracy.")
+
+        for key, count in list(other.positive.items()):
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in list(other.negative.items()):
+            self.negative[key] = self.negative.get(key, 0) + count
+        self._collapse(self.positive)
+        self._collapse(self.negative)
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, quantile):
+        """ Returns the approximated value of a quantile (0 to 1). """
+
+        if self.count <= 0:
+            return 0.0
+
+        rank = quantile * (self.count - 1)
+        seen = 0
+
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return max(-self._value(key), self.min)
+        seen += self.zero
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return min(self._value(key), self.max)
+
+        return self.max
+
+    def to_dict(self):
+        """ Returns a JSON serializable version of the sketch. """
+
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'max_bins': self.max_bins,
+            'positive': dict((str(k), c) for k, c in self.positive.items()),
+            'negative': dict((str(k), c) for k, c in self.negative.items()),
+            'zero': self.zero,
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min if self.count else None,
+            'max': self.max if self.count else None,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """ Builds a sketch from the result of to_dict. """
+
+        sketch = cls(data['relative_accuracy'], data['max_bins'])
+        sketch.positive = dict((int(k), c)
+                               for k, c in data['positive'].items())
+        sketch.negative = dict((int(k), c)
+                               for k, c in data['negative'].items())
+        sketch.zero = data['zero']
+        sketch.count = data['count']
+        sketch.sum = data['sum']
+        if data['count']:
+            sketch.min = data['min']
+            sketch.max = data['max']
+
+        return sketch
+
+
+def load_state(path, window_start):
+    """
+    Loads the sketches saved by a previous run.
+    Returns a dict {"key": {"until", "buckets"}}, "buckets" being
+    {hour start (epoch seconds): {"field": sketch}}; the buckets ended
+    before "window_start" (epoch seconds) are dropped.
+    """
+
+    try:
+        with open(path) as state_file:
+            data = json.load(state_file)
+    except (OSError, IOError, ValueError):
+        if os.path.exists(path):
+            logging.warning("Error while loading sketches state." +
+                            traceback.format_exc())
+        return {}
+
+    state = {}
+    for key, entry in list(data.items()):
+        # States saved before the hourly buckets are dropped
+        if 'buckets' not in entry:
+            continue
+        state[key] = {'until': entry['until'], 'buckets': {}}
+        for hour, sketches in list(entry['buckets'].items()):
+            if int(hour) + BUCKET_SECONDS <= window_start:
+                continue
+            state[key]['buckets'][int(hour)] = dict(
+                (field, DDSketch.from_dict(sketch))
+                for field, sketch in sketches.items())
+
+    return state
+
+
+def save_state(path, state):
+    """ Saves the sketches so the next run can resume them. """
+
+    data = {}
+    for key, entry in list(state.items()):
+        data[key] = {
+            'until': entry['until'],
+            'buckets': dict((str(hour), dict((field, sketch.to_dict())
+                                             for field, sketch
+                                             in sketches.items()))
+                            for hour, sketches in entry['buckets'].items())
+        }
+
+    try:
+        with open(path + ".tmp", "w") as state_file:
+            json.dump(data, state_file)
+        os.rename(path + ".tmp", path)
+    except (OSError, IOError):
+        logging.warning("Error while saving sketches state." +
+                        traceback.format_exc())
+
+
+def update_state(state, key, samples, fields, window_start,
+                 relative_accuracy):
+    """
+    Adds to the hourly sketches of "key" the samples more recent than
+    the last sample already counted. "samples" is a dict of columns
+    {"post_date": [epoch seconds], "field": [values]}.
+    The buckets ended before "window_start" (epoch seconds, None to keep
+    them all) are dropped, and the samples older than it ignored.
+    Returns the sketches of "key" merged over the live buckets.
+    """
+
+    if key not in state:
+        state[key] = {'until': 0, 'buckets': {}}
+    entry = state[key]
+    buckets = entry['buckets']
+
+    until = entry['until']
+    for row, post_date in enumerate(samples['post_date']):
+        if post_date <= entry['until']:
+            continue
+        if window_start is not None and post_date < window_start:
+            continue
+        until = max(until, post_date)
+        hour = int(post_date // BUCKET_SECONDS * BUCKET_SECONDS)
+        bucket = buckets.setdefault(hour, {})
+        for field in fields:
+            # sketch_fields may have changed since the bucket was created
+            bucket.setdefault(field, DDSketch(relative_accuracy)).add(
+                samples[field][row])
+    entry['until'] = until
+
+    if window_start is not None:
+        for hour in [hour for hour in buckets
+                     if hour + BUCKET_SECONDS <= window_start]:
+            del buckets[hour]
+
+    merged = {}
+    for hour, sketches in sorted(buckets.items()):
+        for field in fields:
+            if field not in sketches:
+                continue
+            if field not in merged:
+                merged[field] = DDSketch(sketches[field].relative_accuracy,
+                                         sketches[field].max_bins)
+            merged[field].merge(sketches[field])
+
+    return merged
+
+
+def merged_percentiles(sketches_list, field):
+    """
+    Merges the sketches of a field and returns the percentiles
+    {"field_p50": ..., "field_p95": ..., "field_p99": ..., "field_max": ...}.
+    """
+
+    merged = None
+    for sketches in sketches_list:
+        if field not in sketches:
+            continue
+        if merged is None:
+            merged = DDSketch(sketches[field].relative_accuracy,
+                              sketches[field].max_bins)
+        merged.merge(sketches[field])
+
+    res = {}
+    if merged is None or merged.count <= 0:
+        return res
+    for name, quantile in PERCENTILES:
+        res[field + '_' + name] = merged.quantile(quantile)
+    res[field + '_max'] = merged.max
+
+    return res
@@ -0,0 +1,587 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+
+
+"""
+SNMP stand-in of the EqualLogic SAN groups, to benchmark the SAN poller
+without touching the arrays.
+
+Each fake group is an SNMPv2c agent on its own loopback address
+(127.1.<n / 250>.<n % 250 + 1>) answering GET, GETNEXT and GETBULK on
+the pool tree 1.3.6.1.4.1.12740.16.1 : a walk recorded on a real group
+with the "record" command, or a synthetic tree of "--pools" pools whose
+I/O counters grow with time. The answers can be delayed ("--latency",
+"--jitter"), the requests lost ("--loss"), answered with a genErr
+("--errors") or never answered by a share of dead groups ("--dead").
+
+    capacity_planning_snmpsim.py record san1.example.com san1.tsv
+    capacity_planning_snmpsim.py serve --groups 200 --latency 0.002
+    capacity_planning_snmpsim.py bench --groups 200 --loss 0.01
+
+"serve" prints the "san" map of the simulated groups for the conf
+file. "bench" polls them in process with get_stats_on_all_datacenters
+of capacity_planning_san, the SNMP settings coming from the conf file
+and the documents being dropped, then reports the PDUs sent by the
+poller, the wall time and the CPU time of the poller.
+One socket is opened per group : mind the open files limit.
+"""
+
+import sys
+import json
+import heapq
+import random
+import logging
+import argparse
+import selectors
+import tempfile
+import threading
+import traceback
+import socket
+from bisect import bisect_left, bisect_right
+from time import gmtime, strftime, monotonic, perf_counter, thread_time
+import os
+from pyasn1.codec.ber import decoder, encoder
+from pyasn1.error import PyAsn1Error
+from pysnmp.proto.api import v2c
+from pysnmp.hlapi import bulkCmd, SnmpEngine, CommunityData, \
+    UdpTransportTarget, ContextData, ObjectType, ObjectIdentity
+import capacity_planning_san as san
+from capacity_planning_sinks import NullSink
+
+
+# Subtree recorded by default : the pools of the group.
+POOL_TREE = "1.3.6.1.4.1.12740.16.1"
+
+DEFAULT_PORT = 16100
+
+# Most variables in a GETBULK answer, to stay under the UDP size.
+MAX_BULK_VARBINDS = 1000
+
+GEN_ERR = 5
+
+# Values ending a walk, not recorded.
+END_OF_WALK = (v2c.EndOfMibView, v2c.NoSuchObject, v2c.NoSuchInstance)
+
+# Kinds of PDUs counted by the simulator.
+PDU_KINDS = (
+    (v2c.GetRequestPDU.tagSet, 'get'),
+    (v2c.GetNextRequestPDU.tagSet, 'getnext'),
+    (v2c.GetBulkRequestPDU.tagSet, 'getbulk'),
+)
+
+
+def oid_tuple(oid):
+    """ Returns the tuple of a dotted OID string. """
+
+    return tuple(int(number) for number in oid.strip('.').split('.'))
+
+
+def group_address(number):
+    """ Returns the loopback address of the "number"th fake group. """
+
+    return "127.1.%d.%d" % (number // 250, number % 250 + 1)
+
+
+def counter(base, rate, start):
+    """
+    Returns a Counter32 value growing by "rate" per second since the
+    monotonic time "start", wrapping at 2^32.
+    """
+
+    return lambda: v2c.Counter32(int(base + rate * (monotonic() - start))
+                                 % 2 ** 32)
+
+
+def synthetic_tree(pools, rng, start):
+    """
+    Returns the pool tree of a synthetic SAN group {oid tuple: value}
+    with the "default" pool and "pools" others, a value being a pyasn1
+    object or a function returning one.
+    """
+
+    tree = {}
+    for index in range(1, pools + 2):
+        name = "default" if index == 1 else "pool%d" % (index - 1)
+        tree[oid_tuple(san.POOL_NAME_OID) + (index,)] = v2c.OctetString(name)
+        # Sizes in Mib, up to 100 Tib per pool
+        total = rng.randint(1, 100) * 1024 ** 2
+        for stat, oid, to_gib in san.POOL_STATS:
+            if stat == 'SANCountVol':
+                value = rng.randint(0, 50)
+            elif stat == 'SANTotalVol':
+                value = total
+            else:
+                value = rng.randint(0, total)
+            tree[oid_tuple(oid) + (index,)] = v2c.Integer32(value)
+        for stat, oid in san.POOL_COUNTERS:
+            tree[oid_tuple(oid) + (index,)] = counter(
+                rng.randint(0, 2 ** 32 - 1), rng.uniform(10, 10000), start)
+
+    return tree
+
+
+def load_recording(path):
+    """
+    Returns the tree {oid tuple: value} of a walk recorded by
+    record_walk : one "oid<TAB>type<TAB>value" line per variable.
+    """
+
+    tree = {}
+    with open(path) as recording:
+        for line in recording:
+            try:
+                oid, value_type, value = line.rstrip('\n').split('\t', 2)
+                if value_type == 'OctetString' and value.startswith("0x"):
+                    value = bytes.fromhex(value[2:])
+                elif value_type != 'OctetString' and \
+                        value_type != 'IpAddress' and \
+                        value_type != 'ObjectIdentifier':
+                    value = int(value)
+                tree[oid_tuple(oid)] = getattr(v2c, value_type)(value)
+            except (ValueError, AttributeError, PyAsn1Error):
+                logging.warning("Bad line in " + path + " : " + line)
+
+    return tree
+
+
+def record_walk(host, port, community, oid, output, max_repetitions=50):
+    """
+    Walks the subtree "oid" of a SAN group with GETBULK requests and
+    writes it to "output" in the format of load_recording.
+    Returns the number of variables recorded.
+    """
+
+    count = 0
+    with open(output, "w") as recording:
+        for (error_indication, error_status, error_index, var_binds) \
+            in bulkCmd(SnmpEngine(),
+                       CommunityData(community),
+                       UdpTransportTarget((host, port), timeout=5,
+                                          retries=3),
+                       ContextData(),
+                       0, max_repetitions,
+                       ObjectType(ObjectIdentity(oid)),
+                       lexicographicMode=False):
+            if error_indication or error_status:
+                sys.exit("Error while walking " + host + " : " +
+                         str(error_indication or error_status.prettyPrint()))
+            for name, value in var_binds:
+                if isinstance(value, END_OF_WALK):
+                    continue
+                recording.write(str(name) + "\t" + type(value).__name__ +
+                                "\t" + value.prettyPrint() + "\n")
+                count += 1
+
+    return count
+
+
+class SanSimulator(object):
+    """
+    SNMPv2c agents of fake SAN groups served by one thread.
+    "trees" is {address: {oid tuple: value}}; the groups of "dead" don't
+    answer. Delayed answers wait in a heap until they are due, so the
+    latency doesn't hold the other groups.
+    """
+
+    def __init__(self, trees, community, port=DEFAULT_PORT, latency=0.0,
+                 jitter=0.0, loss=0.0, errors=0.0, dead=(), seed=None):
+        self.trees = {}
+        for address, tree in list(trees.items()):
+            oids = sorted(tree)
+            self.trees[address] = (oids, [tree[oid] for oid in oids])
+        self.community = community
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.errors = errors
+        self.dead = set(dead)
+        self.rng = random.Random(seed)
+        self.stats = dict.fromkeys(('get', 'getnext', 'getbulk', 'responses',
+                                    'varbinds', 'lost', 'errors', 'dead'), 0)
+        # CPU time of the serving thread, once stopped
+        self.cpu = 0.0
+        self.pending = []
+        self.sequence = 0
+        self.running = False
+        self.selector = selectors.DefaultSelector()
+        # Serving thread, see start_simulator
+        self.thread = None
+
+    def bind(self):
+        """ Opens the UDP socket of each group. """
+
+        for address in self.trees:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((address, self.port))
+            sock.setblocking(False)
+            self.selector.register(sock, selectors.EVENT_READ, address)
+        self.running = True
+
+    def serve_forever(self):
+        """ Answers the requests until stop is called. """
+
+        start = thread_time()
+        while self.running:
+            timeout = 0.1
+            if self.pending:
+                timeout = min(timeout, max(self.pending[0][0] - monotonic(),
+                                           0.0))
+            for key, events in self.selector.select(timeout):
+                try:
+                    data, peer = key.fileobj.recvfrom(65535)
+                except OSError:
+                    continue
+                self.receive(key.fileobj, key.data, data, peer)
+            while self.pending and self.pending[0][0] <= monotonic():
+                due, sequence, sock, answer, peer = \
+                    heapq.heappop(self.pending)
+                try:
+                    sock.sendto(answer, peer)
+                except OSError:
+                    logging.warning("Error while answering " + str(peer))
+        self.cpu = thread_time() - start
+        for key in list(self.selector.get_map().values()):
+            key.fileobj.close()
+        self.selector.close()
+
+    def stop(self):
+        """ Stops serve_forever. """
+
+        self.running = False
+
+    def receive(self, sock, address, data, peer):
+        """ Answers a request, when due, unless it is lost. """
+
+        if address in self.dead:
+            self.stats['dead'] += 1
+            return
+        if self.loss and self.rng.random() < self.loss:
+            self.stats['lost'] += 1
+            return
+        answer = self.answer(self.trees[address], data)
+        if answer is None:
+            return
+        self.stats['responses'] += 1
+        delay = self.latency
+        if self.jitter:
+            delay += self.rng.uniform(0.0, self.jitter)
+        self.sequence += 1
+        heapq.heappush(self.pending, (monotonic() + delay, self.sequence,
+                                      sock, answer, peer))
+
+    def answer(self, tree, data):
+        """
+        Returns the encoded response to a request on a tree, or None if
+        it can't be decoded or has the wrong community.
+        """
+
+        try:
+            message, rest = decoder.decode(data, asn1Spec=v2c.Message())
+        except PyAsn1Error:
+            return None
+        if str(v2c.apiMessage.getCommunity(message)) != self.community:
+            return None
+        pdu = v2c.apiMessage.getPDU(message)
+        kind = None
+        for tag_set, name in PDU_KINDS:
+            if pdu.getTagSet() == tag_set:
+                kind = name
+        if kind is None:
+            return None
+        self.stats[kind] += 1
+
+        response = v2c.apiMessage.getResponse(message)
+        response_pdu = v2c.apiMessage.getPDU(response)
+        names = [name for name, value in v2c.apiPDU.getVarBinds(pdu)]
+        if self.errors and self.rng.random() < self.errors:
+            self.stats['errors'] += 1
+            v2c.apiPDU.setErrorStatus(response_pdu, GEN_ERR)
+            v2c.apiPDU.setErrorIndex(response_pdu, 1)
+            v2c.apiPDU.setVarBinds(response_pdu,
+                                   [(name, v2c.Null()) for name in names])
+            return encoder.encode(response)
+
+        if kind == 'get':
+            var_binds = [self.get(tree, name) for name in names]
+        elif kind == 'getnext':
+            var_binds = [self.next(tree, name) for name in names]
+        else:
+            var_binds = self.bulk(tree, names,
+                                  v2c.apiBulkPDU.getNonRepeaters(pdu),
+                                  v2c.apiBulkPDU.getMaxRepetitions(pdu))
+        self.stats['varbinds'] += len(var_binds)
+        v2c.apiPDU.setVarBinds(response_pdu, var_binds)
+
+        return encoder.encode(response)
+
+    @staticmethod
+    def value(value):
+        """ Returns the current value of a variable. """
+
+        return value() if callable(value) else value
+
+    def get(self, tree, name):
+        """ Returns the variable binding of a GET. """
+
+        oids, values = tree
+        oid = tuple(name)
+        position = bisect_left(oids, oid)
+        if position < len(oids) and oids[position] == oid:
+            return name, self.value(values[position])
+
+        return name, v2c.NoSuchObject()
+
+    def next(self, tree, name):
+        """ Returns the variable binding of a GETNEXT. """
+
+        oids, values = tree
+        position = bisect_right(oids, tuple(name))
+        if position < len(oids):
+            return v2c.ObjectIdentifier(oids[position]), \
+                self.value(values[position])
+
+        return name, v2c.EndOfMibView()
+
+    def bulk(self, tree, names, non_repeaters, max_repetitions):
+        """ Returns the variable bindings of a GETBULK. """
+
+        var_binds = [self.next(tree, name) for name in names[:non_repeaters]]
+        repeaters = names[non_repeaters:]
+        if repeaters:
+            max_repetitions = min(max_repetitions,
+                                  MAX_BULK_VARBINDS // len(repeaters))
+        for repetition in range(max_repetitions):
+            row = [self.next(tree, name) for name in repeaters]
+            var_binds += row
+            if all(isinstance(value, v2c.EndOfMibView)
+                   for name, value in row):
+                break
+            repeaters = [name for name, value in row]
+
+        return var_binds
+
+
+def simulated_san(args):
+    """
+    Returns the "san" map {datacenter: {cluster: [address]}} of the
+    simulated groups and their trees {address: tree}.
+    """
+
+    rng = random.Random(args.seed)
+    start = monotonic()
+    recording = load_recording(args.recording) if args.recording else None
+    data = {}
+    trees = {}
+    for number in range(args.groups):
+        address = group_address(number)
+        datacenter = "dc%d" % (number % args.datacenters + 1)
+        cluster = datacenter + "-cluster%d" % (
+            number // args.datacenters % args.clusters + 1)
+        data.setdefault(datacenter, {}).setdefault(cluster, []).append(address)
+        trees[address] = recording if recording is not None else \
+            synthetic_tree(args.pools, rng, start)
+
+    return data, trees
+
+
+def start_simulator(args, community):
+    """ Returns the SanSimulator of the options, serving in a thread. """
+
+    data, trees = simulated_san(args)
+    rng = random.Random(args.seed)
+    dead = [address for address in sorted(trees)
+            if rng.random() < args.dead]
+    simulator = SanSimulator(trees, community, args.port, args.latency,
+                             args.jitter, args.loss, args.errors, dead,
+                             args.seed)
+    simulator.bind()
+    simulator.thread = threading.Thread(target=simulator.serve_forever,
+                                        daemon=True)
+    simulator.thread.start()
+
+    return data, simulator
+
+
+def bench(conf, args):
+    """
+    Polls the simulated groups with get_stats_on_all_datacenters and
+    returns the report of the run.
+    """
+
+    data, simulator = start_simulator(args, conf['snmp_community'])
+    state_dir = tempfile.mkdtemp(prefix="san_bench")
+
+    san.CONF = conf
+    san.SINK = NullSink()
+    san.POOLS_INDEX = conf['indexes']['san_pools']
+    san.HOSTS_INDEX = conf['indexes']['san_hosts']
+    san.DC_INDEX = conf['indexes']['san_dc']
+    san.CLUSTERS_INDEX = conf['indexes']['san_clusters']
+    san.VOLUMES_INDEX = conf['indexes'].get('san_volumes', "sanvolume")
+    san.MEMBERS_INDEX = conf['indexes'].get('san_members', "sanmember")
+    san.SAN_PERF = bool(conf.get('san_perf', False))
+    san.SAN_PERF_STATE = os.path.join(state_dir, "san_perf.json")
+    san.PERF_STATE = {}
+    san.SAN_VOLUMES = bool(conf.get('san_volumes', False))
+    san.LATEST_STATE = False
+    san.SNMP_MAX_REPETITIONS = int(conf.get('snmp_max_repetitions', 50))
+    san.SNMP_COMMUNITY = conf['snmp_community']
+    san.SNMP_PORT = args.port
+    san.SNMP_TIMEOUT = float(conf.get('snmp_timeout', 1))
+    san.SNMP_RETRIES = int(conf.get('snmp_retries', 1))
+    san.SNMP_BUDGET = float(conf.get('san_group_budget', 60))
+    san.BREAKER_THRESHOLD = int(conf.get('san_breaker_threshold', 3))
+    san.BREAKER_BACKOFF = float(conf.get('san_breaker_backoff', 300))
+    san.BREAKER_MAX_BACKOFF = float(conf.get('san_breaker_max_backoff',
+                                             3600))
+    san.SAN_BREAKER_STATE = os.path.join(state_dir, "san_breakers.json")
+    san.BREAKERS = {}
+
+    wall = perf_counter()
+    cpu = thread_time()
+    for run in range(args.runs):
+        dcs_data = san.get_stats_on_all_datacenters(data, True)
+    cpu = thread_time() - cpu
+    wall = perf_counter() - wall
+    simulator.stop()
+    simulator.thread.join()
+
+    stats = simulator.stats
+    return {
+        'groups': args.groups,
+        'runs': args.runs,
+        'pdus': stats['get'] + stats['getnext'] + stats['getbulk'] +
+                stats['lost'] + stats['dead'],
+        'simulator': stats,
+        'stale_groups': sum(dc_data.stale_groups for dc_data in dcs_data),
+        'documents': san.SINK.count,
+        'wall_time': wall,
+        'poller_cpu_time': cpu,
+        'simulator_cpu_time': simulator.cpu,
+    }
+
+
+def parse_conf():
+    """
+    Parse the JSON configuration file and return a map.
+    """
+    __location__ = os.path.realpath(
+        os.path.join(os.getcwd(), os.path.dirname(__file__)))
+
+    # Parse conf file
+    try:
+        conf_file = open(os.path.join(__location__, "capacityPlanning.json"))
+        conf = conf_file.read()
+        conf_file.close()
+    except (OSError, IOError):
+        sys.exit("Error while loading conf file." + traceback.format_exc())
+
+    try:
+        conf = json.loads(conf)
+    except ValueError:
+        sys.exit("Error while parsing conf file." + traceback.format_exc())
+
+    return conf
+
+
+def add_simulator_arguments(parser):
+    """ Adds the options of the simulated groups to an ArgumentParser. """
+
+    parser.add_argument("--groups", type=int, default=100,
+                        help="number of SAN groups (default: 100)")
+    parser.add_argument("--pools", type=int, default=4,
+                        help="pools of the synthetic groups, besides "
+                        "\"default\" (default: 4)")
+    parser.add_argument("--recording",
+                        help="walk replayed by all the groups instead of "
+                        "a synthetic tree")
+    parser.add_argument("--datacenters", type=int, default=2)
+    parser.add_argument("--clusters", type=int, default=5,
+                        help="clusters per datacenter (default: 5)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT,
+                        help="UDP port of the agents (default: %d)" %
+                        DEFAULT_PORT)
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="delay of the answers, in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="random delay added to the latency, "
+                        "in seconds")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="share of the requests lost")
+    parser.add_argument("--errors", type=float, default=0.0,
+                        help="share of the requests answered with a genErr")
+    parser.add_argument("--dead", type=float, default=0.0,
+                        help="share of the groups which never answer")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Simulate SAN groups over SNMP to benchmark the poller.")
+    COMMANDS = PARSER.add_subparsers(dest="command")
+    COMMANDS.required = True
+    RECORD = COMMANDS.add_parser("record",
+                                 help="record the walk of a SAN group")
+    RECORD.add_argument("host")
+    RECORD.add_argument("output")
+    RECORD.add_argument("--oid", default=POOL_TREE,
+                        help="subtree walked (default: %s)" % POOL_TREE)
+    RECORD.add_argument("--port", type=int, default=161)
+    add_simulator_arguments(COMMANDS.add_parser(
+        "serve", help="serve the simulated groups until interrupted"))
+    BENCH = COMMANDS.add_parser(
+        "bench", help="poll the simulated groups and report the costs")
+    add_simulator_arguments(BENCH)
+    BENCH.add_argument("--runs", type=int, default=1,
+                       help="pollings of all the groups (default: 1)")
+    ARGS = PARSER.parse_args()
+
+    CONF = parse_conf()
+
+    LOGFILE = CONF['logs'] + ".log"
+    logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
+    logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
+                     " : Starting capacity planning SAN simulator."))
+
+    if ARGS.command == "record":
+        print("%d variables recorded" % record_walk(
+            ARGS.host, ARGS.port, CONF['snmp_community'], ARGS.oid,
+            ARGS.output, int(CONF.get('snmp_max_repetitions', 50))))
+    elif ARGS.command == "serve":
+        DATA, SIMULATOR = start_simulator(ARGS, CONF['snmp_community'])
+        print(json.dumps({'san': DATA, 'snmp_port': ARGS.port}, indent=4))
+        try:
+            SIMULATOR.thread.join()
+        except KeyboardInterrupt:
+            SIMULATOR.stop()
+    else:
+        print(json.dumps(bench(CONF, ARGS), indent=4))
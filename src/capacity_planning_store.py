@@ -0,0 +1,343 @@
+#!/usr/bin/python3
+
+"""
+Author : Julie Daligaud <julie.daligaud@gmail.com>
+
+MIT License
+
+Copyright (c) 2019 Julie Daligaud
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+"""
+Local columnar store for the samples sent to elastic search.
+
+Each document type (hv, vm, backuphost...) has its own directory with
+one fixed-width file per column :
+    post_date.i8    sample time (seconds since epoch, int64)
+    entity.i4       entity id (int32), index in entities.json
+    <field>.f8      one numeric field (float64, NaN when missing)
+entities.json holds the name and the cluster/datacenter of each entity.
+Columns are appended with the array module and memory-mapped with numpy
+for reads. post_date.i8 is written last and gives the number of rows.
+"""
+
+import os
+import sys
+import json
+import fcntl
+import datetime
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# String fields describing the entity of a document.
+ENTITY_FIELDS = ('name', 'host', 'cluster', 'datacenter')
+
+
+def to_epoch(post_date):
+    """ Converts a post_date (isoformat string) to seconds since epoch. """
+
+    return int(datetime.datetime.fromisoformat(post_date).timestamp())
+
+
+class ColumnStore(object):
+    """ Columnar sample store rooted in a directory. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _dir(self, doc_type):
+        return os.path.join(self.path, doc_type)
+
+    def _column_path(self, doc_type, column):
+        if column == 'post_date':
+            return os.path.join(self._dir(doc_type), "post_date.i8")
+        if column == 'entity':
+            return os.path.join(self._dir(doc_type), "entity.i4")
+        return os.path.join(self._dir(doc_type), column + ".f8")
+
+    def _load_entities(self, doc_type):
+        try:
+            with open(os.path.join(self._dir(doc_type),
+                                   "entities.json")) as entities_file:
+                return json.load(entities_file)
+        except (OSError, IOError):
+            return []
+
+    def _save_entities(self, doc_type, entities):
+        path = os.path.join(self._dir(doc_type), "entities.json")
+        with open(path + ".tmp", "w") as entities_file:
+            json.dump(entities, entities_file)
+        os.rename(path + ".tmp", path)
+
+    def fields(self, doc_type):
+        """ Returns the numeric fields stored for a document type. """
+
+        try:
+            files = os.listdir(self._dir(doc_type))
+        except (OSError, IOError):
+            return []
+
+        return sorted(f[:-3] for f in files if f.endswith(".f8"))
+
+    def count(self, doc_type):
+        """ Returns the number of samples stored for a document type. """
+
+        try:
+            return os.path.getsize(self._column_path(doc_type,
+                                                     'post_date')) // 8
+        except (OSError, IOError):
+            return 0
+
+    def append(self, doc_type, docs):
+        """
+        Appends documents (dicts as sent to ELK) to the store.
+        Numeric fields go in their own column, ENTITY_FIELDS describe
+        the entity, other fields are ignored.
+        """
+
+        if not docs:
+            return
+
+        os.makedirs(self._dir(doc_type), exist_ok=True)
+        lock = open(os.path.join(self._dir(doc_type), "lock"), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        try:
+            rows = self.count(doc_type)
+            entities = self._load_entities(doc_type)
+            ids = {}
+            for entity_id, entity in enumerate(entities):
+                ids[entity['name']] = entity_id
+
+            columns = {}
+            for doc in docs:
+                for key, value in list(doc.items()):
+                    if isinstance(value, (int, float)) and \
+                       not isinstance(value, bool):
+                        columns[key] = array('d')
+            for field in self.fields(doc_type):
+                columns[field] = array('d')
+
+            entity_column = array('i')
+            date_column = array('q')
+            for doc in docs:
+                if doc['name'] not in ids:
+                    ids[doc['name']] = len(entities)
+                    entities.append(dict((key, doc[key])
+                                         for key in ENTITY_FIELDS
+                                         if key in doc))
+                entity_column.append(ids[doc['name']])
+                date_column.append(to_epoch(doc['post_date']))
+                for field, column in list(columns.items()):
+                    value = doc.get(field)
+                    if isinstance(value, (int, float)) and \
+                       not isinstance(value, bool):
+                        column.append(float(value))
+                    else:
+                        column.append(float('nan'))
+
+            self._save_entities(doc_type, entities)
+            for field, column in list(columns.items()):
+                self._write_column(doc_type, field, rows, column)
+            self._write_column(doc_type, 'entity', rows, entity_column)
+            # post_date must be the last column written: it commits the rows
+            self._write_column(doc_type, 'post_date', rows, date_column)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+            lock.close()
+
+    def _write_column(self, doc_type, column, rows, values):
+        """
+        Appends values to a column at row "rows". A column created after
+        the first samples is padded with NaN, a column left longer by an
+        interrupted append is truncated.
+        """
+
+        path = self._column_path(doc_type, column)
+        with open(path, "ab") as column_file:
+            size = column_file.tell() // values.itemsize
+            if size > rows:
+                column_file.truncate(rows * values.itemsize)
+            elif size < rows:
+                array('d', [float('nan')] * (rows - size)).tofile(column_file)
+            values.tofile(column_file)
+
+    def _map(self, doc_type, column, dtype, rows):
+        """ Memory-maps the first "rows" values of a column. """
+
+        if rows <= 0:
+            return numpy.zeros(0, dtype=dtype)
+
+        return numpy.memmap(self._column_path(doc_type, column),
+                            dtype=dtype, mode='r', shape=(rows,))
+
+    def entities(self, doc_type, **attributes):
+        """
+        Returns the names of the entities of a document type matching
+        all given attributes (ex: cluster="ven-mut").
+        """
+
+        return [entity['name'] for entity in self._load_entities(doc_type)
+                if all(entity.get(key) == value
+                       for key, value in list(attributes.items()))]
+
+    def attribute_values(self, doc_type, attribute):
+        """
+        Returns the distinct values of an attribute (ex: cluster)
+        of the entities of a document type.
+        """
+
+        return sorted(set(entity[attribute]
+                          for entity in self._load_entities(doc_type)
+                          if attribute in entity))
+
+    def query(self, doc_type, fields, start=None, end=None, names=None,
+              **attributes):
+        """
+        Returns the samples of a document type between "start" and "end"
+        (seconds since epoch) as a dict of numpy arrays :
+        {"post_date": ..., "name": ..., "field": ...}.
+        Samples can be filtered on entity names and/or attributes.
+        """
+
+        if numpy is None:
+            sys.exit("numpy is needed to read the sample store.")
+
+        rows = self.count(doc_type)
+        entities = self._load_entities(doc_type)
+        dates = self._map(doc_type, 'post_date', numpy.int64, rows)
+        entity_ids = self._map(doc_type, 'entity', numpy.int32, rows)
+
+        mask = numpy.ones(rows, dtype=bool)
+        if start is not None:
+            mask &= dates > start
+        if end is not None:
+            mask &= dates <= end
+        if names is not None or attributes:
+            wanted = set(self.entities(doc_type, **attributes))
+            if names is not None:
+                wanted &= set(names)
+            selected = numpy.zeros(len(entities), dtype=bool)
+            for entity_id, entity in enumerate(entities):
+                selected[entity_id] = entity['name'] in wanted
+            mask &= selected[entity_ids]
+
+        names_array = numpy.array([entity['name'] for entity in entities],
+                                  dtype=object)
+        res = {}
+        res['post_date'] = numpy.asarray(dates[mask])
+        res['name'] = names_array[entity_ids[mask]]
+        for field in fields:
+            if os.path.exists(self._column_path(doc_type, field)):
+                res[field] = numpy.asarray(
+                    self._map(doc_type, field, numpy.float64, rows)[mask])
+            else:
+                res[field] = numpy.full(len(res['post_date']), numpy.nan)
+
+        return res
+
+    def stream(self, doc_type, fields=None, start=None, end=None,
+               chunk_rows=65536):
+        """
+        Yields the samples of a document type between "start" and "end"
+        (seconds since epoch) as documents, in the order they were
+        appended, reading "chunk_rows" rows at a time. "fields" default
+        to all the stored fields.
+        """
+
+        if numpy is None:
+            sys.exit("numpy is needed to read the sample store.")
+
+        if fields is None:
+            fields = self.fields(doc_type)
+        rows = self.count(doc_type)
+        entities = self._load_entities(doc_type)
+        dates = self._map(doc_type, 'post_date', numpy.int64, rows)
+        entity_ids = self._map(doc_type, 'entity', numpy.int32, rows)
+        columns = dict((field, self._map(doc_type, field, numpy.float64,
+                                         rows))
+                       for field in fields
+                       if os.path.exists(self._column_path(doc_type, field)))
+
+        for first in range(0, rows, chunk_rows):
+            last = min(first + chunk_rows, rows)
+            mask = numpy.ones(last - first, dtype=bool)
+            if start is not None:
+                mask &= dates[first:last] > start
+            if end is not None:
+                mask &= dates[first:last] <= end
+            selected = numpy.nonzero(mask)[0] + first
+            if not len(selected):
+                continue
+            chunk = dict((field, column[selected].tolist())
+                         for field, column in list(columns.items()))
+            for position, row in enumerate(selected.tolist()):
+                doc = dict(entities[entity_ids[row]])
+                doc['post_date'] = datetime.datetime.fromtimestamp(
+                    int(dates[row])).isoformat()
+                for field, values in list(chunk.items()):
+                    # NaN : field missing from the document
+                    if values[position] == values[position]:
+                        doc[field] = values[position]
+                yield doc
+
+    def samples_by_name(self, doc_type, fields, start=None, end=None,
+                        **attributes):
+        """
+        Returns the samples between "start" and "end" split by entity
+        name : {"name": {"post_date": array, "field": array}}.
+        """
+
+        samples = self.query(doc_type, fields, start, end, **attributes)
+        res = {}
+
+        for name in numpy.unique(samples['name']):
+            selected = samples['name'] == name
+            res[name] = {'post_date': samples['post_date'][selected]}
+            for field in fields:
+                res[name][field] = samples[field][selected]
+
+        return res
+
+    def averages_by_name(self, doc_type, fields, start=None, end=None,
+                         **attributes):
+        """
+        Returns the average of each field by entity name, on the samples
+        between "start" and "end" : {"name": {"field": average}}.
+        """
+
+        res = {}
+
+        for name, samples in list(self.samples_by_name(
+                doc_type, fields, start, end, **attributes).items()):
+            res[name] = {}
+            for field in fields:
+                values = samples[field][~numpy.isnan(samples[field])]
+                res[name][field] = float(values.mean()) if len(values) \
+                    else 0.0
+
+        return res
@@ -37,27 +37,38 @@ import json
 import logging
 import traceback
 import datetime
-from time import gmtime, strftime
+import argparse
+from time import gmtime, strftime, time
 import os
 import requests
+from capacity_planning_store import ColumnStore, to_epoch
+from capacity_planning_indices import search_url, write_url, type_filter, \
+    latest_search_url
+from capacity_planning_sinks import add_sink_arguments, open_sink
+from capacity_planning_msearch import request_msearch
+from capacity_planning_sketch import load_state, save_state, update_state, \
+    merged_percentiles
 
 
-def send_to_elk(url, data_json):
+# Fields of the backuphost documents summed by datacenter.
+BACKUP_VALUES = ("volumeLogUsed", "volumeLogFree", "volumeUsed",
+                 "volumeFree", "volumeTotal")
+
+
+def send_to_elk(url, data):
     """
-    Send data formated in JSON to the elastic search stack.
+    Send a document to the sink of the script (the elastic search stack
+    by default).
     """
 
-    try:
-        requests.post(url, data=data_json, timeout=5)
-    except RequestException:
-        message = "Error while sending data to elasticsearch at " + url
-        sys.exit(message)
+    SINK.send(url, data)
 
 
-def request(json_value):
-    """ Request values from ES. """
-    req = requests.get(ELK_URL + "/" + MAIN_INDEX + "/" + "_search",
-                       data=json_value, timeout=5)
+def request(json_value, url=None):
+    """ Request values from ES, the backuphost documents by default. """
+    if url is None:
+        url = search_url(CONF, "backuphost")
+    req = requests.get(url, data=json_value, timeout=5)
     if req.status_code != 200:
         message = "Error while requesting object"
         logging.warning(str(message + traceback.format_exc()))
@@ -66,8 +77,8 @@ def request(json_value):
     return json.loads(req.content)
 
 
-def request_filter(filter_values):
-    """Request ELK stack with a filter.
+def search_filter(filter_values):
+    """Build the search body for a filter.
         The filter must be a list of map"""
 
     # "must" :[{"term":{"_type":""}}, {"term" : {"name": ""}}],
@@ -87,22 +98,52 @@ def request_filter(filter_values):
     }
     """
     search = json.loads(search_json)
+    # ES returns 10 hits by default, all the samples of the window are
+    # needed by the averages and the sketches
+    search['size'] = SEARCH_SIZE
     for filter_value in filter_values:
         search['query']['bool']['must'].append({'term': filter_value})
-    search_json = json.dumps(search)
-    return request(search_json)
+    return search
+
+
+def request_filter(filter_values):
+    """Request ELK stack with a filter.
+        The filter must be a list of map"""
+
+    return request(json.dumps(search_filter(filter_values)))
+
+
+def request_filter_batch(filters):
+    """ Request ES with a list of filters, returns one response per filter. """
+    return request_msearch(search_url(CONF, "backuphost", endpoint="_msearch"),
+                           [search_filter(filter_values)
+                            for filter_values in filters],
+                           MSEARCH_CHUNK_SIZE, MSEARCH_MAX_HITS,
+                           MSEARCH_TIMEOUT)
 
 
 def request_by_name(type_value, name_value):
     """ Request value from ES for a host name. """
-    return request_filter([{'_type': type_value}, {'name': name_value}])
+    return request_filter(type_filter(CONF, type_value) +
+                          [{'name': name_value}])
 
 
 def request_bc_host_in_dc(datacenter):
-    """ Return a list of backupHosts in a datacenter"""
+    """
+    Return a list of backupHosts in a datacenter, from their latest-state
+    documents if enabled.
+    """
 
-    dc_query = request_filter([{'_type': 'backuphost'},
-                               {'datacenter': datacenter}])
+    if LATEST_STATE:
+        search = search_filter(type_filter(CONF, 'backuphost') +
+                               [{'datacenter': datacenter}])
+        search['size'] = LATEST_SIZE
+        search['_source'] = ['name']
+        dc_query = request(json.dumps(search),
+                           latest_search_url(CONF, 'backuphost'))
+    else:
+        dc_query = request_filter(type_filter(CONF, 'backuphost') +
+                                  [{'datacenter': datacenter}])
     hosts = {}
     for hit in dc_query['hits']['hits']:
         hosts[hit['_source']['name']] = 1
@@ -112,10 +153,16 @@ def request_bc_host_in_dc(datacenter):
     return result
 
 
-def average_by_name(name, value):
-    """ Returns the average for a host name. """
+def request_hits_by_host(hosts):
+    """ Returns a dict {"host name": response} batched with _msearch. """
+    responses = request_filter_batch([type_filter(CONF, 'backuphost') +
+                                      [{'name': host}] for host in hosts])
+    return dict(zip(hosts, responses))
+
+
+def average_of_hits(hits, value):
+    """ Returns the average of a field over the hits of a request. """
 
-    hits = request_by_name("backuphost", name)
     hits_cpt = 0.0
     hits_sum = 0.0
     for hit in hits['hits']['hits']:
@@ -127,25 +174,101 @@ def average_by_name(name, value):
     return float(hits_sum / hits_cpt)
 
 
-def sum_by_dc(datacenter, value):
+def average_by_name(name, value):
+    """ Returns the average for a host name. """
+    return average_of_hits(request_by_name("backuphost", name), value)
+
+
+def samples_by_host_in_dc(datacenter):
+    """
+    Returns the samples of all backup hosts of a datacenter over the
+    last 24 hours : {"host name": {"post_date": [epoch], "field": [values]}}.
+    The samples come from ES or from the local sample store.
+    """
+    if ROLLUP_SOURCE == "store":
+        return ColumnStore(SAMPLE_STORE).samples_by_name(
+            "backuphost", BACKUP_VALUES, start=time() - 24 * 3600,
+            datacenter=datacenter)
+
+    hits_by_host = request_hits_by_host(request_bc_host_in_dc(datacenter))
+    res = {}
+    for host, hits in list(hits_by_host.items()):
+        sources = [hit['_source'] for hit in hits['hits']['hits']]
+        res[host] = {'post_date': [to_epoch(source['post_date'])
+                                   for source in sources]}
+        for value in BACKUP_VALUES:
+            res[host][value] = [float(source[value]) for source in sources]
+    return res
+
+
+def averages_of_samples_by_host(samples_by_host):
+    """ Returns {"host name": {"field": average}}, NaN are ignored. """
+    res = {}
+    for host, samples in list(samples_by_host.items()):
+        res[host] = {}
+        for value in BACKUP_VALUES:
+            values = [v for v in samples[value] if v == v]
+            res[host][value] = float(sum(values) / len(values)) \
+                if values else 0.0
+    return res
+
+
+def percentiles_by_dc(samples_by_host):
+    """
+    Returns the percentiles of SKETCH_FIELDS in a datacenter, merged
+    from one sketch per host resumed from SKETCH_STATE if any.
+    """
+    window_start = time() - 24 * 3600
+    state = {}
+    if SKETCH_STATE:
+        state = load_state(SKETCH_STATE, window_start)
+    sketches_list = []
+    for host, samples in list(samples_by_host.items()):
+        sketches_list.append(update_state(state, host, samples,
+                                          SKETCH_FIELDS, window_start,
+                                          SKETCH_ACCURACY))
+    if SKETCH_STATE:
+        save_state(SKETCH_STATE, state)
+    res = {}
+    for value in SKETCH_FIELDS:
+        res.update(merged_percentiles(sketches_list, value))
+    return res
+
+
+def sum_by_dc(datacenter, value, averages_by_host=None):
     """ Returns the average by host name in a datacenter. """
-    hosts = request_bc_host_in_dc(datacenter)
+    if averages_by_host is None:
+        averages_by_host = averages_of_samples_by_host(
+            samples_by_host_in_dc(datacenter))
     result = 0.0
-    for host in hosts:
-        result += average_by_name(host, value)
+    for averages in list(averages_by_host.values()):
+        result += averages[value]
     return result
 
 
 def send_sums_by_dc(datacenter):
     """ Send a doc with the sums of volumes by DC """
+    samples_by_host = samples_by_host_in_dc(datacenter)
+    dc_data = sums_by_dc(datacenter,
+                         averages_of_samples_by_host(samples_by_host))
+    if SKETCH_FIELDS:
+        dc_data.update(percentiles_by_dc(samples_by_host))
+
+    send_to_elk(write_url(CONF, BACKUPDC_INDEX), dc_data)
+
+
+def sums_by_dc(datacenter, averages_by_host, now=None):
+    """
+    Process the averages of all backup hosts of a datacenter.
+    Returns the datacenter document, dated "now" (default NOW).
+    """
+    if now is None:
+        now = NOW
     dc_data = {}
     dc_data['name'] = datacenter
-    dc_data['volumeLogUsed'] = sum_by_dc(datacenter, "volumeLogUsed")
-    dc_data['volumeLogFree'] = sum_by_dc(datacenter, "volumeLogFree")
-    dc_data['volumeUsed'] = sum_by_dc(datacenter, "volumeUsed")
-    dc_data['volumeFree'] = sum_by_dc(datacenter, "volumeFree")
-    dc_data['volumeTotal'] = sum_by_dc(datacenter, "volumeTotal")
-    dc_data['post_date'] = NOW.isoformat()
+    for value in BACKUP_VALUES:
+        dc_data[value] = sum_by_dc(datacenter, value, averages_by_host)
+    dc_data['post_date'] = now.isoformat()
 
     if float(dc_data['volumeTotal']) <= 0.0:
         print(("Error vol total on : " + dc_data['name']))
@@ -153,8 +276,7 @@ def send_sums_by_dc(datacenter):
         dc_data['volumeRatio'] = float(dc_data['volumeUsed']) / \
                                        float(dc_data['volumeTotal']) * 100.0
 
-    dc_data_json = json.dumps(dc_data)
-    send_to_elk(ELK_URL + "/" + MAIN_INDEX + "/" + BACKUPDC_INDEX, dc_data_json)
+    return dc_data
 
 
 def parse_conf():
@@ -181,11 +303,33 @@ def parse_conf():
 
 
 if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Send the sums of the backup hosts by datacenter.")
+    add_sink_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
     CONF = parse_conf()
     LOGFILE = CONF['logs']
     ELK_URL = CONF['url']
     MAIN_INDEX = CONF['indexes']['main']
     BACKUPDC_INDEX = CONF['indexes']['backup_dc']
+    MSEARCH_CHUNK_SIZE = int(CONF.get('msearch_chunk_size', 100))
+    # A chunk answers within the timeout for the hits it requests
+    MSEARCH_MAX_HITS = int(CONF.get('msearch_max_hits', 50000))
+    MSEARCH_TIMEOUT = float(CONF.get('msearch_timeout', 30))
+    ROLLUP_SOURCE = CONF.get('rollup_source', "elk")
+    SAMPLE_STORE = CONF.get('sample_store')
+    if ROLLUP_SOURCE == "store" and not SAMPLE_STORE:
+        sys.exit("Error while parsing conf file : no sample_store.")
+    SKETCH_FIELDS = [value for value in CONF.get('sketch_fields',
+                                                 ["volumeFree"])
+                     if value in BACKUP_VALUES]
+    SKETCH_STATE = CONF.get('sketch_state_backups')
+    SKETCH_ACCURACY = float(CONF.get('sketch_accuracy', 0.01))
+    LATEST_STATE = bool(CONF.get('latest_state', False))
+    LATEST_SIZE = int(CONF.get('latest_size', 10000))
+    SEARCH_SIZE = int(CONF.get('search_size', 10000))
+    SINK = open_sink(CONF, ARGS)
     # End parse conf file
 
     NOW = datetime.datetime.now()
@@ -197,3 +341,4 @@ if __name__ == "__main__":
 
     send_sums_by_dc("ven")
     send_sums_by_dc("eqx")
+    SINK.close()
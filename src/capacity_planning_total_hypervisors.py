@@ -32,27 +32,47 @@ import json
 import logging
 import traceback
 import datetime
-from time import gmtime, strftime
+from time import gmtime, strftime, time
 import os
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from capacity_planning_store import ColumnStore, to_epoch
+from capacity_planning_indices import search_url, write_url, type_filter, \
+    latest_search_url, partitioned
+from capacity_planning_sinks import add_sink_arguments, open_sink
+from capacity_planning_msearch import request_msearch
+from capacity_planning_sketch import load_state, save_state, update_state, \
+    merged_percentiles
 
 
-def send_to_elk(url, data_json):
+# Fields of the hv documents summed by cluster.
+HV_VALUES = ("pRAMfree", "pRAMtotal", "pRAMused", "vRAMfree",
+             "vRAMallocated", "pCPU", "vCPUfree", "vCPUallocated")
+
+# Clusters rolled up when they can't be discovered.
+DEFAULT_CLUSTERS = ("ven-mut", "pa2-mut")
+
+# The sketches state file is shared by the clusters processed in parallel.
+SKETCH_LOCK = threading.Lock()
+
+
+def send_to_elk(url, data):
     """
-    Send data formated in JSON to the elastic search stack.
+    Send a document to the sink of the script (the elastic search stack
+    by default).
     """
 
-    try:
-        requests.post(url, data=data_json, timeout=5)
-    except RequestException:
-        message = "Error while sending data to elasticsearch at " + url
-        sys.exit(message)
+    SINK.send(url, data)
 
 
-def request(json_value):
-    """ Request from ELK. """
+def request(json_value, url=None):
+    """ Request from ELK, the hv documents of the last 24h by default. """
 
-    url = ELK_URL + "/" + MAIN_INDEX + "/" + "_search"
+    if url is None:
+        url = search_url(CONF, HV_INDEX)
     req = requests.get(url, data=json_value, timeout=5)
 
     if req.status_code != 200:
@@ -63,9 +83,9 @@ def request(json_value):
     return json.loads(req.content)
 
 
-def request_filter(filter_values):
+def search_filter(filter_values):
     """
-    Request ELK stack with a filter.
+    Build the search body for a filter.
     The filter must be a list of map.
 
     ALL THE AVERAGE ARE DONE ON A PERIODE OF 24 HOURS.
@@ -89,22 +109,74 @@ def request_filter(filter_values):
     }
     """
     search = json.loads(search_json)
+    # ES returns 10 hits by default, all the samples of the window are
+    # needed by the averages and the sketches
+    search['size'] = SEARCH_SIZE
+    # The VMs nested in the hv documents aren't used by the rollups
+    search['_source'] = {'excludes': ['vms']}
 
     for filter_value in filter_values:
         search['query']['bool']['must'].append({'term': filter_value})
-    search_json = json.dumps(search)
 
-    return request(search_json)
+    return search
+
+
+def request_filter(filter_values):
+    """
+    Request ELK stack with a filter.
+    The filter must be a list of map.
+    """
+
+    return request(json.dumps(search_filter(filter_values)))
+
+
+def request_filter_batch(filters):
+    """
+    Request ELK stack with a list of filters in as few round trips
+    as possible. Returns one response per filter, in order.
+    """
+
+    return request_msearch(search_url(CONF, HV_INDEX, endpoint="_msearch"),
+                           [search_filter(filter_values)
+                            for filter_values in filters],
+                           MSEARCH_CHUNK_SIZE, MSEARCH_MAX_HITS,
+                           MSEARCH_TIMEOUT)
 
 
 def request_by_name(typeValue, nameValue):
-    return request_filter([{'_type': typeValue}, {'name': nameValue}])
+    return request_filter(type_filter(CONF, typeValue) +
+                          [{'name': nameValue}])
+
+
+def hosts_in_cluster_search(cluster):
+    """
+    Returns the search of the hosts of a cluster and its url : one
+    latest-state document per host, or the hv documents of the last
+    24 hours (url None).
+    """
+
+    search = search_filter(type_filter(CONF, HV_INDEX) +
+                           [{'cluster': cluster}])
+    if not LATEST_STATE:
+        return search, None
+
+    search['size'] = LATEST_SIZE
+    search['_source'] = ['name']
+
+    return search, latest_search_url(CONF, HV_INDEX)
 
 
 def request_hosts_in_cluster(cluster):
-    """ Request all the host in a cluster from ELK.  """
+    """ Request all the host in a cluster from ELK. """
+
+    search, url = hosts_in_cluster_search(cluster)
+
+    return hosts_of_hits(request(json.dumps(search), url))
+
+
+def hosts_of_hits(dc_query):
+    """ Returns the distinct host names found in the hits of a request. """
 
-    dc_query = request_filter([{'_type': HV_INDEX}, {'cluster': cluster}])
     hosts = {}
 
     for hit in dc_query['hits']['hits']:
@@ -117,10 +189,164 @@ def request_hosts_in_cluster(cluster):
     return result
 
 
-def sum_by_cluster(cluster, value):
-    """ Return the sum of field from all hosts of a cluster.  """
+def discover_clusters():
+    """
+    Returns the clusters of the hv documents of the last 24 hours,
+    from the local sample store or with a composite aggregation on ELK
+    (on the latest states if enabled). Returns DEFAULT_CLUSTERS if ELK
+    can't run the aggregation (ex: ES older than 6.1).
+    """
+
+    if ROLLUP_SOURCE == "store":
+        return ColumnStore(SAMPLE_STORE).attribute_values(HV_INDEX, 'cluster')
+
+    # Strings are keywords in the partitioned templates, dynamically
+    # mapped text with a keyword sub-field in the legacy index
+    field = 'cluster' if partitioned(CONF) else 'cluster.keyword'
+    search = search_filter(type_filter(CONF, HV_INDEX))
+    search['size'] = 0
+    search['aggs'] = {
+        'clusters': {
+            'composite': {
+                'size': 100,
+                'sources': [{'cluster': {'terms': {'field': field}}}]
+            }
+        }
+    }
+    url = latest_search_url(CONF, HV_INDEX) if LATEST_STATE else \
+        search_url(CONF, HV_INDEX)
+    clusters = []
+
+    while True:
+        try:
+            req = requests.get(url, data=json.dumps(search), timeout=30,
+                               headers={'Content-Type': 'application/json'})
+            error = str(req.content)[:1000]
+            result = json.loads(req.content)['aggregations']['clusters']
+        except requests.exceptions.RequestException:
+            error = traceback.format_exc()
+            result = None
+        except (ValueError, KeyError, TypeError):
+            result = None
+        if result is None:
+            logging.warning("Error while discovering the clusters, using " +
+                            ", ".join(DEFAULT_CLUSTERS) + " : " + error)
+            return list(DEFAULT_CLUSTERS)
+        for bucket in result['buckets']:
+            clusters.append(bucket['key']['cluster'])
+        if not result['buckets'] or 'after_key' not in result:
+            break
+        search['aggs']['clusters']['composite']['after'] = result['after_key']
+
+    return clusters
+
+
+def request_hits_by_host(hosts):
+    """
+    Request the raw hits of each host, batched with _msearch.
+    Returns a dict {"host name": response}.
+    """
+
+    responses = request_filter_batch([type_filter(CONF, HV_INDEX) +
+                                      [{'name': host}] for host in hosts])
+
+    return dict(zip(hosts, responses))
+
+
+def samples_by_host_in_cluster(cluster):
+    """
+    Returns the samples of all hosts of a cluster over the last 24 hours :
+    {"host name": {"post_date": [epoch], "field": [values]}}.
+    The samples come from ELK or from the local sample store.
+    """
+
+    if ROLLUP_SOURCE == "store":
+        return ColumnStore(SAMPLE_STORE).samples_by_name(
+            HV_INDEX, HV_VALUES, start=time() - 24 * 3600, cluster=cluster)
+
+    hits_by_host = request_hits_by_host(request_hosts_in_cluster(cluster))
+
+    return samples_of_hits_by_host(hits_by_host)
+
+
+def samples_of_hits_by_host(hits_by_host):
+    """ Returns the samples of each host from the hosts hits. """
+
+    res = {}
+
+    for host, hits in list(hits_by_host.items()):
+        sources = [hit['_source'] for hit in hits['hits']['hits']]
+        res[host] = {}
+        res[host]['post_date'] = [to_epoch(source['post_date'])
+                                  for source in sources]
+        for value in HV_VALUES:
+            res[host][value] = [float(source[value]) for source in sources]
+
+    return res
+
+
+def average(values):
+    """ Returns the average of a list of values, NaN are ignored. """
+
+    values = [value for value in values if value == value]
+    if not values:
+        return 0.0
+
+    return float(sum(values) / len(values))
+
+
+def averages_of_samples_by_host(samples_by_host):
+    """ Returns {"host name": {"field": average}} from the hosts samples. """
+
+    res = {}
+
+    for host, samples in list(samples_by_host.items()):
+        res[host] = {}
+        for value in HV_VALUES:
+            res[host][value] = average(samples[value])
+
+    return res
+
+
+def percentiles_by_cluster(samples_by_host):
+    """
+    Builds a quantile sketch per host for each SKETCH_FIELDS, resuming
+    the sketches saved in SKETCH_STATE by previous runs of the window,
+    and merges them to return the percentiles of the cluster.
+    """
+
+    window_start = time() - 24 * 3600
+    state = {}
+
+    with SKETCH_LOCK:
+        if SKETCH_STATE:
+            state = load_state(SKETCH_STATE, window_start)
+
+        sketches_list = []
+        for host, samples in list(samples_by_host.items()):
+            sketches_list.append(update_state(state, host, samples,
+                                              SKETCH_FIELDS, window_start,
+                                              SKETCH_ACCURACY))
+
+        if SKETCH_STATE:
+            save_state(SKETCH_STATE, state)
+
+    res = {}
+    for value in SKETCH_FIELDS:
+        res.update(merged_percentiles(sketches_list, value))
 
-    hosts = request_hosts_in_cluster(cluster)
+    return res
+
+
+def sum_by_cluster(cluster, value, averages_by_host=None):
+    """
+    Return the sum of field from all hosts of a cluster.
+    "averages_by_host" can be given to reuse the averages already computed.
+    """
+
+    if averages_by_host is None:
+        averages_by_host = averages_of_samples_by_host(
+            samples_by_host_in_cluster(cluster))
     result = 0.0
 
     # Remove one hypervisor from capacity-planning for spare.
@@ -128,16 +354,15 @@ def sum_by_cluster(cluster, value):
     #if value in ('pRAMfree', 'vRAMfree', 'vCPUfree') and len(hosts) > 1:
     #    hosts.pop(len(hosts) - 1)
 
-    for host in hosts:
-        result += average_by_name(host, value)
+    for averages in list(averages_by_host.values()):
+        result += averages[value]
 
     return result
 
 
-def average_by_name(name, value):
-    """ Returns the average of a given field by host name. """
+def average_of_hits(hits, value):
+    """ Returns the average of a given field over the hits of a request. """
 
-    hits = request_by_name(HV_INDEX, name)
     hits_cpt = 0.0
     hits_sum = 0.0
 
@@ -150,19 +375,81 @@ def average_by_name(name, value):
     return float(hits_sum / hits_cpt)
 
 
+def average_by_name(name, value):
+    """ Returns the average of a given field by host name. """
+
+    return average_of_hits(request_by_name(HV_INDEX, name), value)
+
+
 def send_sums_by_cluster(cluster):
     """ Process data per cluster and send results to ELK. """
 
+    send_cluster_data(cluster_document(cluster,
+                                      samples_by_host_in_cluster(cluster)))
+
+
+async def request_hits_by_host_async(elk, cluster):
+    """
+    Request the hosts of a cluster then the raw hits of each host,
+    all the hosts being requested concurrently.
+    Returns a dict {"host name": response}.
+    """
+
+    search, url = hosts_in_cluster_search(cluster)
+    hosts = hosts_of_hits(await elk.request(search, url))
+    responses = await elk.request_all([
+        search_filter(type_filter(CONF, HV_INDEX) + [{'name': host}])
+        for host in hosts])
+
+    return dict(zip(hosts, responses))
+
+
+async def send_sums_by_clusters_async(clusters):
+    """
+    Request the data of all the clusters concurrently, then process
+    them and send results to ELK.
+    """
+
+    from capacity_planning_async_elk import AsyncElk
+
+    async with AsyncElk(search_url(CONF, HV_INDEX), MAX_CONCURRENT_QUERIES,
+                        QUERY_DEADLINE) as elk:
+        results = await asyncio.gather(*[request_hits_by_host_async(elk,
+                                                                    cluster)
+                                         for cluster in clusters])
+
+    for cluster, hits_by_host in zip(clusters, results):
+        send_cluster_data(cluster_document(
+            cluster, samples_of_hits_by_host(hits_by_host)))
+
+
+def cluster_document(cluster, samples_by_host):
+    """
+    Returns the cluster document from the samples of its hosts :
+    the sums of the hosts averages and the percentiles of SKETCH_FIELDS.
+    """
+
+    cluster_data = sums_by_cluster(cluster,
+                                   averages_of_samples_by_host(samples_by_host))
+    if SKETCH_FIELDS:
+        cluster_data.update(percentiles_by_cluster(samples_by_host))
+
+    return cluster_data
+
+
+def sums_by_cluster(cluster, averages_by_host, now=None):
+    """
+    Process the averages of all hosts of a cluster.
+    Returns the cluster document, dated "now" (default NOW).
+    """
+
+    if now is None:
+        now = NOW
+
     cluster_data = {}
     cluster_data['name'] = cluster
-    cluster_data['pRAMfree'] = sum_by_cluster(cluster, "pRAMfree")
-    cluster_data['pRAMtotal'] = sum_by_cluster(cluster, "pRAMtotal")
-    cluster_data['pRAMused'] = sum_by_cluster(cluster, "pRAMused")
-    cluster_data['vRAMfree'] = sum_by_cluster(cluster, "vRAMfree")
-    cluster_data['vRAMallocated'] = sum_by_cluster(cluster, "vRAMallocated")
-    cluster_data['pCPU'] = sum_by_cluster(cluster, "pCPU")
-    cluster_data['vCPUfree'] = sum_by_cluster(cluster, "vCPUfree")
-    cluster_data['vCPUallocated'] = sum_by_cluster(cluster, "vCPUallocated")
+    for value in HV_VALUES:
+        cluster_data[value] = sum_by_cluster(cluster, value, averages_by_host)
 
     if cluster_data['pRAMtotal'] > 0.0 and cluster_data['vRAMallocated'] > 0.0:
         cluster_data['RAMratio'] = float(float(cluster_data['vRAMallocated']) /
@@ -190,11 +477,15 @@ def send_sums_by_cluster(cluster):
                 cluster_data['remaining_vm_type_' + vm_type['type']] = \
                     max(vm_for_cpu, vm_for_ram)
 
-    cluster_data['post_date'] = NOW.isoformat()
-    cluster_data_json = json.dumps(cluster_data)
+    cluster_data['post_date'] = now.isoformat()
+
+    return cluster_data
+
+
+def send_cluster_data(cluster_data):
+    """ Send a cluster document to ELK. """
 
-    send_to_elk(ELK_URL + "/" + MAIN_INDEX + "/" + CLUSTER_INDEX,
-                cluster_data_json)
+    send_to_elk(write_url(CONF, CLUSTER_INDEX), cluster_data)
 
 
 def parse_conf():
@@ -220,6 +511,11 @@ def parse_conf():
     return conf
 
 if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser(
+        description="Send the sums of the hypervisors by cluster.")
+    add_sink_arguments(PARSER)
+    ARGS = PARSER.parse_args()
+
     CONF = parse_conf()
 
     LOGFILE = CONF['logs']
@@ -231,14 +527,42 @@ if __name__ == "__main__":
     CPU_OVERCOMMIT = float(CONF['hv_cpu_overcommit'])
     RAM_OVERCOMMIT = float(CONF['hv_ram_overcommit'])
     VMS_TYPE = CONF['vm_type']
+    MSEARCH_CHUNK_SIZE = int(CONF.get('msearch_chunk_size', 100))
+    # A chunk answers within the timeout for the hits it requests
+    MSEARCH_MAX_HITS = int(CONF.get('msearch_max_hits', 50000))
+    MSEARCH_TIMEOUT = float(CONF.get('msearch_timeout', 30))
+    ASYNC_QUERIES = bool(CONF.get('async_queries', False))
+    MAX_CONCURRENT_QUERIES = int(CONF.get('max_concurrent_queries', 10))
+    QUERY_DEADLINE = float(CONF.get('query_deadline', 5))
+    ROLLUP_SOURCE = CONF.get('rollup_source', "elk")
+    SAMPLE_STORE = CONF.get('sample_store')
+    if ROLLUP_SOURCE == "store" and not SAMPLE_STORE:
+        sys.exit("Error while parsing conf file : no sample_store.")
+    SKETCH_FIELDS = [value for value in CONF.get('sketch_fields',
+                                                 ["pRAMused"])
+                     if value in HV_VALUES]
+    SKETCH_STATE = CONF.get('sketch_state')
+    SKETCH_ACCURACY = float(CONF.get('sketch_accuracy', 0.01))
+    ROLLUP_WORKERS = int(CONF.get('rollup_workers', 4))
+    LATEST_STATE = bool(CONF.get('latest_state', False))
+    LATEST_SIZE = int(CONF.get('latest_size', 10000))
+    SEARCH_SIZE = int(CONF.get('search_size', 10000))
+    SINK = open_sink(CONF, ARGS)
     ###
 
-    NOW = datetime.datetime.NOW()
+    NOW = datetime.datetime.now()
 
     LOGFILE = LOGFILE + ".log"
     logging.basicConfig(filename=LOGFILE, level=logging.DEBUG)
     logging.info(str(strftime("\n\n-----\n" + "%Y-%m-%d %H:%M:%S", gmtime()) +
                      " : Starting capacity planning script."))
 
-    send_sums_by_cluster("ven-mut")
-    send_sums_by_cluster("pa2-mut")
+    CLUSTERS = CONF.get('clusters') or discover_clusters()
+    logging.info("Clusters : " + ", ".join(CLUSTERS))
+
+    if ASYNC_QUERIES and ROLLUP_SOURCE != "store":
+        asyncio.run(send_sums_by_clusters_async(CLUSTERS))
+    else:
+        with ThreadPoolExecutor(max_workers=ROLLUP_WORKERS) as EXECUTOR:
+            list(EXECUTOR.map(send_sums_by_cluster, CLUSTERS))
+    SINK.close()